@@ -2,6 +2,8 @@ import os
 import subprocess
 from zipfile import ZipFile
 
+from wrapper.prop_file import parse_props
+
 class BuildPropCommon(object):
     """
     build.prop common behaviors.
@@ -25,26 +27,11 @@ class BuildPropCommon(object):
         if self.cached_build_props is not None:
             return self.cached_build_props
 
-        self.cached_build_props = {}
-
         # Read in build_props
         with ZipFile(self.local_path_to_zip, 'r') as zipfile_h:
             build_props = zipfile_h.read(self.BUILD_PROP_LOCATION)
 
-        for prop_line in build_props.splitlines():
-            # Skip comments and any line that isn't a key-value pair
-            if prop_line.startswith('#'):
-                continue
-            if '=' not in prop_line:
-                continue
-
-            prop_name, prop_val = prop_line.split('=', 1)
-            if prop_name in self.cached_build_props and \
-                    prop_val != self.cached_build_props[prop_name]:
-                print 'WARN: Duplicate property "%s" has two values ("%s", "%s")' % \
-                    (prop_name, self.cached_build_props[prop_name], prop_val)
-            self.cached_build_props[prop_name] = prop_val
-
+        self.cached_build_props = parse_props(build_props)
         return self.cached_build_props
 
     def get_prop(self, prop=None, props=None):
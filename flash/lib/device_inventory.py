@@ -0,0 +1,88 @@
+#! /usr/bin/python
+
+import os
+import threading
+import time
+
+from wrapper.json_store import JsonStore
+
+class DeviceInventory(object):
+    """
+    What is known about each device this host has seen, keyed by serial, kept across runs
+    in blobs/device_inventory.json:
+
+        {
+          "04f2a52b25e2a8f2": {
+            "codename": "hammerhead",
+            "bootloader_version": "hhz12f",
+            "radio_version": "m8974a-2.0.50.2.25",
+            "recovery_image": "twrp-2.8.6.1-hammerhead.img",
+            "recovery_digest": "5e1c...",
+            "system_fingerprint": ["cyanogenmod", "12.1-20150804-..."],
+            "gapps_version": "20150503",
+            "last_flash_time": 1438723200.0,
+            "last_flash_outcome": "success",
+            "updated": 1438723200.0
+          }
+        }
+
+    Several processes may share the file: each update is merged into it under a lock.
+
+    Entries are a first guess only.  Callers confirm them with a cheap check before
+    acting on them, since a device may have been changed by another host since.
+
+    One inventory is shared by the whole process; use DeviceInventory.get_instance().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    OUTCOME_SUCCESS = 'success'
+    OUTCOME_FAILED = 'failed'
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'blobs', 'device_inventory.json'))
+        self.path = path
+        self.store = JsonStore(path)
+        self.lock = threading.Lock()
+        self.devices = self.store.load()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def get(self, serial):
+        """Returns a copy of the entry for serial ({} if the device was never seen)."""
+        with self.lock:
+            return dict(self.devices.get(serial, {}))
+
+    def get_value(self, serial, key):
+        return self.get(serial).get(key)
+
+    def update(self, serial, **fields):
+        """
+        Merges fields into the entry for serial, and saves if anything changed.
+
+        Fields set to None are left as they were: None means "not found out this time".
+        """
+        if not serial:
+            return
+        fields = dict([(key, list(value) if isinstance(value, tuple) else value)
+                       for key, value in fields.iteritems() if value is not None])
+        with self.lock:
+            entry = self.devices.setdefault(serial, {})
+            changed = dict([(key, value) for key, value in fields.iteritems()
+                            if entry.get(key) != value])
+            if not changed:
+                return
+            changed['updated'] = time.time()
+            # Merged into the file as it is now: another process may have written since.
+            self.devices = self.store.update(
+                self.devices, lambda devices: devices.setdefault(serial, {}).update(changed))
+
+    def record_flash(self, serial, outcome, **fields):
+        """Records the end of a flash, and what the device holds afterwards."""
+        self.update(serial, last_flash_time=time.time(), last_flash_outcome=outcome, **fields)
@@ -1,4 +1,23 @@
+import socket
+import subprocess
+import threading
+
+from wrapper.adb_client import AdbClient, AdbClientException
+from wrapper.device_futures import map_bounded, run_async
+from wrapper.fastboot import Fastboot
+
+from .device_inventory import DeviceInventory
+
 class DevicePicker(object):
+    # Fastboot devices probed at the same time.
+    MAX_PROBES = 8
+
+    # serial -> codename, for the whole process.  A serial's codename never changes, so
+    # a device is only asked once, whether it was seen through adb or fastboot.  Across
+    # runs, the DeviceInventory remembers them.
+    _codenames = {}
+    _codenames_lock = threading.Lock()
+
     @classmethod
     def pick(cls, device_hint=None, interactive=True):
         return cls().choose_device(device_hint=device_hint)
@@ -73,13 +92,18 @@ class DevicePicker(object):
         Returns a list of device dictionaries, or an empty list.
         Dictionaries all have both the 'serial' key and the 'model' key.
         """
-        # Run 'adb devices -l' in a sub-shell, capturing stdout and stderr.
-        devicescmd = subprocess.Popen("adb devices -l", shell = True,
-                                      stdout = subprocess.PIPE)
-        output, errout = devicescmd.communicate()
-        if devicescmd.returncode != 0:
-            print("Failed to list devices via adb: {}".format(errout))
-            return list()
+        try:
+            # Ask the adb server directly.  Its reply is the body of 'adb devices -l'.
+            output = "List of devices attached\n" + AdbClient().devices_l()
+        except (AdbClientException, socket.error):
+            # Run 'adb devices -l' in a sub-shell, capturing stdout and stderr.
+            # This also starts the adb server if it is not running.
+            devicescmd = subprocess.Popen("adb devices -l", shell = True,
+                                          stdout = subprocess.PIPE)
+            output, errout = devicescmd.communicate()
+            if devicescmd.returncode != 0:
+                print("Failed to list devices via adb: {}".format(errout))
+                return list()
 
         accumulator = list()
 
@@ -103,6 +127,7 @@ class DevicePicker(object):
                 if 'product:' in components[3]:
                     product = components[3].split(":")[1]
                 translated_device = self.translate_adb_device(device=device, product=product)
+                self.remember_codename(components[0], translated_device)
 
                 accumulator.append({'serial': components[0],
                                     'device': translated_device})
@@ -116,6 +141,32 @@ class DevicePicker(object):
 
         return accumulator
 
+    @classmethod
+    def remember_codename(cls, serial, codename):
+        if codename:
+            with cls._codenames_lock:
+                cls._codenames[serial] = codename
+            DeviceInventory.get_instance().update(serial, codename=codename)
+
+    @classmethod
+    def get_fastboot_codename(cls, serial):
+        """
+        Returns the codename of a device in fastboot, asking the bootloader only for
+        serials never seen before on this host.
+        """
+        with cls._codenames_lock:
+            if serial in cls._codenames:
+                return cls._codenames[serial]
+        codename = DeviceInventory.get_instance().get_value(serial, 'codename')
+        if codename:
+            codename = str(codename)
+            with cls._codenames_lock:
+                cls._codenames[serial] = codename
+            return codename
+        codename = Fastboot(serial=serial).getvar_product()
+        cls.remember_codename(serial, codename)
+        return codename
+
     def list_devices_fastboot(self):
         devices = list()
         devicescmd = subprocess.Popen(
@@ -125,20 +176,22 @@ class DevicePicker(object):
             print("Failed to list devices via fastboot: {}".format(errout))
             return devices
 
-        for line in output.split("\n"):
-            components = line.split()
-            if len(components) > 0:
-                serial = components[0]
-                product = Fastboot(serial=serial).getvar_product()
-                devices.append({'serial': serial,
-                                'device': product})
+        serials = [line.split()[0] for line in output.split("\n") if line.split()]
+
+        # Bootloaders answer slowly; ask them all at once.
+        codenames = map_bounded(self.get_fastboot_codename, serials, max_workers=self.MAX_PROBES)
+        for serial, codename in zip(serials, codenames):
+            devices.append({'serial': serial,
+                            'device': codename.result()})
 
         return devices
 
     def list_devices(self):
+        # adb answers from its server; fastboot devices are probed meanwhile.
+        fastboot_devices = run_async(self.list_devices_fastboot)
         devices = list()
         devices.extend(self.list_devices_adb())
-        devices.extend(self.list_devices_fastboot())
+        devices.extend(fastboot_devices.result())
         return devices
 
     @classmethod
@@ -1,5 +1,6 @@
 #! /usr/bin/python
 
+from .device_inventory import DeviceInventory
 from .download_client import DownloadClient
 
 class Firmware(object):
@@ -50,6 +51,28 @@ class Firmware(object):
         # 2012-n7-3g
         }
 
+    # Properties that report firmware versions in device and recovery modes, so that an
+    # up-to-date device is never rebooted into fastboot just to be checked.  The first
+    # property with a value wins.  gsm.version.baseband is only set while the radio
+    # interface runs (not in recovery); ro.boot.* come from the bootloader in both modes.
+    VERSION_PROPS = {
+        'hammerhead' : {
+            'bootloader' : ['ro.boot.bootloader'],
+            'radio' : ['gsm.version.baseband'],
+            },
+        'mako' : {
+            'bootloader' : ['ro.boot.bootloader'],
+            'radio' : ['gsm.version.baseband'],
+            },
+        'flo' : {
+            'bootloader' : ['ro.boot.bootloader'],
+            },
+        }
+    DEFAULT_VERSION_PROPS = {
+        'bootloader' : ['ro.boot.bootloader'],
+        'radio' : ['gsm.version.baseband', 'ro.boot.baseband'],
+        }
+
     def __init__(self, adb=None, fastboot=None, device=None,
                  device_info={}, dist=None, download_client=None):
         # Initialize device_name
@@ -90,33 +113,49 @@ class Firmware(object):
             return '5.1'
         return None
 
-    def get_bootloader_version(self):
+    def _get_version_prop(self, firmware):
+        """
+        Returns the firmware version reported by Android or recovery props, or None.
+        """
+        props = self.VERSION_PROPS.get(self.device_name, self.DEFAULT_VERSION_PROPS).get(firmware, [])
+        for prop in props:
+            value = self.adb.getprop(prop)
+            if value:
+                # Multi-SIM devices list one baseband per SIM.
+                return value.split(',')[0].strip()
+        return None
+
+    def get_bootloader_version(self, mode=None):
         if self.device_name not in self.FIRMWARES.keys():
             # Skip firmware version checking for this unknown device
             return None
 
-        mode = self.device.get_mode()
+        if mode is None:
+            mode = self.device.get_mode()
         if mode == 'timedout':
             raise Exception('Unable to verify bootloader version. mode: timedout')
         elif mode == 'fastboot':
             # Assumes Nexus devices
             return self.fastboot.getvar('version-bootloader')
         elif mode in ['recovery', 'device']:
-            return self.adb.getprop('ro.boot.bootloader')
+            return self._get_version_prop('bootloader')
 
         return None
 
-    def get_radio_version(self):
+    def get_radio_version(self, mode=None):
         if self.device_name not in self.FIRMWARES.keys():
             # Skip firmware version checking for this unknown device
             return None
 
-        mode = self.device.get_mode()
+        if mode is None:
+            mode = self.device.get_mode()
         if mode == 'timedout':
             raise Exception('Unable to verify radio version. mode: timedout')
         elif mode == 'fastboot':
             # Assumes Nexus devices
             return self.fastboot.getvar('version-baseband')
+        elif mode in ['recovery', 'device']:
+            return self._get_version_prop('radio')
 
         return None
 
@@ -131,6 +170,13 @@ class Firmware(object):
 
         bootloader_has_update = False
         radio_has_update = False
+        device_bootloader_version = None
+        device_radio_version = None
+        inventory = DeviceInventory.get_instance()
+        known = inventory.get(self.device.serial)
+
+        # Both versions are read in whichever mode the device is in now.
+        mode = self.device.get_mode()
 
         # Get and normalize the proper bootloader version
         proper_bootloader_version = \
@@ -139,7 +185,7 @@ class Firmware(object):
             proper_bootloader_version = proper_bootloader_version.lower()
 
             # Get and normalize the bootloader version currently on the device
-            device_bootloader_version = self.get_bootloader_version()
+            device_bootloader_version = self.get_bootloader_version(mode=mode)
             if device_bootloader_version is not None:
                 device_bootloader_version = device_bootloader_version.lower()
 
@@ -157,7 +203,14 @@ class Firmware(object):
                 proper_radio_version = proper_radio_version.lower()
 
                 # Get and normalize the radio version currently on the device
-                device_radio_version = self.get_radio_version()
+                device_radio_version = self.get_radio_version(mode=mode)
+                if device_radio_version is None and device_bootloader_version is not None and \
+                        known.get('bootloader_version') == device_bootloader_version:
+                    # Recovery does not start the radio, so nothing reports its version.
+                    # The one seen last time holds if the bootloader has not changed since.
+                    device_radio_version = known.get('radio_version')
+                    if device_radio_version is not None:
+                        print 'Radio version not reported; assuming %s, as last seen.' % device_radio_version
                 if device_radio_version is not None:
                     device_radio_version = device_radio_version.lower()
 
@@ -166,8 +219,21 @@ class Firmware(object):
                             device_radio_version, proper_radio_version)
                         radio_has_update = True
 
+        inventory.update(self.device.serial,
+                         bootloader_version=device_bootloader_version,
+                         radio_version=device_radio_version)
         return bootloader_has_update or radio_has_update
 
+    def record_flashed(self):
+        """Notes in the DeviceInventory that this firmware is now on the device."""
+        firmware = self.FIRMWARES[self.device_name][self.firmware_ver]
+        radio_version = firmware.get('radio_version')
+        if radio_version is not None:
+            radio_version = radio_version.lower()
+        DeviceInventory.get_instance().update(self.device.serial,
+                                              bootloader_version=firmware['bootloader_version'].lower(),
+                                              radio_version=radio_version)
+
     def get_bootloader_file(self):
         url = self.FIRMWARES[self.device_name][self.firmware_ver]['bootloader_file']
         return self.download_client.get_local_path(url)
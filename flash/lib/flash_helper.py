@@ -1,29 +1,67 @@
 #! /usr/bin/python
 
 import sys
-import time
+import threading
 
 # From parent package
+from wrapper.device_futures import run_async
+from wrapper.fastboot_chain import FastbootChain
 from wrapper.open_recovery_script import OpenRecoveryScript
 
 from .colorcli import ColorCli
 from .cm_rom import CmRom
+from .device_inventory import DeviceInventory
 from .firmware import Firmware
+from .flash_plan import FlashPlan
 from .google_apps import GoogleApps, NoGoogleAppsException
 from .recovery import Recovery
 from .sideloadable_ota_build import SideloadableOtaBuild
 from .supersu import SuperSU
 
 class FlashHelper(object):
+    # (name, codename, dist) -> DeviceFuture, see shared_download().
+    _shared_downloads = {}
+    _shared_downloads_lock = threading.Lock()
+
     def __init__(self, adb=None, device=None, fastboot=None):
         self.adb = adb
         self.device = device
         self.fastboot = fastboot
         self.userdata_wiped = False
 
+        # Most recent DeviceSnapshot.  Dropped whenever this class changes the device.
+        self.snapshot = None
+
+        # (framework code, fingerprint) read by the preparation plan.
+        self.system_fingerprint = (None, None)
+
+        # (codename, dist) that downloads are shared under, set by start_downloads().
+        self.download_scope = None
+
     def set_userdata_wiped(self):
         self.userdata_wiped = True
 
+    def refresh_snapshot(self, mount_system=False, use_cache=True):
+        """
+        Collects a new DeviceSnapshot in one adb round trip and returns it.
+
+        Decisions that follow read from self.snapshot until the device is changed again.
+        AdbSerial may answer from its boot-scoped read cache unless use_cache is False.
+        """
+        self.snapshot = self.adb.get_snapshot(mount_system=mount_system, use_cache=use_cache)
+        return self.snapshot
+
+    def get_current_snapshot(self):
+        """
+        Returns the current snapshot, collecting one if the last was invalidated.
+        """
+        if self.snapshot is None:
+            return self.refresh_snapshot()
+        return self.snapshot
+
+    def invalidate_snapshot(self):
+        self.snapshot = None
+
     def get_cm_version(self):
         """
         Returns the fully-qualified CM version (CM-11-YYYYMMDD-...) defined by /system.
@@ -42,10 +80,9 @@ class FlashHelper(object):
             self.device.reboot_to_recovery()
 
         # /system is already mounted in device mode
-        if mode == 'recovery':
-            mount_cmd = self.adb.shell('mount /system')
+        snapshot = self.refresh_snapshot(mount_system=(mode == 'recovery'))
 
-        return self.adb.getprop_system('ro.cm.display.version')
+        return snapshot.getprop_system('ro.cm.display.version')
 
     def get_aosp_version(self):
         """
@@ -65,10 +102,9 @@ class FlashHelper(object):
             self.device.reboot_to_recovery()
 
         # /system is already mounted in device mode
-        if mode == 'recovery':
-            mount_cmd = self.adb.shell('mount /system')
+        snapshot = self.refresh_snapshot(mount_system=(mode == 'recovery'))
 
-        return self.adb.getprop_system('ro.build.version.release')
+        return snapshot.getprop_system('ro.build.version.release')
 
     def get_device_system_build_fingerprint(self):
         """
@@ -96,18 +132,17 @@ class FlashHelper(object):
             self.device.reboot_to_recovery()
 
         # /system is already mounted in device mode
-        if mode == 'recovery':
-            mount_cmd = self.adb.shell('mount /system')
+        snapshot = self.refresh_snapshot(mount_system=(mode == 'recovery'))
 
         framework_code = None
         fingerprint = None
-        if self.adb.path_exists('/data/system/packages.xml'):
+        if snapshot.path_exists('/data/system/packages.xml'):
             framework_code = 'cyanogenmod'
-            fingerprint = self.adb.getprop_system('ro.cm.display.version')
+            fingerprint = snapshot.getprop_system('ro.cm.display.version')
 
             if fingerprint in [None, '']:
                 framework_code = 'aosp'
-                fingerprint = self.adb.getprop_system('ro.build.display.id')
+                fingerprint = snapshot.getprop_system('ro.build.display.id')
 
         return (framework_code, fingerprint)
 
@@ -145,74 +180,151 @@ class FlashHelper(object):
             # partitions may never get mounted.
             self.adb.wait_for_path_or_mount(path='/tmp/recovery.log', debounce=3)
 
-        # getprop may fail if the device is still rebooting.
+        # The snapshot may fail if the device is still rebooting.
         try:
-            which_twrp_cmd = self.adb.shell('which twrp')
-            which_twrp = which_twrp_cmd.stdout.strip()
+            return self.refresh_snapshot().is_twrp()
         except:
-            which_twrp = ''
-        return which_twrp != ''
-
-    def flash_firmware(self, first=False, device_info={}, dist=None):
-        firmware = Firmware(device_info=device_info,
-                            dist=dist,
-                            adb=self.adb,
-                            fastboot=self.fastboot,
-                            device=self.device)
-
-        # If --first is passed, then automatically flash firmware
-        replace_firmware = first
-
-        # If we are not authorized to flash firmware, check if firmware is out of date.
-        if not replace_firmware:
-            if firmware.has_update():
-                replace_firmware = True
-
-        # Only continue flashing the firmware if there is a update.
-        if replace_firmware:
-            # Download bootloader and radio
-            bootloader = firmware.get_bootloader_file()
-            radio = firmware.get_radio_file()
+            return False
 
-            self.device.reboot_to_fastboot()
-            self.fastboot.flash('bootloader', bootloader)
-            self.device.reboot_to_fastboot(forced=True)
+    def get_firmware(self, device_info={}, dist=None):
+        return Firmware(device_info=device_info,
+                        dist=dist,
+                        adb=self.adb,
+                        fastboot=self.fastboot,
+                        device=self.device)
 
-            if radio:
-                self.fastboot.flash('radio', radio)
-                self.device.reboot_to_fastboot(forced=True)
+    def identify_recovery(self, device_info={}):
+        """
+        Returns True if the installed recovery is known to be TWRP, False if it is known
+        not to be, and None if only booting it would tell.
+
+        No reboot is made.  In recovery mode, the running recovery is asked.  In device
+        mode, the header of the recovery partition is hashed on the device and compared
+        with the image pinned in Recovery.DEVICE_TO_IMAGE_NAME and with the last image
+        this tool flashed to the device.  A match is TWRP; any other digest may still be
+        a TWRP this tool did not flash, so it is left to booting the recovery.  So is a
+        partition that cannot be read (no root): the record of the last recovery this
+        tool flashed does not say whether a ROM or install-recovery.sh replaced it since.
+        """
+        mode = self.device.get_mode()
+        if mode == 'recovery':
+            return self.is_twrp()
+        elif mode != 'device':
+            return None
+
+        digest = self.adb.get_partition_digest('recovery', Recovery.HEADER_DIGEST_BYTES)
+        if digest is None:
+            return None
+
+        known_digests = set([known for known in [
+            Recovery.get_flashed_digest(self.device.serial),
+            Recovery().get_known_digest(device_info.get('device')),
+            ] if known is not None])
+        if digest in known_digests:
+            return True
+        return None
 
-    def flash_compatible_recovery(self, first=False, device_info={}):
+    def flash_firmware_images(self, firmware):
         """
-        Ensure device receives a compatible recovery.  Handle all device states.
+        Flashes the bootloader and radio of firmware, and leaves the device in fastboot.
         """
-        # If --first is passed, then we flash recovery
-        flash_needed = first
+        # Download bootloader and radio
+        bootloader = firmware.get_bootloader_file()
+        radio = firmware.get_radio_file()
+
+        # One stay in fastboot: the new bootloader has to be running before the
+        # radio is flashed, so each flash is followed by a bootloader restart.
+        chain = FastbootChain(fastboot=self.fastboot, device=self.device,
+                              verbose=self.device.verbose)
+        chain.flash('bootloader', bootloader).reboot_bootloader()
+        if radio:
+            chain.flash('radio', radio).reboot_bootloader()
+
+        self.invalidate_snapshot()
+        if not chain.execute():
+            ColorCli.print_red('Firmware update failed.  Exiting.')
+            sys.exit(1)
+        firmware.record_flashed()
 
-        # Otherwise, only flash recovery if twrp is not installed
-        if not flash_needed:
-            if not self.is_twrp():
-                print 'TWRP not detected. Going to bootloader mode to flash TWRP into recovery.'
-                flash_needed = True
+    def flash_recovery_image(self, first=False, device_info={}):
+        """
+        Flashes TWRP from fastboot and boots it.  With first, also formats system and userdata.
+        """
+        recoveryfile = Recovery().get_recovery(device_info['device'])
 
-        # If flash_needed is true, continue
-        if flash_needed:
-            recoveryfile = Recovery().get_recovery(device_info['device'])
+        # Reboot into bootloader mode, unless a previous step left the device there.
+        self.invalidate_snapshot()
+        self.device.reboot_to_fastboot(forced=False)
 
-            # Reboot into bootloader mode
-            self.device.reboot_to_fastboot()
+        # if --first, also format system and userdata to start from scratch
+        if first:
+            self.fastboot.format('system')
+            self.fastboot.wipe()
+            self.set_userdata_wiped()
 
-            # if --first, also format system and userdata to start from scratch
-            if first:
-                self.fastboot.format('system')
-                self.fastboot.wipe()
-                self.set_userdata_wiped()
+        # Install recovery image
+        if self.fastboot.flash('recovery', recoveryfile):
+            Recovery.record_flashed(self.device.serial, recoveryfile)
 
-            # Install recovery image
-            self.fastboot.flash('recovery', recoveryfile)
+        # Boot to new recovery image (but do not flash recovery)
+        self.device.begin_transition('fastboot', 'recovery')
+        self.fastboot.boot(recoveryfile, just_flashed_recovery=True)
 
-            # Boot to new recovery image (but do not flash recovery)
-            self.fastboot.boot(recoveryfile, just_flashed_recovery=True)
+    def get_preparation_plan(self, flags=None, device_info=None):
+        """
+        Returns the FlashPlan that brings the device to a TWRP with /data and /sdcard
+        mounted: firmware, recovery, partitions, then the installed build's fingerprint.
+
+        The plan picks the order, so that firmware and recovery are flashed in the same
+        stay in fastboot, and checks run in whichever mode the device is already in.
+        The fingerprint is left in self.system_fingerprint.
+        """
+        firmware = self.get_firmware(device_info=device_info, dist=flags.dist)
+        state = {
+            'firmware_update' : False,
+            'recovery_flash' : flags.first,
+            }
+
+        def check_firmware():
+            state['firmware_update'] = firmware.has_update()
+
+        def check_recovery():
+            if self.device.get_mode() == 'recovery':
+                # Do not depend on /cache: with a broken partition table it never mounts.
+                self.adb.wait_for_path_or_mount(path='/tmp/recovery.log', debounce=3)
+            twrp = self.identify_recovery(device_info=device_info)
+            if twrp is None:
+                # Only booting the recovery tells.
+                twrp = self.is_twrp()
+            if not twrp:
+                print 'TWRP not detected. Going to bootloader mode to flash TWRP into recovery.'
+                state['recovery_flash'] = True
+
+        def read_fingerprint():
+            self.system_fingerprint = self.get_device_system_build_fingerprint()
+            if self.system_fingerprint[1]:
+                DeviceInventory.get_instance().update(self.device.serial,
+                                                      system_fingerprint=self.system_fingerprint)
+
+        # 'mounts' is what a reboot throws away: partitions are prepared after the last one.
+        plan = FlashPlan(device=self.device, verbose=flags.verbose)
+        plan.add('check firmware', ['device', 'recovery', 'fastboot'], check_firmware,
+                 writes=['firmware_update'])
+        plan.add('check recovery', ['recovery', 'device'], check_recovery,
+                 reads=['recovery'], writes=['recovery_flash'],
+                 needed=lambda: not flags.first)
+        plan.add('flash firmware', ['fastboot'], lambda: self.flash_firmware_images(firmware),
+                 reads=['firmware_update'], writes=['bootloader', 'mounts'],
+                 needed=lambda: state['firmware_update'])
+        plan.add('flash recovery', ['fastboot'],
+                 lambda: self.flash_recovery_image(first=flags.first, device_info=device_info),
+                 reads=['recovery_flash'], writes=['recovery', 'userdata', 'mounts'],
+                 needed=lambda: state['recovery_flash'], then_mode='recovery')
+        plan.add('prepare partitions', ['recovery'], lambda: self.prepare_partitions(flags=flags),
+                 reads=['recovery'], writes=['userdata', 'mounts'])
+        plan.add('read fingerprint', ['device', 'recovery'], read_fingerprint,
+                 reads=['userdata'], needed=lambda: not flags.full)
+        return plan
 
     def prepare_partitions(self, flags=None, count=0):
         """
@@ -235,8 +347,10 @@ class FlashHelper(object):
         self.adb.wait_for_path_or_mount(path='/tmp/recovery.log', debounce=3)
 
         # Observe device partition state.
-        is_data_mounted = self.adb.is_mount_point_mounted(mount='/data')
-        is_sdcard_mounted = self.adb.is_mount_point_mounted(mount='/sdcard')
+        # Recovery mounts partitions on its own, so the mount table is always re-read.
+        snapshot = self.refresh_snapshot(use_cache=False)
+        is_data_mounted = snapshot.is_mount_point_mounted(mount='/data')
+        is_sdcard_mounted = snapshot.is_mount_point_mounted(mount='/sdcard')
         if is_data_mounted and is_sdcard_mounted:
             # We're done here. Nothing to do.
             return True
@@ -285,8 +399,9 @@ class FlashHelper(object):
             self.device.reboot_to_recovery()
             # Wait for the device to come back
 
-        is_data_mounted = self.adb.is_mount_point_mounted(mount='/data')
-        is_sdcard_mounted = self.adb.is_mount_point_mounted(mount='/sdcard')
+        snapshot = self.refresh_snapshot(use_cache=False)
+        is_data_mounted = snapshot.is_mount_point_mounted(mount='/data')
+        is_sdcard_mounted = snapshot.is_mount_point_mounted(mount='/sdcard')
         if not is_data_mounted:
             if flags.verbose:
                 print '\tprepare_partitions: stage B, /data is not mounted.  This is unexpected.'
@@ -304,8 +419,9 @@ class FlashHelper(object):
 
             self.device.reboot_to_recovery(forced=True)
 
-        is_data_mounted = self.adb.is_mount_point_mounted(mount='/data')
-        is_sdcard_mounted = self.adb.is_mount_point_mounted(mount='/sdcard')
+        snapshot = self.refresh_snapshot(use_cache=False)
+        is_data_mounted = snapshot.is_mount_point_mounted(mount='/data')
+        is_sdcard_mounted = snapshot.is_mount_point_mounted(mount='/sdcard')
         if not is_data_mounted or not is_sdcard_mounted:
             # Now we really need help.
             if flags.verbose:
@@ -326,29 +442,15 @@ class FlashHelper(object):
         self.adb.wait_for_recovery()
 
         # Assume we can check /data now
-        if not self.adb.is_mount_point_mounted(mount='/data'):
+        if not self.adb.is_mount_point_mounted(mount='/data', use_cache=False):
             return False
 
         # Wait for file to be created first.
         self.adb.wait_for_path_or_mount(path='/tmp/releasekey', mount='/data', debounce=2)
 
-        # Then wait for file contents to stablize.
-        count = 0
-        last_sha1sum = None
-        while True:
-            if count > 3:
-                break
-
-            sha1sum_cmd = self.adb.shell('sha1sum /tmp/releasekey')
-            sha1sum = sha1sum_cmd.stdout.strip()
-            if len(sha1sum) > 1:
-                if last_sha1sum is None or last_sha1sum != sha1sum:
-                    count = 1
-                    last_sha1sum = sha1sum
-                else:
-                    count = count + 1
-
-            time.sleep(1)
+        # Then wait for file contents to stablize.  This runs on the device and returns
+        # once the sha1sum has not changed for 3 seconds.
+        sha1sum = self.adb.wait_for_stable_output('sha1sum /tmp/releasekey', 3).value or ''
 
         # Check if the sha1sum is of INVALID
         # $ adb shell sha1sum /tmp/releasekey
@@ -358,6 +460,61 @@ class FlashHelper(object):
 
         return False
 
+    @classmethod
+    def shared_download(cls, key, download, *args, **kwargs):
+        """
+        Returns a DeviceFuture for download(*args, **kwargs), started only once per key
+        in the process.  Devices flashed side by side wait on the same download.
+        """
+        with cls._shared_downloads_lock:
+            if key not in cls._shared_downloads:
+                cls._shared_downloads[key] = run_async(download, *args, **kwargs)
+            return cls._shared_downloads[key]
+
+    def _get_download_key(self, name):
+        if name == 'supersu':
+            # The same zip for every device.
+            return (name,)
+        return (name,) + self.download_scope
+
+    def start_downloads(self, flags=None, full_rom=None, ota_build=None, device_info=None):
+        """
+        Starts downloading the zips that flags already ask for, in the background.
+
+        Returns a dict of name -> DeviceFuture.  The downloads overlap with firmware and
+        recovery flashing and the reboots that follow.  Zips only needed after a decision
+        made on the device (--full or --gapps being assumed) are downloaded when needed.
+        Downloads are shared with other devices of the same codename and dist.
+        """
+        self.download_scope = (device_info['device'], flags.dist)
+        downloads = {}
+        if flags.full and full_rom is not None:
+            # TODO: Unify the interface between SideloadableOtaBuild and CmRom
+            if type(full_rom) == SideloadableOtaBuild:
+                downloads['full_rom'] = self.shared_download(self._get_download_key('full_rom'),
+                                                             full_rom.get_local_path)
+            else:
+                downloads['full_rom'] = self.shared_download(self._get_download_key('full_rom'),
+                                                             full_rom.get_zip)
+            downloads['supersu'] = self.shared_download(self._get_download_key('supersu'),
+                                                        SuperSU().get_supersu_zip)
+        if flags.gapps == '__':
+            google_apps = GoogleApps(device=device_info['device'])
+            downloads['gapps'] = self.shared_download(self._get_download_key('gapps'),
+                                                      google_apps.get_gapps_zip, ota_build=ota_build)
+        return downloads
+
+    def get_download(self, downloads, name, download):
+        """
+        Returns the result of the background download name, or of download() run once
+        for every device sharing this codename and dist.
+        """
+        if name in downloads:
+            return downloads[name].result()
+        if self.download_scope is None:
+            return download()
+        return self.shared_download(self._get_download_key(name), download).result()
+
     @classmethod
     def add_common_arguments(cls, parser=None):
         """
@@ -395,13 +552,38 @@ class FlashHelper(object):
         return parser
 
 
-    def perform_template_flash(self, flags=None, device_info=None,
-                               install_zip=None,
-                               install_system_app_apk=None,
-                               ota_build=None, # Represents a full or delta OTA, if it is included.
-                               full_rom=None):
+    def perform_template_flash(self, flags=None, device_info=None, ota_build=None, **kwargs):
         """
-        A templated flash follows these steps:
+        Runs _perform_template_flash(), and records its outcome in the DeviceInventory.
+        """
+        inventory = DeviceInventory.get_instance()
+        try:
+            self._perform_template_flash(flags=flags, device_info=device_info,
+                                         ota_build=ota_build, **kwargs)
+        except BaseException:
+            inventory.record_flash(device_info['serial'], DeviceInventory.OUTCOME_FAILED,
+                                   codename=device_info['device'])
+            raise
+
+        installed = {}
+        if ota_build is not None:
+            installed['system_fingerprint'] = self.get_ota_build_fingerprint(ota_build=ota_build)
+        if flags.gapps == '__':
+            try:
+                installed['gapps_version'] = GoogleApps.get_gapps_version(ota_build=ota_build)
+            except Exception:
+                pass
+        inventory.record_flash(device_info['serial'], DeviceInventory.OUTCOME_SUCCESS,
+                               codename=device_info['device'], **installed)
+
+    def _perform_template_flash(self, flags=None, device_info=None,
+                                install_zip=None,
+                                install_system_app_apk=None,
+                                ota_build=None, # Represents a full or delta OTA, if it is included.
+                                full_rom=None):
+        """
+        A templated flash follows these steps (the first four, and mounting partitions,
+        run as a FlashPlan that orders them to reboot as little as possible):
         - Check if there is a newer firmware (baseband and radio)
         - Check if compatible recovery is installed (skip if --first)
         - Optinally install compatible recovery
@@ -416,26 +598,26 @@ class FlashHelper(object):
         print '  device name:   %s' % device_info['device']
         print '  device serial: %s' % device_info['serial']
         print '-----------------'
-        # Check if the firmware needs updating.
-        self.flash_firmware(device_info=device_info, dist=flags.dist)
-
-        # Check if the recovery image is twrp.  Flash TWRP if not.
-        self.flash_compatible_recovery(first=flags.first, device_info=device_info)
+        downloads = self.start_downloads(flags=flags, full_rom=full_rom, ota_build=ota_build,
+                                         device_info=device_info)
 
-        self.prepare_partitions(flags=flags)
+        # Update firmware and install TWRP where needed, then mount /data and /sdcard.
+        self.get_preparation_plan(flags=flags, device_info=device_info).execute()
 
         # Check if device needs to have its system flashed. If so, --full is forced on.
         if not flags.full:
-            current_framework, current_fingerprint = self.get_device_system_build_fingerprint()
+            current_framework, current_fingerprint = self.system_fingerprint
             if current_framework in [None, ''] or current_fingerprint in [None, '']:
                 # We will automatically continue if:
                 # 1. --first is passed,
                 # 2. --wipe is passed, or
                 # 3. /data is semantically empty (after a fastboot wipe)
-                if flags.first or flags.wipe or not self.adb.path_exists('/data/system/packages.xml'):
+                # The snapshot taken by get_device_system_build_fingerprint() is still current.
+                data_is_empty = not self.get_current_snapshot().path_exists('/data/system/packages.xml')
+                if flags.first or flags.wipe or data_is_empty:
                     # Toggle --full --gapps on
                     # --wipe can be toggled in case 3 only (but not in cases 1 and 2).
-                    if not flags.first and not flags.wipe and not self.adb.path_exists('/data/system/packages.xml'):
+                    if not flags.first and not flags.wipe and data_is_empty:
                         print 'Android was not found, and /data already looks empty.  Assuming --full --gapps --wipe'
                         flags.wipe = True
                     else:
@@ -495,7 +677,8 @@ class FlashHelper(object):
             upgrade_details = None
             try:
                 upgrade_details = GoogleApps.is_upgrade_available(adb=self.adb,
-                                                                  ota_build=ota_build)
+                                                                  ota_build=ota_build,
+                                                                  snapshot=self.snapshot)
             except NoGoogleAppsException, e:
                 ColorCli.print_red('Skipping GApps: "%s"' % e.message)
 
@@ -510,7 +693,8 @@ class FlashHelper(object):
                     flags.gapps = '__'
 
         # Create OpenRecoveryScript
-        script = OpenRecoveryScript(serial=device_info['serial'], verbose=flags.verbose)
+        script = OpenRecoveryScript(serial=device_info['serial'], verbose=flags.verbose,
+                                    codename=device_info['device'])
 
         # Erase userdata if requested and if not already wiped.
         # Note: For bacon, userdata must be first wiped before CM will install
@@ -527,14 +711,14 @@ class FlashHelper(object):
 
             # TODO: Unify the interface between SideloadableOtaBuild and CmRom
             if type(full_rom) == SideloadableOtaBuild:
-                cm_zip_file = full_rom.get_local_path()
+                cm_zip_file = self.get_download(downloads, 'full_rom', full_rom.get_local_path)
             else:
-                cm_zip_file = full_rom.get_zip()
+                cm_zip_file = self.get_download(downloads, 'full_rom', full_rom.get_zip)
             script.install_zip(cm_zip_file)
 
             # Install SuperSU
             supersu = SuperSU()
-            script.install_zip(supersu.get_supersu_zip())
+            script.install_zip(self.get_download(downloads, 'supersu', supersu.get_supersu_zip))
 
         # If --gapps, install Gapps
         # Also, the required CM version is needed to load the proper gapps (kitkat vs. lollipop)
@@ -544,10 +728,12 @@ class FlashHelper(object):
                 flavor = None
                 google_apps = GoogleApps(flavor=flavor, device=device_info['device'])
 
-                gapps_zip_file = google_apps.get_gapps_zip(ota_build=ota_build)
+                gapps_zip_file = self.get_download(
+                    downloads, 'gapps', lambda: google_apps.get_gapps_zip(ota_build=ota_build))
                 script.install_zip(gapps_zip_file)
 
                 # Install gapps-config
+                self.invalidate_snapshot()
                 self.adb.shell('echo -n > %s/.gapps-config' % OpenRecoveryScript.ZIP_PREFIX)
                 for line in google_apps.get_gapps_config():
                     self.adb.shell('echo %s >> %s/.gapps-config' % (line, OpenRecoveryScript.ZIP_PREFIX))
@@ -565,6 +751,7 @@ class FlashHelper(object):
         script.reboot_to('system')
 
         # Execute script on device
+        self.invalidate_snapshot()
         script.execute()
 
         # If userdata was not already wiped, then check if the user needs to wipe data.
@@ -0,0 +1,205 @@
+#! /usr/bin/python
+
+class FlashStep(object):
+    """
+    One unit of work in a FlashPlan.
+
+    - name: shown in verbose output.
+    - modes: device modes the step can run in, most preferred first.
+    - action: callable doing the work.
+    - reads / writes: names of the device state the step looks at or changes.  Steps
+      that share state keep the order they were added in; the others may move.
+    - needed: optional callable deciding whether the step runs at all.  It is asked once
+      every step the step depends on is finished.
+    - then_mode: the mode the action leaves the device in, if the action itself reboots
+      (for example 'fastboot boot' of a recovery image).
+    """
+    def __init__(self, name=None, modes=None, action=None, reads=(), writes=(),
+                 needed=None, then_mode=None):
+        self.name = name
+        self.modes = list(modes)
+        self.action = action
+        self.reads = set(reads)
+        self.writes = set(writes)
+        self.needed = needed
+        self.then_mode = then_mode
+
+        # Earlier steps that have to finish (or be skipped) before this one.
+        self.depends_on = set()
+
+    def conflicts_with(self, other):
+        """True if the relative order of self and other changes the outcome."""
+        return bool(self.writes & (other.reads | other.writes) or
+                    self.reads & other.writes)
+
+class FlashPlan(object):
+    """
+    Orders the steps of a flash to pass through as few device modes as possible.
+
+    Each reboot (to fastboot, to recovery, to Android) takes 20 to 60 seconds, and used
+    to be decided by every helper on its own.  Instead, every step declares the modes it
+    can run in and the state it reads and writes; the plan runs each step in the mode
+    the device is already in when it can, and groups steps needing the same mode:
+
+        plan = FlashPlan(device=device)
+        plan.add('flash firmware', ['fastboot'], flash_firmware, writes=['bootloader'])
+        plan.add('check recovery', ['recovery'], check_recovery, writes=['recovery_needed'])
+        plan.add('flash recovery', ['fastboot'], flash_recovery, reads=['recovery_needed'],
+                 needed=lambda: recovery_needed, then_mode='recovery')
+        plan.execute()
+
+    The order is searched exhaustively (flash plans have a handful of steps), and
+    searched again after every step, since results decide which conditional steps run.
+    A conditional step that cannot be decided yet is planned as if it will be skipped:
+    conditional work is the exception, and assuming it would pull every plan towards it.
+    """
+    def __init__(self, device=None, verbose=False):
+        self.device = device
+        self.verbose = verbose
+
+        self.steps = []
+        self.completed = set()
+        self.skipped = set()
+        # Conditional steps whose needed() said yes.
+        self.confirmed = set()
+
+        # Mode changes made so far, by the plan or by steps.
+        self.transitions = 0
+
+    def add(self, name, modes, action, reads=(), writes=(), needed=None, then_mode=None):
+        step = FlashStep(name=name, modes=modes, action=action, reads=reads, writes=writes,
+                         needed=needed, then_mode=then_mode)
+        for earlier in self.steps:
+            if earlier.conflicts_with(step):
+                step.depends_on.add(earlier)
+        self.steps.append(step)
+        return self
+
+    def _print_verbose(self, message):
+        if self.verbose:
+            print message
+
+    def _resolve_conditions(self):
+        """Asks needed() of every conditional step whose dependencies are finished."""
+        changed = True
+        while changed:
+            changed = False
+            finished = self.completed | self.skipped
+            for step in self.steps:
+                if step in finished or step in self.confirmed or step.needed is None:
+                    continue
+                if not step.depends_on <= finished:
+                    continue
+                if step.needed():
+                    self.confirmed.add(step)
+                else:
+                    self._print_verbose('FlashPlan: skipping %s' % step.name)
+                    self.skipped.add(step)
+                    changed = True
+
+    def _is_undecided(self, step):
+        return step.needed is not None and step not in self.confirmed and \
+            step not in self.skipped and step not in self.completed
+
+    @classmethod
+    def _moves(cls, step, mode):
+        """Yields (entry mode, transitions, mode afterwards) for running step from mode."""
+        if mode in step.modes:
+            entries = [(mode, 0)]
+        else:
+            entries = [(entry, 1) for entry in step.modes]
+        for entry, cost in entries:
+            after = entry
+            if step.then_mode is not None and step.then_mode != entry:
+                after = step.then_mode
+                cost += 1
+            yield (entry, cost, after)
+
+    def plan(self, mode):
+        """
+        Returns (transitions, [(step, entry mode), ...]): the cheapest order for the
+        remaining steps, starting from mode.  The first step is always ready to run.
+        """
+        finished = frozenset(self.completed | self.skipped)
+        assumed = frozenset([step for step in self.steps if self._is_undecided(step)])
+        pending = [step for step in self.steps if step not in finished and step not in assumed]
+        memo = {}
+
+        def search(planned, mode):
+            key = (planned, mode)
+            if key in memo:
+                return memo[key]
+            best = (0, [])
+            remaining = [step for step in pending if step not in planned]
+            if remaining:
+                best = None
+                satisfied = planned | assumed
+                for step in remaining:
+                    if not step.depends_on <= satisfied:
+                        continue
+                    for entry, cost, after in self._moves(step, mode):
+                        rest = search(planned | frozenset([step]), after)
+                        if best is None or cost + rest[0] < best[0]:
+                            best = (cost + rest[0], [(step, entry)] + rest[1])
+            memo[key] = best
+            return best
+
+        best = (0, [])
+        for step in pending:
+            # Only a step whose dependencies really finished may go first.
+            if not step.depends_on <= finished:
+                continue
+            for entry, cost, after in self._moves(step, mode):
+                rest = search(finished | frozenset([step]), after)
+                if not best[1] or cost + rest[0] < best[0]:
+                    best = (cost + rest[0], [(step, entry)] + rest[1])
+        return best
+
+    def _enter(self, mode):
+        if mode == 'fastboot':
+            entered = self.device.reboot_to_fastboot(forced=False) and \
+                self.device.wait_for_mode(modes=['fastboot']) == 'fastboot'
+        elif mode == 'recovery':
+            entered = self.device.reboot_to_recovery()
+        elif mode == 'device':
+            entered = self.device.reboot_to_device() and \
+                self.device.wait_for_mode(modes=['device']) == 'device'
+        else:
+            raise Exception('FlashPlan cannot enter %s mode' % mode)
+
+        if not entered:
+            raise Exception('Unable to reboot %s into %s mode' % (self.device.serial, mode))
+        self.transitions += 1
+
+    def execute(self):
+        """
+        Runs every needed step.  Returns the number of mode transitions made.
+        """
+        while True:
+            self._resolve_conditions()
+            mode = self.device.get_mode()
+            transitions, order = self.plan(mode)
+            if not order:
+                unfinished = [step.name for step in self.steps
+                              if step not in self.completed and step not in self.skipped]
+                if unfinished:
+                    raise Exception('FlashPlan cannot order: %s' % ', '.join(unfinished))
+                break
+
+            self._print_verbose('FlashPlan: %s -> %s (%d reboots left)' % (
+                mode, ', '.join(['%s@%s' % (step.name, entry) for step, entry in order]),
+                transitions))
+            step, entry = order[0]
+            if mode not in step.modes:
+                self._enter(entry)
+
+            step.action()
+            self.completed.add(step)
+            self.confirmed.discard(step)
+
+            if step.then_mode is not None and step.then_mode != entry:
+                self.device.wait_for_mode(modes=[step.then_mode])
+                self.transitions += 1
+
+        self._print_verbose('FlashPlan: done after %d reboots' % self.transitions)
+        return self.transitions
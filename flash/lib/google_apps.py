@@ -122,18 +122,24 @@ class GoogleApps(BlobsCache):
         raise Exception('Could not determine which gapps to use for ROM %s' % ota_build)
 
     @classmethod
-    def is_upgrade_available(cls, adb=None, ota_build=None):
+    def is_upgrade_available(cls, adb=None, ota_build=None, snapshot=None):
         """
         Determines whether gapps on the system is older than the one the script knows about.
 
         We are standardizing on PA's GApps' distribution, which uses datestamps as their version.
 
+        If snapshot is a DeviceSnapshot taken with /system mounted, the device is not queried.
+
         If an upgrade is available, return a tuple: (old_version, new_version).
         Otherwise, return None.
         """
-        adb.shell('mount /system')
-        device_gapps_version = adb.getprop_file('ro.addon.pa_version',
-                                                prop_file='/system/etc/g.prop')
+        if snapshot is not None and snapshot.is_mount_point_mounted(mount='/system'):
+            device_gapps_version = snapshot.getprop_file('ro.addon.pa_version',
+                                                         prop_file='/system/etc/g.prop')
+        else:
+            adb.shell('mount /system')
+            device_gapps_version = adb.getprop_file('ro.addon.pa_version',
+                                                    prop_file='/system/etc/g.prop')
         script_gapps_version = cls.get_gapps_version(ota_build=ota_build)
 
         upgrade_available = False
@@ -0,0 +1,222 @@
+#! /usr/bin/python
+
+import copy
+import os
+import sys
+import threading
+import time
+import traceback
+
+from wrapper.device_futures import map_bounded, run_async
+
+from .device_picker import DevicePicker
+
+class ThreadOutput(object):
+    """
+    Stand-in for sys.stdout / sys.stderr that sends what each thread prints to that
+    thread's own file, so that devices flashed side by side keep separate logs.
+
+    Threads without a file of their own print to the original stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        # thread ident -> file
+        self.files = {}
+
+    def set_file(self, file_h):
+        with self.lock:
+            self.files[threading.current_thread().ident] = file_h
+
+    def clear_file(self):
+        with self.lock:
+            self.files.pop(threading.current_thread().ident, None)
+
+    def _get_stream(self):
+        with self.lock:
+            return self.files.get(threading.current_thread().ident, self.stream)
+
+    def write(self, data):
+        self._get_stream().write(data)
+
+    def writelines(self, lines):
+        self._get_stream().writelines(lines)
+
+    def flush(self):
+        self._get_stream().flush()
+
+    def __getattr__(self, name):
+        # softspace, encoding, isatty() and the like.
+        return getattr(self._get_stream(), name)
+
+class DeviceResult(object):
+    """
+    The outcome of flashing one device.
+    """
+    def __init__(self, serial=None, codename=None, log_path=None):
+        self.serial = serial
+        self.codename = codename
+        self.log_path = log_path
+        self.passed = False
+        self.error = None
+        self.seconds = 0
+
+class ParallelFlash(object):
+    """
+    Flashes several devices at once, one worker thread per device:
+
+        parallel = ParallelFlash(flags=flags)
+        devices = parallel.select_devices()
+        parallel.run(devices, flash_device)
+        parallel.print_summary()
+
+    Each worker gets its own copy of flags and its own log file; the console only shows
+    when each device starts and finishes.  Work that is the same for every device of a
+    codename (finding the build, downloading zips) is done once, through shared() here
+    and FlashHelper.shared_download(), so the whole run takes about as long as the
+    slowest device.
+    """
+    # Devices flashed at the same time.  Downloads are shared, so this mostly bounds
+    # the adb and fastboot processes running at once.
+    MAX_WORKERS = 16
+
+    def __init__(self, flags=None, log_dir=None):
+        self.flags = flags
+        if log_dir is None:
+            log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'blobs', 'logs'))
+        self.log_dir = log_dir
+
+        self.results = []
+        self.results_lock = threading.Lock()
+
+        # key -> DeviceFuture, see shared().
+        self.shared_results = {}
+        self.shared_lock = threading.Lock()
+
+    def select_devices(self):
+        """
+        Returns the device dictionaries to flash: the serials in flags.serials, or every
+        connected device for flags.all (narrowed by flags.device, if given).
+
+        Devices that cannot be flashed (not connected, adb not authorized) are recorded
+        as failures rather than stopping the others.
+        """
+        connected = DevicePicker().list_devices()
+        if self.flags.serials:
+            by_serial = dict([(device['serial'], device) for device in connected])
+            devices = []
+            for serial in self.flags.serials:
+                if serial in by_serial:
+                    devices.append(by_serial[serial])
+                else:
+                    self._add_failure(serial, None, 'not connected')
+        else:
+            devices = connected
+            if self.flags.device:
+                devices = [device for device in devices
+                           if device['device'] in (self.flags.device, 'unauthorized')]
+
+        authorized = []
+        for device in devices:
+            try:
+                DevicePicker.check_device_authorization(device)
+            except Exception, e:
+                self._add_failure(device['serial'], None, str(e))
+                continue
+            authorized.append(device)
+
+        if not authorized and not self.results:
+            raise Exception('Did not detect any connected devices.')
+        return authorized
+
+    def shared(self, key, function, *args, **kwargs):
+        """
+        Returns function(*args, **kwargs), called only once per key however many workers
+        ask.  A failure is raised in every worker that asks.
+        """
+        with self.shared_lock:
+            if key not in self.shared_results:
+                self.shared_results[key] = run_async(function, *args, **kwargs)
+            future = self.shared_results[key]
+        return future.result()
+
+    def _add_failure(self, serial, codename, error):
+        result = DeviceResult(serial=serial, codename=codename)
+        result.error = error
+        with self.results_lock:
+            self.results.append(result)
+
+    def _get_log_path(self, serial):
+        return os.path.join(self.log_dir, '%s-%s.log' % (serial, time.strftime('%Y%m%d-%H%M%S')))
+
+    def _flash_one(self, device_info, flash_function, stdout, stderr):
+        result = DeviceResult(serial=device_info['serial'], codename=device_info['device'],
+                              log_path=self._get_log_path(device_info['serial']))
+        print >> stdout.stream, '%s (%s): flashing, log in %s' % (
+            result.serial, result.codename, result.log_path)
+
+        started = time.time()
+        with open(result.log_path, 'w', 0) as log_h:
+            stdout.set_file(log_h)
+            stderr.set_file(log_h)
+            try:
+                # Flags are changed during a flash (--gapps may be assumed, for example).
+                flash_function(copy.copy(self.flags), device_info)
+                result.passed = True
+            except SystemExit, e:
+                # Helpers sys.exit(1) when a step fails; the reason is in the log.
+                traceback.print_exc()
+                result.error = 'exited with status %s' % e.code
+            except BaseException, e:
+                traceback.print_exc()
+                result.error = str(e) or e.__class__.__name__
+            finally:
+                stdout.clear_file()
+                stderr.clear_file()
+        result.seconds = time.time() - started
+
+        print >> stdout.stream, '%s (%s): %s after %ds' % (
+            result.serial, result.codename, 'passed' if result.passed else 'FAILED',
+            result.seconds)
+        with self.results_lock:
+            self.results.append(result)
+        return result
+
+    def run(self, devices, flash_function):
+        """
+        Calls flash_function(flags, device_info) for every device, at the same time.
+        Returns the list of DeviceResults, including devices that were not flashed.
+        """
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        stdout = ThreadOutput(sys.stdout)
+        stderr = ThreadOutput(sys.stderr)
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            futures = map_bounded(
+                lambda device_info: self._flash_one(device_info, flash_function, stdout, stderr),
+                devices, max_workers=self.MAX_WORKERS)
+            for future in futures:
+                future.exception()
+        finally:
+            sys.stdout, sys.stderr = stdout.stream, stderr.stream
+        return self.results
+
+    def has_failures(self):
+        with self.results_lock:
+            return any([not result.passed for result in self.results])
+
+    def print_summary(self):
+        with self.results_lock:
+            results = sorted(self.results, key=lambda result: result.serial)
+        print ''
+        print 'Flashed %d devices:' % len(results)
+        for result in results:
+            if result.passed:
+                print '  %-20s %-12s passed   %4ds' % (result.serial, result.codename, result.seconds)
+            else:
+                print '  %-20s %-12s FAILED   %4ds  %s' % (result.serial, result.codename or '?',
+                                                           result.seconds, result.error)
+            if result.log_path:
+                print '      log: %s' % result.log_path
@@ -1,9 +1,12 @@
+import hashlib
+import os
 import sys
 import urllib
 
 from bs4 import BeautifulSoup
 
 from .blobs_cache import BlobsCache
+from .device_inventory import DeviceInventory
 
 class Recovery(BlobsCache):
     # Pins an image name for stability (and is saved in S3 bucket).
@@ -26,6 +29,10 @@ class Recovery(BlobsCache):
 
     TWRP_LINK = 'http://techerrata.com/browse/twrp2/%(device)s'
 
+    # A boot image header up to and including its id, a SHA-1 of the kernel, ramdisk and
+    # second stage.  Hashing these bytes tells images apart without reading all of them.
+    HEADER_DIGEST_BYTES = 608
+
     def __init__(self, *args, **kwargs):
         super(Recovery, self).__init__(*args, **kwargs)
 
@@ -45,6 +52,36 @@ class Recovery(BlobsCache):
 
         return self.download_client.get_local_path(twrp_url)
 
+    @classmethod
+    def get_header_digest(cls, image_path):
+        """
+        Returns the MD5 of the first HEADER_DIGEST_BYTES of an image, to compare with
+        AdbSerial.get_partition_digest().
+        """
+        with open(image_path, 'rb') as file_h:
+            return hashlib.md5(file_h.read(cls.HEADER_DIGEST_BYTES)).hexdigest()
+
+    def get_known_digest(self, device=None):
+        """
+        Returns the header digest of the image pinned for device, or None if the device
+        follows the latest TWRP (which cannot be known ahead of time).
+        """
+        if device not in self.DEVICE_TO_IMAGE_NAME:
+            return None
+        return self.get_header_digest(self.get_recovery(device))
+
+    @classmethod
+    def record_flashed(cls, serial, image_path):
+        """Remembers in the DeviceInventory that image_path was flashed to serial's recovery."""
+        DeviceInventory.get_instance().update(serial,
+                                              recovery_image=os.path.basename(image_path),
+                                              recovery_digest=cls.get_header_digest(image_path))
+
+    @classmethod
+    def get_flashed_digest(cls, serial):
+        """Returns the header digest of the recovery last flashed to serial, or None."""
+        return DeviceInventory.get_instance().get_value(serial, 'recovery_digest')
+
     def latest_twrp_url(self, device=None):
         """
         Returns the URL for the latest TWRP image.
@@ -1,46 +1,50 @@
 #! /usr/bin/python
 
 import argparse
+import sys
 
 from lib.build_set import BuildSet
 from lib.cm_rom import CmRom
 from lib.device_picker import DevicePicker
 from lib.flash_helper import FlashHelper
+from lib.parallel_flash import ParallelFlash
 
 from wrapper.adb import AdbSerial
 from wrapper.device import Device
 from wrapper.fastboot import Fastboot
 
-if __name__ == '__main__':
-    parser = FlashHelper.add_common_arguments(parser=argparse.ArgumentParser())
-    parser.add_argument('--pipeline_number',
-                        type=int,
-                        help='specify the pipeline number to build')
-    flags = parser.parse_args()
-
-    # May be interactive
-    device_info = DevicePicker.pick(device_hint=flags.device)
-    DevicePicker.check_device_authorization(device_info)
-
-    # Instantiate
-    adb = AdbSerial(serial=device_info['serial'], verbose=flags.verbose)
-    device = Device(serial=device_info['serial'], verbose=flags.verbose)
-    fastboot = Fastboot(serial=device_info['serial'], verbose=flags.verbose)
-    flash_helper = FlashHelper(adb=adb, device=device, fastboot=fastboot)
-
+def resolve_builds(flags, codename):
+    """
+    Returns (build_set, cm_rom) for a device codename.  cm_rom is None unless the
+    build is a delta OTA.
+    """
     # Find the appropriate build set
-    build_set = BuildSet(device=device_info['device'],
+    build_set = BuildSet(device=codename,
                          dist=flags.dist,
                          pipeline_number=flags.pipeline_number)
 
+    cm_rom = None
     if build_set.type == BuildSet.TYPE_DELTA_OTA:
         # Delta OTAs require a full ROM.
         # For now, only CM Milestones are supported.
-        delta_ota_zip = build_set.ota_build.get_local_path()
-
         # Check for the latest version of the CM Milestone
-        cm_rom = CmRom(device_info['device'],
+        cm_rom = CmRom(codename,
                        cm_filename=build_set.ota_build.get_base_cm_filename())
+    return (build_set, cm_rom)
+
+def flash_device(flags, device_info, builds):
+    # Instantiate
+    adb = AdbSerial.get_shared(serial=device_info['serial'], verbose=flags.verbose)
+    device = Device(serial=device_info['serial'], verbose=flags.verbose,
+                    codename=device_info['device'])
+    fastboot = Fastboot(serial=device_info['serial'], verbose=flags.verbose)
+    flash_helper = FlashHelper(adb=adb, device=device, fastboot=fastboot)
+
+    build_set, cm_rom = builds
+    if build_set.type == BuildSet.TYPE_DELTA_OTA:
+        delta_ota_zip = FlashHelper.shared_download(
+            ('delta_ota', device_info['device'], flags.dist),
+            build_set.ota_build.get_local_path).result()
 
         flash_helper.perform_template_flash(
             flags = flags,
@@ -54,3 +58,47 @@ if __name__ == '__main__':
             device_info = device_info,
             ota_build = build_set.ota_build,
             full_rom = build_set.ota_build)
+
+def flash_all(flags):
+    """
+    Flashes every selected device at once.  Returns True if all of them passed.
+    """
+    parallel = ParallelFlash(flags=flags, log_dir=flags.log_dir)
+    devices = parallel.select_devices()
+
+    def flash(device_flags, device_info):
+        # One BuildSet per codename, shared by its devices.
+        builds = parallel.shared((device_info['device'], flags.dist),
+                                 resolve_builds, flags, device_info['device'])
+        flash_device(device_flags, device_info, builds)
+
+    parallel.run(devices, flash)
+    parallel.print_summary()
+    return not parallel.has_failures()
+
+if __name__ == '__main__':
+    parser = FlashHelper.add_common_arguments(parser=argparse.ArgumentParser())
+    parser.add_argument('--pipeline_number',
+                        type=int,
+                        help='specify the pipeline number to build')
+    devices_group = parser.add_mutually_exclusive_group()
+    devices_group.add_argument('--all',
+                               action='store_true',
+                               help='flashes every connected device (of --device type, if given) at once')
+    devices_group.add_argument('--serials',
+                               type=lambda value: [serial for serial in value.split(',') if serial],
+                               help='flashes the comma-separated serials at once')
+    parser.add_argument('--log_dir', type=str,
+                        help='where --all and --serials write a log per device (default blobs/logs)')
+    flags = parser.parse_args()
+
+    if flags.all or flags.serials:
+        if not flash_all(flags):
+            sys.exit(1)
+        sys.exit(0)
+
+    # May be interactive
+    device_info = DevicePicker.pick(device_hint=flags.device)
+    DevicePicker.check_device_authorization(device_info)
+
+    flash_device(flags, device_info, resolve_builds(flags, device_info['device']))
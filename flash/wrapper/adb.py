@@ -1,39 +1,121 @@
+import hashlib
+import os
+import re
+import signal
+import socket
 import subprocess
+import threading
 import time
 
+from .adb_client import AdbClient, AdbClientException, AdbSyncFailException
+from .adb_exceptions import (
+    AdbCommandException,
+    NoDeviceException,
+    ERROR_FAILED,
+    ERROR_NO_DEVICE,
+    ERROR_TIMEDOUT,
+    EXCEPTIONS_BY_ERROR,
+    classify_adb_output,
+)
+from .apk_install import ApkBatchInstall, ApkInstallResult
 from .console_wrapper import ConsoleWrapper
+from .device_snapshot import DeviceSnapshot
+from .device_tracker import DeviceTracker
+from .device_wait import DeviceWait, DeviceWaitResult
+from .device_watch import DeviceWatch
+from .prop_file import parse_props
+from .read_cache import BootScopedReadCache
+from .retry import Deadline, backoff_delay
+from .shared_artifact import SharedArtifact
+from .shell_session import AdbShellResult, AdbShellSession, AdbShellSessionException, AdbShellSessionTimeout
 
 class AdbCommand(object):
     """
     This wrapper retries until a clean execution happens (return code of 0).
 
     For non-idempotent commands, automatic retries can be disabled by setting attempts.
+
+    Each attempt is bounded by timeout seconds, and all attempts (including the backoff
+    between them) by deadline, a retry.Deadline shared with the caller.  Retries back off
+    exponentially with jitter.
+
+    After construction, error is None if adb ran the command, or one of ERROR_TIMEDOUT,
+    ERROR_NO_DEVICE and ERROR_FAILED.  raise_for_error() turns it into an exception.
     """
-    def __init__(self, serial, verbose, raw_command=None, shell_command=None, attempts=3):
+    def __init__(self, serial, verbose, raw_command=None, shell_command=None, attempts=3,
+                 timeout=None, deadline=None):
         line = self.construct_line(serial, raw_command=raw_command, shell_command=shell_command)
+        self.line = line
+        deadline = Deadline.coerce(deadline=deadline)
+
+        self.stdout = ''
+        self.stderr = ''
+        self.returncode = None
+        self.error = ERROR_TIMEDOUT
 
         for i in xrange(attempts):
+            attempt_timeout = deadline.bound(timeout)
+            if attempt_timeout is not None and attempt_timeout <= 0:
+                break
+
             if verbose:
                 if i < 1:
                     print '\tExecuting: %s' % line
                 else:
                     print '\tExecuting (retry %d): %s' % (i+1, line)
-            command = subprocess.Popen(line,
-                                       shell=True,
-                                       stdout=subprocess.PIPE)
-            self.stdout, self.stderr = command.communicate()
-            self.returncode = command.returncode
+            self._execute(line, attempt_timeout)
 
             if verbose and self.returncode != 0:
-                print '\tReturnCode = %s' % self.returncode
+                print '\tReturnCode = %s (%s)' % (self.returncode, self.error)
+                if self.stderr:
+                    print '\t%s' % self.stderr.strip()
 
             # Break if successful
             if self.returncode == 0:
                 break
 
-            # If the loop will restart, then we should wait one second
+            # If the loop will restart, then we should back off first
             if i+1 < attempts:
-                time.sleep(1)
+                delay = deadline.bound(backoff_delay(i))
+                time.sleep(delay)
+
+    def _execute(self, line, timeout):
+        # Run adb in its own process group, so a timeout kills adb and not just /bin/sh.
+        command = subprocess.Popen(line,
+                                   shell=True,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   preexec_fn=os.setsid)
+        timed_out = []
+        timer = None
+        if timeout is not None:
+            def kill():
+                timed_out.append(True)
+                try:
+                    os.killpg(command.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            self.stdout, self.stderr = command.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self.returncode = command.returncode
+
+        if timed_out:
+            self.error = ERROR_TIMEDOUT
+        elif self.returncode != 0:
+            self.error = classify_adb_output(self.stderr)
+        else:
+            self.error = None
+
+    def raise_for_error(self):
+        """Raises the AdbCommandException subclass matching error, if any."""
+        if self.error is not None:
+            raise EXCEPTIONS_BY_ERROR[self.error]('%s: %s (%s)' % (
+                self.error, self.line, (self.stderr or '').strip()))
 
     @classmethod
     def construct_line(cls, serial, raw_command=None, shell_command=None):
@@ -52,37 +134,194 @@ class AdbCommand(object):
             line = 'adb -s "%s" shell "%s"' % (serial, shell_command)
         return line
 
-class AdbCommandException(Exception):
-    """
-    Used to indicate a non-zero return-code.
-
-    Since this exception is a checked exception, AdbCommand() commands and
-    their callers need to be updated to properly catch this.
-    """
-    pass
-
-class NoDeviceException(Exception):
-    def __unicode__():
-        return u"NoDeviceException"
+class AdbSerial(ConsoleWrapper):
+    # serial -> AdbSerial shared by every caller in the process (see get_shared).
+    _shared = {}
+    _shared_lock = threading.Lock()
 
-    def __str__():
-        return "NoDeviceException"
+    @classmethod
+    def get_shared(cls, serial=None, verbose=None):
+        """
+        Returns the process-wide AdbSerial for serial, creating it on first use.
 
-class AdbSerial(ConsoleWrapper):
-    def __init__(self, serial=None, verbose=None):
+        Sharing keeps one shell session and one read cache per device, instead of one per
+        call site.  Use from one thread per device; the session is not thread safe.
+        """
+        with cls._shared_lock:
+            adb = cls._shared.get(serial)
+            if adb is None:
+                adb = cls(serial=serial, verbose=verbose)
+                cls._shared[serial] = adb
+            return adb
+
+    def __init__(self, serial=None, verbose=None, persistent_shell=True):
         ConsoleWrapper.__init__(self, verbose=verbose)
         self.serial = serial
 
-    def shell(self, in_command, attempts=3, use_exception=False):
-        out_command = AdbCommand(self.serial, self.verbose, shell_command=in_command)
+        # Shell commands are multiplexed over one long-lived 'adb shell' unless disabled.
+        self.shell_session = None
+        if persistent_shell:
+            self.shell_session = AdbShellSession(serial=serial, verbose=verbose)
+
+        # Talks to the local adb server directly for reboot and push.
+        self.client = AdbClient()
+
+        # Read results for the current boot.  Only used with the shell session, whose
+        # generation tells us when the device may have rebooted.
+        self.read_cache = BootScopedReadCache()
+        self.read_cache_generation = None
+
+        # Parsed prop files, keyed by path.  Each entry remembers the 'cat' result it was
+        # parsed from, so it lives exactly as long as that result stays in the read cache.
+        self.prop_files = {}
+
+    def shell(self, in_command, attempts=3, use_exception=False, use_cache=True, timeout=None,
+              deadline=None):
+        """
+        Runs in_command on the device.
+
+        Read-only and idempotent commands are answered from the boot-scoped read cache when
+        possible.  Pass use_cache=False when polling for a change the device makes on its
+        own (mounts appearing, files being written).
+
+        timeout bounds each attempt, in seconds.  deadline (a retry.Deadline) bounds all
+        attempts together, and is meant to be shared across a caller's sequence of commands.
+
+        The result's error attribute says whether the command timed out, found no device or
+        failed in adb; with use_exception, the matching AdbCommandException subclass is raised.
+        """
+        deadline = Deadline.coerce(deadline=deadline)
+        if self.shell_session is not None:
+            out_command = self._cached_session_shell(in_command, attempts=attempts,
+                                                     use_cache=use_cache, timeout=timeout,
+                                                     deadline=deadline)
+        else:
+            out_command = AdbCommand(self.serial, self.verbose, shell_command=in_command,
+                                     attempts=attempts, timeout=timeout, deadline=deadline)
 
         # If the caller can handle exceptions, raise AdbCommandException if return code is not 0.
         if use_exception and out_command.returncode != 0:
-            raise AdbCommandException()
+            if out_command.error is not None:
+                raise EXCEPTIONS_BY_ERROR[out_command.error]('%s: %s' % (out_command.error, in_command))
+            raise AdbCommandException('Return code %s: %s' % (out_command.returncode, in_command))
 
         # Legacy behavior: return the command
         return out_command
 
+    def _cached_session_shell(self, in_command, attempts=3, use_cache=True, timeout=None,
+                              deadline=None):
+        command_class = BootScopedReadCache.classify(in_command)
+
+        if command_class == BootScopedReadCache.WRITE:
+            self.read_cache.invalidate()
+            return self._session_shell(in_command, attempts=attempts, timeout=timeout,
+                                       deadline=deadline)
+
+        if command_class == BootScopedReadCache.VOLATILE:
+            return self._session_shell(in_command, attempts=attempts, timeout=timeout,
+                                       deadline=deadline)
+
+        if not use_cache:
+            if command_class == BootScopedReadCache.IDEMPOTENT:
+                self.read_cache.invalidate()
+            return self._session_shell(in_command, attempts=attempts, timeout=timeout,
+                                       deadline=deadline)
+
+        if self._validate_read_cache(attempts=attempts):
+            cached = self.read_cache.get(in_command)
+            if cached is not None:
+                self.print_verbose('Cached (%s): %s' % (command_class, in_command))
+                return cached
+
+        if command_class == BootScopedReadCache.IDEMPOTENT:
+            self.read_cache.invalidate()
+
+        out_command = self._session_shell(in_command, attempts=attempts, timeout=timeout,
+                                          deadline=deadline)
+
+        # Only cache commands that ran in the boot the cache was validated for.  A change
+        # that failed (mount /system while TWRP is still starting) has to run again.
+        if out_command.returncode != AdbShellSession.TRANSPORT_FAILURE and \
+           self.shell_session.generation == self.read_cache_generation and \
+           (command_class != BootScopedReadCache.IDEMPOTENT or out_command.returncode == 0):
+            self.read_cache.put(in_command, out_command)
+        return out_command
+
+    def _validate_read_cache(self, attempts=3):
+        """
+        Makes sure the read cache belongs to the current boot and mode of the device.
+
+        Free while the shell session stays up.  Otherwise, costs one round trip to read
+        /proc/sys/kernel/random/boot_id.  Returns False if the key cannot be read.
+        """
+        if self.shell_session.is_alive() and \
+           self.shell_session.generation == self.read_cache_generation:
+            return True
+
+        boot_key_cmd = self._session_shell(BootScopedReadCache.BOOT_KEY_COMMAND, attempts=attempts)
+        boot_key = None
+        if boot_key_cmd.returncode == 0:
+            boot_key = BootScopedReadCache.parse_boot_key(boot_key_cmd.stdout)
+        if boot_key is None:
+            self.read_cache.invalidate()
+            self.read_cache_generation = None
+            return False
+
+        self.read_cache.set_boot_key(boot_key)
+        self.read_cache_generation = self.shell_session.generation
+        self.print_verbose('Read cache key: boot_id=%s mode=%s' % boot_key)
+        return True
+
+    def invalidate_read_cache(self):
+        """Drops all cached read results."""
+        self.read_cache.invalidate()
+
+    def _session_shell(self, in_command, attempts=3, timeout=None, deadline=None):
+        """
+        Runs in_command in the persistent shell session, reconnecting as needed.
+
+        Mirrors AdbCommand: retries up to attempts times with backoff, but only when the
+        session failed before the command started (device rebooting or unplugged).  A
+        command that started and then timed out or lost its session may have run, so it is
+        not retried (an appending 'echo >>' would append twice).  Stops early once deadline
+        has expired.
+        """
+        deadline = Deadline.coerce(deadline=deadline)
+        error = ERROR_TIMEDOUT
+        for i in xrange(attempts):
+            attempt_timeout = deadline.bound(timeout)
+            if attempt_timeout is not None and attempt_timeout <= 0:
+                break
+
+            if i < 1:
+                self.print_verbose('Executing (session): %s' % in_command)
+            else:
+                self.print_verbose('Executing (session, retry %d): %s' % (i+1, in_command))
+            try:
+                return self.shell_session.execute(in_command, timeout=attempt_timeout)
+            except AdbShellSessionTimeout, e:
+                self.print_verbose('Shell session timed out: %s' % e)
+                error = ERROR_TIMEDOUT
+                if e.command_started:
+                    break
+            except (AdbShellSessionException, OSError), e:
+                self.print_verbose('Shell session failed: %s' % e)
+                error = classify_adb_output(str(e))
+                if getattr(e, 'command_started', False):
+                    break
+
+            # If the loop will restart, then we should back off first
+            if i+1 < attempts:
+                time.sleep(deadline.bound(backoff_delay(i)))
+
+        return AdbShellResult(stdout='', returncode=AdbShellSession.TRANSPORT_FAILURE, error=error)
+
+    def close(self):
+        """Closes the persistent shell session, if any."""
+        self.read_cache.invalidate()
+        if self.shell_session is not None:
+            self.shell_session.close()
+
     def getprop(self, property):
         """Returns the property requested. None if there's nothing."""
         prop = self.shell('getprop %s' % property)
@@ -99,14 +338,34 @@ class AdbSerial(ConsoleWrapper):
         getprop() uses the getprop utility, which reads from /defaults.prop if the device
         is in recovery mode.
         """
-        prop_cmd = self.shell('grep ^%s %s' % (property, prop_file))
-        if prop_cmd.returncode != 0:
+        return self.read_prop_file(prop_file).get(property, '')
+
+    def read_prop_file(self, prop_file, use_cache=True):
+        """
+        Returns all properties defined in a build.prop-style file on the device, as a dict.
+
+        The file is read with a single 'cat' and parsed like BuildPropCommon parses the
+        build.prop of a zip.  With the shell session, the result is kept until the next
+        write or reboot, so any number of lookups cost one round trip.
+
+        Returns an empty dict if the file does not exist.
+        """
+        cat_cmd = self.shell('cat %s' % prop_file, use_cache=use_cache)
+        if cat_cmd.returncode == AdbShellSession.TRANSPORT_FAILURE or \
+           cat_cmd.error in [ERROR_TIMEDOUT, ERROR_NO_DEVICE]:
             raise Exception('Unable to read %s' % prop_file)
 
-        prop_line = prop_cmd.stdout.strip()
-        if prop_line.startswith('%s=' % property):
-            return prop_line.replace('%s=' % property, '', 1)
-        return ''
+        # A missing file is not an error; it simply defines nothing.
+        if cat_cmd.returncode != 0:
+            return {}
+
+        cached = self.prop_files.get(prop_file)
+        if cached is not None and cached[0] is cat_cmd:
+            return cached[1]
+
+        props = parse_props(cat_cmd.stdout.replace('\r\n', '\n'))
+        self.prop_files[prop_file] = (cat_cmd, props)
+        return props
 
     def getprop_system(self, property):
         """
@@ -140,8 +399,33 @@ class AdbSerial(ConsoleWrapper):
             raise Exception('Sending key event command %d failed: %s' %
                             (key_event, key_event_cmd.returncode))
 
+    def run_input_batch(self, batch):
+        """
+        Runs an InputBatch of taps, text, key events and activity waits in one round trip.
+
+        Returns an InputBatchResult.
+        """
+        self.read_cache.invalidate()
+        batch_cmd = self._run_script(batch.get_script(), timeout=batch.wait_seconds + 60)
+        if batch_cmd is None:
+            raise NoDeviceException('Device disconnected while running input batch.')
+
+        result = batch.parse(batch_cmd.stdout)
+        self.print_verbose('run_input_batch: %d steps completed, failed step: %s' % (
+            result.completed, result.failed_step))
+        return result
+
+    def wait_for_activity(self, activity, timeout=30):
+        """
+        Blocks until activity ('.WelcomeActivity') is in the foreground.  Returns a DeviceWaitResult.
+        """
+        return self.wait_on_device(DeviceWait.foreground_activity(activity), timeout=timeout)
+
     def get_adb_root(self):
         """Runs 'adb root'"""
+        # adbd restarts when escalating, which disconnects the shell session.
+        self.close()
+
         adbrootcmd = AdbCommand(self.serial, self.verbose, raw_command='root')
         if adbrootcmd.returncode != 0:
             raise Exception('Could not execute root. Failed: %s' % adbrootcmd.returncode)
@@ -168,15 +452,44 @@ class AdbSerial(ConsoleWrapper):
     def is_wifi_connected(self):
         """Checks if any wifi state machines are in NotConnectedStates or DisconnectedStates."""
         dumpsys_wifi_cmd = self.shell('dumpsys wifi | grep -e "curState=NotConnectedState"  -e "curState=DisconnectedState"')
-        return dumpsys_wifi_cmd.returncode != 0
+        # grep exits with 1 when neither state was found.
+        return dumpsys_wifi_cmd.returncode == 1
+
+    def watch(self, probes, interval=DeviceWatch.DEFAULT_INTERVAL):
+        """
+        Returns a started DeviceWatch streaming the probes (name -> shell command).
+
+        The caller must stop() it.
+        """
+        return DeviceWatch(serial=self.serial, probes=probes, interval=interval,
+                           verbose=self.verbose).start()
+
+    def wait_for_watch(self, probe, expected, timeout=None):
+        """
+        Blocks until the probe's value matches expected, and returns the value.
+
+        Returns None if timeout seconds pass first.
+        """
+        device_watch = self.watch({'probe' : probe})
+        try:
+            return device_watch.wait_for('probe', expected).result(timeout=timeout)
+        except Exception, e:
+            self.print_verbose('wait_for_watch: %s' % e)
+            return None
+        finally:
+            device_watch.stop()
 
     def wait_for_wifi(self):
         """Blocks for up to 30 seconds until the Wifi subsystem is connected."""
-        for i in xrange(30):
-            if self.is_wifi_connected():
-                return
-            time.sleep(1)
-        raise Exception('Timed out waiting for wifi.')
+        if self.wait_for_watch(DeviceWatch.wifi_connected(), '1', timeout=30) is None:
+            raise Exception('Timed out waiting for wifi.')
+
+    def wait_for_boot_completed(self, timeout=None):
+        """
+        Blocks until Android reports sys.boot_completed=1.  Returns False on timeout.
+        """
+        return self.wait_for_watch(DeviceWatch.prop('sys.boot_completed'), '1',
+                                   timeout=timeout) is not None
 
     def has_telephony(self):
         """Returns True if the device GCM or CDMA access, false if not, None if ambiguous."""
@@ -194,6 +507,16 @@ class AdbSerial(ConsoleWrapper):
         if mode is not None:
             reboot_cmdline = 'reboot %s' % (mode)
 
+        # The session would die with the device anyway; close it so nothing reuses it.
+        self.close()
+
+        try:
+            self.print_verbose('Rebooting (adb server): %s %s' % (self.serial, mode or ''))
+            self.client.reboot(self.serial, mode=mode)
+            return True
+        except (AdbClientException, socket.error), e:
+            self.print_verbose('adb server reboot failed (%s), falling back to adb' % e)
+
         cmd = AdbCommand(self.serial, self.verbose, raw_command=reboot_cmdline)
         if cmd.returncode != 0:
             print 'Could not reboot. Failed: %s' % cmd.returncode
@@ -202,7 +525,31 @@ class AdbSerial(ConsoleWrapper):
         return True
 
     def push(self, local_path, remote_path):
-        """Pushes local_path to remote_path on the device."""
+        """
+        Pushes local_path to remote_path on the device.
+
+        The file is read through its SharedArtifact, so devices pushing it at the same
+        time share one read from disk.  Only a failure to reach the device falls back to
+        the adb binary; a transfer the device refused returns False.
+        """
+        self.invalidate_read_cache()
+        try:
+            self.print_verbose('Pushing (adb server): %s %s' % (local_path, remote_path))
+            artifact = SharedArtifact.get(local_path)
+            chunks = artifact.chunks()
+            try:
+                self.client.push_stream(self.serial, chunks, remote_path,
+                                        mtime=int(artifact.mtime), total=artifact.size)
+            finally:
+                # Leaves the shared buffer even if the push stopped halfway.
+                chunks.close()
+            return True
+        except AdbSyncFailException, e:
+            print 'Could not push %s to %s: %s' % (local_path, remote_path, e)
+            return False
+        except (AdbClientException, socket.error), e:
+            self.print_verbose('adb server push failed (%s), falling back to adb' % e)
+
         cmdline = 'push %s %s' % (local_path, remote_path)
         cmd = AdbCommand(self.serial, self.verbose, raw_command=cmdline)
         if cmd.returncode != 0:
@@ -212,6 +559,7 @@ class AdbSerial(ConsoleWrapper):
 
     def install(self, local_path):
         """Installs the apk indicated in the local_path."""
+        self.invalidate_read_cache()
         cmdline = 'install -r %s' % (local_path)
         cmd = AdbCommand(self.serial, self.verbose, raw_command=cmdline)
         if cmd.returncode != 0:
@@ -219,6 +567,40 @@ class AdbSerial(ConsoleWrapper):
             return False
         return True
 
+    def install_batch(self, local_paths):
+        """
+        Installs several APKs in one transaction with the device and returns a list of
+        ApkInstallResult, in the order of local_paths.
+
+        Every APK is pushed over the adb server, then one shell script installs them all
+        (install sessions where supported, 'pm install -r' otherwise).
+        """
+        self.invalidate_read_cache()
+        batch = ApkBatchInstall(local_paths)
+
+        results = {}
+        pushed = []
+        for index, local_path in enumerate(batch.local_paths):
+            if self.push(local_path, batch.get_remote_path(index)):
+                pushed.append(index)
+            else:
+                results[index] = ApkInstallResult(local_path=local_path, message='Push failed')
+
+        if pushed:
+            install_cmd = self._run_script(batch.get_script(pushed), timeout=120 + 60 * len(pushed))
+            stdout = ''
+            if install_cmd is not None:
+                stdout = install_cmd.stdout
+            results.update(batch.parse(stdout, pushed))
+
+        ordered = [results[index] for index in xrange(len(batch.local_paths))]
+        for result in ordered:
+            if not result.success:
+                print 'Could not install %s: %s' % (result.local_path, result.message)
+            else:
+                self.print_verbose('Installed %s' % result.local_path)
+        return ordered
+
     def wait_for_device(self):
         """Waits for a device to start adb."""
         # Capture stderr so that we can throw away the silly stderr message
@@ -240,30 +622,121 @@ class AdbSerial(ConsoleWrapper):
         This is because adb does not respond to wait-for-device in recovery.
         This method was originally implemented in flash-device-latest and thoroughly tested.
         """
-        # Step 1: Execute dmesg, and look for "Linux"
+        # Step 1: Wait until dmesg contains "Linux"
         # - If device is missing, adb shell returns "device not found"
         # - If dmesg is not ready, dmesg returns "klogctl: Operation not permitted"
-        while True:
-            dmesg = self.shell('dmesg')
-
-            if 'Linux' in dmesg.stdout:
-                break
-
-            self.print_when_not_verbose('.')
-            time.sleep(1)
+        self.wait_on_device(DeviceWait.output_contains('dmesg', 'Linux'))
 
         # Step 2 (Clockwork-specific): Make sure /cache/recovery/log is visible.
         # - Reject message "/cache/recovery/log: No such file or directory"
         self.wait_for_path_or_mount(path='/cache/recovery/log')
 
-    def is_mount_point_mounted(self, mount=None):
+    def wait_on_device(self, condition, timeout=None, hold=0, deadline=None):
+        """
+        Blocks until condition (see DeviceWait) holds on the device, and returns a
+        DeviceWaitResult.
+
+        The wait runs as a loop inside a single adb shell, and returns as soon as the
+        condition has held for hold seconds.  While the device is unreachable (rebooting),
+        the host waits for adb to report it again before retrying.
+
+        timeout (seconds) or deadline (a retry.Deadline shared with other commands) bound
+        the whole wait, reconnects included.
+        """
+        return self._wait_with_script(
+            lambda remaining: DeviceWait.condition_script(condition, timeout=remaining, hold=hold),
+            timeout=timeout, deadline=deadline)
+
+    def wait_for_stable_output(self, command, seconds, timeout=None, deadline=None):
+        """
+        Blocks until command prints the same non-empty output for the indicated number of
+        seconds (for example, 'sha1sum FILE' of a file still being written).
+
+        Returns a DeviceWaitResult whose value is the stable output.
+        """
+        return self._wait_with_script(
+            lambda remaining: DeviceWait.stable_output_script(command, seconds, timeout=remaining),
+            timeout=timeout, deadline=deadline)
+
+    def wait_for_prop(self, prop, value, timeout=None, deadline=None):
+        """Blocks until getprop prop returns value.  Returns a DeviceWaitResult."""
+        return self.wait_on_device(DeviceWait.prop_equals(prop, value), timeout=timeout,
+                                   deadline=deadline)
+
+    # Upper bound for one wait script when the caller has no timeout.  The script is
+    # simply restarted if it runs out.
+    MAX_WAIT_SCRIPT_SECONDS = 3600
+
+    def _wait_with_script(self, build_script, timeout=None, deadline=None):
+        started = time.time()
+        deadline = Deadline.coerce(deadline=deadline, timeout=timeout)
+        while True:
+            remaining = deadline.bound(self.MAX_WAIT_SCRIPT_SECONDS)
+            if remaining <= 0:
+                return DeviceWaitResult(satisfied=False, elapsed=time.time() - started)
+
+            # The script times itself out; the host allows some slack for adb before
+            # giving up on it, but never beyond the caller's deadline.
+            script_timeout = remaining + 30
+            if deadline.remaining() is not None:
+                script_timeout = remaining + 5
+            wait_cmd = self._run_script(build_script(remaining), timeout=script_timeout)
+            parsed = None
+            if wait_cmd is not None:
+                parsed = DeviceWait.parse(wait_cmd.stdout)
+            if parsed is not None:
+                satisfied, value = parsed
+                if satisfied or deadline.remaining() is not None:
+                    elapsed = time.time() - started
+                    self.print_verbose('wait_on_device: satisfied=%s after %.1fs' % (satisfied, elapsed))
+                    return DeviceWaitResult(satisfied=satisfied, elapsed=elapsed, value=value)
+                continue
+
+            # The device is not reachable.  Wait for adb to report it before trying again.
+            self.print_when_not_verbose('.')
+            self._wait_for_transport(timeout=deadline.bound(1))
+
+    def _run_script(self, script, timeout=None):
+        """
+        Runs a multi-line shell script without host-side quoting, returning None on
+        transport failure.
+        """
+        if self.shell_session is not None:
+            script_cmd = self._session_shell(script, attempts=1, timeout=timeout)
+            if script_cmd.returncode == AdbShellSession.TRANSPORT_FAILURE:
+                return None
+            return script_cmd
+
+        try:
+            return self.client.shell(self.serial, script)
+        except (AdbClientException, socket.error), e:
+            self.print_verbose('wait script failed: %s' % e)
+            return None
+
+    def _wait_for_transport(self, timeout=1):
+        """
+        Sleeps until adb reports this serial in a shell-capable state, or timeout passes.
+        """
+        tracker = DeviceTracker.get_instance()
+        if tracker is None:
+            time.sleep(timeout)
+            return
+
+        deadline = time.time() + timeout
+        while tracker.get_state(self.serial) not in ['device', 'recovery']:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            tracker.wait_for_change(tracker.version, remaining)
+
+    def is_mount_point_mounted(self, mount=None, use_cache=True):
         """
         Returns true if the indicated mountpoint is mounted.
 
         Note: This method only accepts the following mount(1) format:
         -  /dev/block/mmcblk0p25 on /system type ext4 (rw,seclabel,relatime,data=ordered)
         """
-        mount_point = self.shell('mount', use_exception=True)
+        mount_point = self.shell('mount', use_exception=True, use_cache=use_cache)
 
         mount_grep = 'on %s type ' % mount
         if mount_grep in mount_point.stdout:
@@ -274,53 +747,87 @@ class AdbSerial(ConsoleWrapper):
         self.print_verbose('is_mount_point_mounted %s : %s' % (mount, mounted))
         return mounted
 
-    def path_exists(self, path=None):
+    def get_snapshot(self, paths=None, prop_files=None, mount_system=False, use_cache=True):
+        """
+        Returns a DeviceSnapshot collected in a single shell round trip.
+
+        paths and prop_files default to the questions FlashHelper asks during a flash.
+        If mount_system is True, /system is mounted first (needed in recovery).
+        Pass use_cache=False if the mount table may have changed on its own.
+        """
+        snapshot = DeviceSnapshot(paths=paths, prop_files=prop_files, mount_system=mount_system)
+        snapshot_cmd = self.shell(snapshot.get_script(), use_exception=True, use_cache=use_cache)
+        snapshot.parse(snapshot_cmd.stdout)
+        self.print_verbose('get_snapshot: mounts=%s paths=%s props=%s twrp=%s' % (
+            sorted(snapshot.mount_points), snapshot.existing_paths, snapshot.props, snapshot.twrp_path))
+        return snapshot
+
+    def path_exists(self, path=None, use_cache=True):
         """
         Returns true if a path exists.  Otherwise, returns false.
         """
-        ls_path = self.shell('ls %s' % path, use_exception=True)
+        ls_path = self.shell('ls %s' % path, use_cache=use_cache)
         if 'No such file or directory' in ls_path.stdout:
             return False
+
+        # Through the session, ls may fail for other reasons (permissions) on an existing
+        # path; only a command that never ran is an error.  Without the session, adb
+        # only reports a non-zero return code when the command never ran.
+        if ls_path.returncode == AdbShellSession.TRANSPORT_FAILURE or \
+           (self.shell_session is None and ls_path.returncode != 0):
+            raise EXCEPTIONS_BY_ERROR[ls_path.error or ERROR_FAILED]('ls %s' % path)
         return True
 
-    def wait_for_path_or_mount(self, path=None, mount=None, debounce=1):
+    def get_partition_digest(self, partition, length):
+        """
+        Returns the MD5 of the first length bytes of a partition (for example 'recovery'),
+        or None if they cannot be read.
+
+        Partitions are only readable as root: adbd running as root, or su (SuperSU is
+        installed with every full flash).  md5sum comes from toybox or busybox.
+        """
+        script = ('for p in /dev/block/platform/*/by-name/%(partition)s '
+                  '/dev/block/bootdevice/by-name/%(partition)s; do '
+                  '[ -e $p ] && dd if=$p bs=%(length)d count=1 2> /dev/null | md5sum && break; '
+                  'done' % {'partition' : partition, 'length' : length})
+        digest_cmd = self.shell('if id | grep -q uid=0\\(; then %s; else su -c \'%s\'; fi' % (
+            script, script))
+
+        fields = digest_cmd.stdout.split()
+        if not fields or not re.match('^[0-9a-f]{32}$', fields[0]):
+            self.print_verbose('get_partition_digest %s: unreadable' % partition)
+            return None
+        digest = fields[0]
+        if digest == hashlib.md5('').hexdigest():
+            # dd was refused, and md5sum hashed nothing.
+            return None
+        return digest
+
+    def wait_for_path_or_mount(self, path=None, mount=None, debounce=1, timeout=None, deadline=None):
         """
         Blocks until a path or a mount exists on the device.
 
         If debounce is set to a positive integer N, then the path or mount must
-        return the same result N times before this function returns.
+        stay present for N-1 seconds before this function returns (the historical
+        one check per second, N times in a row).
+
+        timeout or deadline bound the whole wait, e.g. deadline=Deadline(90) for
+        "up to 90 seconds total" across this and the caller's following commands.
+
+        Returns a DeviceWaitResult.
         """
         if path is None and mount is None:
             self.print_verbose('WARNING: wait_for_path_or_mount was called with no arguments')
-            return
+            return DeviceWaitResult(satisfied=True)
 
-        true_count = 0
+        conditions = []
+        if path is not None:
+            conditions.append(DeviceWait.path_exists(path))
+        if mount is not None:
+            conditions.append(DeviceWait.mount_present(mount))
 
-        while True:
-            if path is not None:
-                # Make sure the requested path is visible.
-                # - Reject message "${path}: No such file or directory"
-                try:
-                    if self.path_exists(path=path):
-                        true_count += 1
-                        if true_count >= debounce:
-                            return
-                except AdbCommandException:
-                    # We should wait if shell did not execute.
-                    pass
-
-            if mount is not None:
-                try:
-                    if self.is_mount_point_mounted(mount=mount):
-                        true_count += 1
-                        if true_count >= debounce:
-                            return
-                except AdbCommandException:
-                    # We should wait if shell did not execute.
-                    pass
-
-            self.print_when_not_verbose('.')
-            time.sleep(1)
+        return self.wait_on_device(DeviceWait.any_of(conditions), timeout=timeout,
+                                   hold=max(debounce - 1, 0), deadline=deadline)
 
     # The 'dumpsys' command on the device can tell us which activity is front most.
     # Parse its output. It looks something like this...
@@ -334,22 +841,24 @@ class AdbSerial(ConsoleWrapper):
     #
     # For this case, we want to return ".SimMissingActivity". Returns None on failure.
     # Raises NoDeviceException if no adb device is available.
-    def getForegroundActivity(serial = None):
+    def getForegroundActivity(self):
         """
         Gets the name of the Android app Activity that is in the foreground.
         """
-        if serial is not None:
-            cmd = "adb -s {} shell dumpsys activity".format(serial)
-        else:
-            cmd = "adb shell dumpsys activity"
-        dumpsys = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-        output, errout = dumpsys.communicate()
+        dumpsys = self.shell('dumpsys activity activities', use_cache=False)
         if dumpsys.returncode != 0:
-            if 'error: device not found' in errout:
+            if dumpsys.error == ERROR_NO_DEVICE:
                 raise NoDeviceException()
-            print("Dumpsys command failed: {}".format(dumpsys.returncode))
+            print 'Dumpsys command failed: %s' % dumpsys.returncode
             return None
 
+        return self.parse_foreground_activity(dumpsys.stdout)
+
+    @classmethod
+    def parse_foreground_activity(cls, output):
+        """
+        Returns the foreground activity named in 'dumpsys activity' output, or None.
+        """
         # 'dumpsys activity' includes the current focused activity.  Search for the name.
         apos = output.find("mFocusedActivity: ActivityRecord")
         if apos == -1:
@@ -361,5 +870,7 @@ class AdbSerial(ConsoleWrapper):
         # In 4.4, it looks like this:
         #   mFocusedActivity: ActivityRecord{41a40b60 u0 com.google.android.setupwizard/.WelcomeActivity t3}
         line = output[apos:].split("\n")[0]
-        fullName = re.search("{[0-9a-f]{8} .. ([^ ]*)[ }]", line).group(1)
-        return fullName.split("/")[1]
+        match = re.search("{[0-9a-f]{8} .. ([^ ]*)[ }]", line)
+        if match is None:
+            return None
+        return match.group(1).split("/")[1]
@@ -0,0 +1,303 @@
+import os
+import re
+import socket
+import stat
+import struct
+import time
+
+from .shell_session import AdbShellResult
+
+class AdbClientException(Exception):
+    """
+    Used to indicate that the adb server refused a request (FAIL) or broke the protocol.
+    """
+    pass
+
+class AdbSyncFailException(AdbClientException):
+    """
+    Used to indicate that the device refused a file transfer (no space left, read-only
+    filesystem, remote path is a directory).  Retrying another way fails the same way.
+    """
+    pass
+
+class AdbClient(object):
+    """
+    In-process client for the adb host protocol spoken by the local adb server.
+
+    No adb process is started: requests go straight to the server socket (localhost:5037
+    by default), which also makes the client easy to point at a fake server.
+
+    Protocol summary:
+    - a request is its length in 4 hex digits followed by the payload;
+    - the server answers OKAY, or FAIL followed by a hex-length-prefixed message;
+    - after host:transport:<serial> the same socket talks to that device (shell:, sync:,
+      reboot:);
+    - sync: frames are a 4-byte id followed by a little-endian 32-bit length or value.
+
+    All payloads are returned as byte strings.
+    """
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_PORT = 5037
+
+    # Largest payload of a single sync DATA frame.
+    SYNC_DATA_MAX = 64 * 1024
+
+    EXIT_MARKER = '__LMA_EXIT__'
+
+    def __init__(self, host=None, port=None, timeout=300):
+        if host is None:
+            host = os.environ.get('ADB_SERVER_HOST', self.DEFAULT_HOST)
+        if port is None:
+            port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', self.DEFAULT_PORT))
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    # Low-level framing
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.settimeout(self.timeout)
+        return sock
+
+    @classmethod
+    def _recv_exactly(cls, sock, length):
+        chunks = []
+        while length > 0:
+            chunk = sock.recv(min(length, 65536))
+            if not chunk:
+                raise AdbClientException('Connection closed by adb server.')
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    @classmethod
+    def _recv_all(cls, sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    @classmethod
+    def _send_request(cls, sock, request):
+        sock.sendall('%04x%s' % (len(request), request))
+
+    @classmethod
+    def _read_status(cls, sock, request=None):
+        status = cls._recv_exactly(sock, 4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            length = int(cls._recv_exactly(sock, 4), 16)
+            raise AdbClientException(cls._recv_exactly(sock, length))
+        raise AdbClientException('Unexpected adb server status %r for request %r' % (status, request))
+
+    @classmethod
+    def _read_hex_payload(cls, sock):
+        length = int(cls._recv_exactly(sock, 4), 16)
+        return cls._recv_exactly(sock, length)
+
+    def _host_request(self, request):
+        """Sends a host: request and returns its length-prefixed reply."""
+        sock = self._connect()
+        try:
+            self._send_request(sock, request)
+            self._read_status(sock, request)
+            return self._read_hex_payload(sock)
+        finally:
+            sock.close()
+
+    def _transport(self, serial):
+        """Returns a socket that has been switched to the device with the indicated serial."""
+        sock = self._connect()
+        try:
+            request = 'host:transport:%s' % serial
+            self._send_request(sock, request)
+            self._read_status(sock, request)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _device_request(self, serial, request):
+        """Switches to the device and issues request.  Returns the open socket."""
+        sock = self._transport(serial)
+        try:
+            self._send_request(sock, request)
+            self._read_status(sock, request)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    # Host services
+
+    def devices_l(self):
+        """
+        Returns the raw 'host:devices-l' listing, which matches the body of 'adb devices -l'.
+        """
+        return self._host_request('host:devices-l')
+
+    def devices(self):
+        """
+        Returns a dict of serial => state ('device', 'recovery', 'unauthorized', ...).
+        """
+        device_states = {}
+        for line in self.devices_l().splitlines():
+            components = line.split()
+            if len(components) >= 2:
+                device_states[components[0]] = components[1]
+        return device_states
+
+    def track_devices(self):
+        """
+        Yields a dict of serial => state every time the set of devices or their states change.
+
+        The first dict describes the devices present when tracking starts.  The generator
+        ends (or raises socket.error) when the adb server goes away.
+        """
+        sock = self._connect()
+        try:
+            request = 'host:track-devices'
+            self._send_request(sock, request)
+            self._read_status(sock, request)
+
+            # Updates may be far apart; only the connection itself has a timeout.
+            sock.settimeout(None)
+            while True:
+                try:
+                    listing = self._read_hex_payload(sock)
+                except AdbClientException:
+                    return
+
+                device_states = {}
+                for line in listing.splitlines():
+                    components = line.split()
+                    if len(components) >= 2:
+                        device_states[components[0]] = components[1]
+                yield device_states
+        finally:
+            sock.close()
+
+    # Device services
+
+    def shell(self, serial, command):
+        """
+        Runs command on the device and returns an AdbShellResult.
+
+        The legacy shell: service does not report exit codes, so the command is followed by
+        an echo of $? which is stripped from stdout.
+        """
+        sock = self._device_request(
+            serial, 'shell:%s; echo "%s $?"' % (command, self.EXIT_MARKER))
+        try:
+            output = self._recv_all(sock)
+        finally:
+            sock.close()
+
+        # Older adbd runs shell: on a pty, which turns \n into \r\n.
+        exit_match = re.search(r'(?:\r?\n)?%s (\d+)\r?\n?$' % self.EXIT_MARKER, output)
+        if exit_match is None:
+            raise AdbClientException('Shell output is missing its exit code: %r' % output[-80:])
+
+        stdout = output[:exit_match.start()]
+        if stdout:
+            stdout += '\n'
+        return AdbShellResult(stdout=stdout, returncode=int(exit_match.group(1)))
+
+    def reboot(self, serial, mode=None):
+        """Reboots the device.  mode may be None, 'recovery' or 'bootloader'."""
+        sock = self._device_request(serial, 'reboot:%s' % (mode or ''))
+        try:
+            # adbd closes the connection as it goes down; drain whatever is left.
+            try:
+                self._recv_all(sock)
+            except socket.error:
+                pass
+        finally:
+            sock.close()
+
+    def push(self, serial, local_path, remote_path, mode=0644, progress_callback=None):
+        """
+        Pushes local_path to remote_path using the sync: service.
+
+        progress_callback, if set, is called with (bytes_sent, total_bytes).
+        """
+        with open(local_path, 'rb') as file_h:
+            total = os.fstat(file_h.fileno()).st_size
+            mtime = int(os.path.getmtime(local_path))
+            self.push_stream(serial, iter(lambda: file_h.read(self.SYNC_DATA_MAX), ''),
+                             remote_path, mode=mode, mtime=mtime, total=total,
+                             progress_callback=progress_callback)
+
+    def push_stream(self, serial, chunks, remote_path, mode=0644, mtime=None,
+                    total=None, progress_callback=None):
+        """
+        Pushes an iterable of byte strings to remote_path using the sync: service.
+        """
+        if mtime is None:
+            mtime = int(time.time())
+
+        sock = self._device_request(serial, 'sync:')
+        try:
+            spec = '%s,%d' % (remote_path, stat.S_IFREG | mode)
+            sock.sendall('SEND' + struct.pack('<I', len(spec)) + spec)
+
+            sent = 0
+            for chunk in chunks:
+                # Split oversized chunks to respect the sync frame limit.
+                for offset in xrange(0, len(chunk), self.SYNC_DATA_MAX):
+                    piece = chunk[offset:offset + self.SYNC_DATA_MAX]
+                    sock.sendall('DATA' + struct.pack('<I', len(piece)) + piece)
+                    sent += len(piece)
+                if progress_callback is not None:
+                    progress_callback(sent, total)
+
+            sock.sendall('DONE' + struct.pack('<I', mtime))
+
+            status = self._recv_exactly(sock, 4)
+            length = struct.unpack('<I', self._recv_exactly(sock, 4))[0]
+            if status == 'FAIL':
+                raise AdbSyncFailException(self._recv_exactly(sock, length))
+            if status != 'OKAY':
+                raise AdbClientException('Unexpected sync status %r' % status)
+
+            sock.sendall('QUIT' + struct.pack('<I', 0))
+        finally:
+            sock.close()
+
+    def pull(self, serial, remote_path):
+        """
+        Returns the contents of remote_path using the sync: service.
+        """
+        sock = self._device_request(serial, 'sync:')
+        try:
+            sock.sendall('RECV' + struct.pack('<I', len(remote_path)) + remote_path)
+
+            chunks = []
+            while True:
+                frame_id = self._recv_exactly(sock, 4)
+                length = struct.unpack('<I', self._recv_exactly(sock, 4))[0]
+                if frame_id == 'DATA':
+                    chunks.append(self._recv_exactly(sock, length))
+                elif frame_id == 'DONE':
+                    break
+                elif frame_id == 'FAIL':
+                    raise AdbClientException(self._recv_exactly(sock, length))
+                else:
+                    raise AdbClientException('Unexpected sync frame %r' % frame_id)
+
+            sock.sendall('QUIT' + struct.pack('<I', 0))
+            return ''.join(chunks)
+        finally:
+            sock.close()
+
+if __name__ == '__main__':
+    client = AdbClient()
+    print client.devices_l()
+    for serial, state in client.devices().items():
+        print '%s\t%s' % (serial, state)
+        if state in ['device', 'recovery']:
+            print client.shell(serial, 'getprop ro.product.device').stdout
@@ -0,0 +1,46 @@
+# Structured errors for adb commands
+
+import re
+
+class AdbCommandException(Exception):
+    """
+    Used to indicate a non-zero return-code.
+
+    Since this exception is a checked exception, AdbCommand() commands and
+    their callers need to be updated to properly catch this.
+
+    Subclasses say why the command did not succeed.
+    """
+    pass
+
+class AdbTimeoutException(AdbCommandException):
+    """The command did not finish within its timeout or deadline."""
+    pass
+
+class NoDeviceException(AdbCommandException):
+    """adb could not find the device (unplugged, rebooting, or not authorized yet)."""
+    pass
+
+# Values of the 'error' attribute of AdbCommand and AdbShellResult.
+# None means adb ran the command; check returncode for the command's own result.
+ERROR_TIMEDOUT = 'timedout'
+ERROR_NO_DEVICE = 'no_device'
+ERROR_FAILED = 'failed'
+
+EXCEPTIONS_BY_ERROR = {
+    ERROR_TIMEDOUT : AdbTimeoutException,
+    ERROR_NO_DEVICE : NoDeviceException,
+    ERROR_FAILED : AdbCommandException,
+    }
+
+# "error: device not found", "error: device 'SERIAL' not found",
+# "error: no devices/emulators found", "error: device offline"
+NO_DEVICE_PATTERN = re.compile(r"device( '[^']*')? not found|no devices|device offline")
+
+def classify_adb_output(output):
+    """
+    Returns ERROR_NO_DEVICE if adb's output says the device is missing, ERROR_FAILED otherwise.
+    """
+    if output and NO_DEVICE_PATTERN.search(output):
+        return ERROR_NO_DEVICE
+    return ERROR_FAILED
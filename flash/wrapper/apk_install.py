@@ -0,0 +1,96 @@
+import os
+
+class ApkInstallResult(object):
+    """
+    Outcome of installing one APK with AdbSerial.install_batch().
+
+    - local_path: the APK on the host.
+    - success: True if the package manager reported Success.
+    - message: the package manager's last line ("Success", "Failure [INSTALL_FAILED_...]"),
+      or why the APK never reached the package manager.
+    """
+    def __init__(self, local_path=None, success=False, message=None):
+        self.local_path = local_path
+        self.success = success
+        self.message = message
+
+class ApkBatchInstall(object):
+    """
+    Installs several APKs, already pushed to the device, from a single shell script.
+
+    On Android 5.0 (SDK 21) and newer each package goes through an install session
+    (pm install-create / install-write / install-commit), which reads the APK in place.
+    Older devices fall back to 'pm install -r' per APK.  Either way there is one shell
+    round trip for the whole batch, and the script reports each package on its own:
+
+        __LMA_INSTALL__ 0
+        Success
+        __LMA_INSTALL__ 1
+        Failure [INSTALL_FAILED_OLDER_SDK]
+    """
+    RESULT_MARKER = '__LMA_INSTALL__'
+    REMOTE_DIR = '/data/local/tmp'
+
+    # First SDK with 'pm install-create'.
+    SESSION_MIN_SDK = 21
+
+    def __init__(self, local_paths):
+        self.local_paths = list(local_paths)
+
+    def get_remote_path(self, index):
+        return '%s/lma_install_%d.apk' % (self.REMOTE_DIR, index)
+
+    def get_script(self, indexes):
+        """
+        Returns the script installing the APKs at indexes (those that were pushed).
+        """
+        lines = ['sdk=$(getprop ro.build.version.sdk)']
+        for index in indexes:
+            remote_path = self.get_remote_path(index)
+            size = os.path.getsize(self.local_paths[index])
+            lines.append(
+                'echo "%(marker)s %(index)d"; '
+                'if [ "${sdk:-0}" -ge %(min_sdk)d ]; then '
+                    'out=$(pm install-create -r -S %(size)d); id=${out#*[}; id=${id%%]*}; '
+                    'pm install-write -S %(size)d $id base.apk %(path)s > /dev/null && pm install-commit $id; '
+                'else pm install -r %(path)s; fi; '
+                'rm %(path)s' % {
+                    'marker' : self.RESULT_MARKER,
+                    'index' : index,
+                    'min_sdk' : self.SESSION_MIN_SDK,
+                    'size' : size,
+                    'path' : remote_path,
+                    })
+        return '\n'.join(lines)
+
+    def parse(self, stdout, indexes):
+        """
+        Returns {index: ApkInstallResult} for indexes from the script's output.
+        """
+        outputs = {}
+        index = None
+        for line in stdout.splitlines():
+            line = line.strip()
+            if line.startswith(self.RESULT_MARKER + ' '):
+                index = int(line.split()[1])
+                outputs[index] = []
+            elif index is not None and line:
+                outputs[index].append(line)
+
+        results = {}
+        for index in indexes:
+            local_path = self.local_paths[index]
+            lines = outputs.get(index)
+            if not lines:
+                message = 'No result from the package manager'
+                if index in outputs:
+                    message = 'Empty result from the package manager'
+                results[index] = ApkInstallResult(local_path=local_path, message=message)
+                continue
+
+            # pm prints "pkg: PATH" first on older releases; the verdict is last.
+            message = lines[-1]
+            results[index] = ApkInstallResult(local_path=local_path,
+                                              success=message == 'Success',
+                                              message=message)
+        return results
@@ -0,0 +1,104 @@
+import os
+import threading
+
+from .json_store import JsonStore
+
+class TransitionSchedule(object):
+    """
+    When to look for a device after a reboot, in seconds from the reboot command.
+
+    - quiet: nothing is expected before this, so there is no point looking hard.
+    - expected: the median observed transition.
+    - timeout: how long to wait before giving up.
+    """
+    def __init__(self, quiet=0, expected=None, timeout=None):
+        self.quiet = quiet
+        self.expected = expected
+        self.timeout = timeout
+
+class BootTimings(object):
+    """
+    Observed durations of mode transitions, per device codename, kept across runs.
+
+    Every reboot waited on by Device is recorded under its codename and mode pair
+    (for example bacon, fastboot -> recovery) in blobs/boot_timings.json.  Waits are then
+    scheduled from those numbers: quiet until shortly before the fastest observed
+    transition, polled quickly from there, and abandoned at a multiple of the slow end.
+    Until a pair has MIN_SAMPLES, the caller's own timeout applies as before.
+
+    One instance is shared by the whole process; use BootTimings.get_instance().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # Samples kept per codename and mode pair; older ones are dropped.
+    MAX_SAMPLES = 20
+    MIN_SAMPLES = 3
+
+    # Start polling quickly at this fraction of the fastest observed transition.
+    QUIET_FRACTION = 0.8
+    # Give up at this multiple of the 95th percentile.
+    TIMEOUT_FACTOR = 2
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'blobs', 'boot_timings.json'))
+        self.path = path
+        self.store = JsonStore(path)
+        self.lock = threading.Lock()
+        self.timings = self.store.load()
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def get_key(cls, from_mode, to_mode):
+        return '%s->%s' % (from_mode, to_mode)
+
+    def record(self, codename, from_mode, to_mode, seconds):
+        """Adds one observed transition, merged into the file under a lock."""
+        if not codename:
+            return
+        key = self.get_key(from_mode, to_mode)
+
+        def add_sample(timings):
+            samples = timings.setdefault(codename, {}).setdefault(key, [])
+            samples.append(round(seconds, 2))
+            del samples[:-self.MAX_SAMPLES]
+
+        with self.lock:
+            self.timings = self.store.update(self.timings, add_sample)
+
+    def get_samples(self, codename, from_mode, to_mode):
+        with self.lock:
+            return list(self.timings.get(codename, {}).get(self.get_key(from_mode, to_mode), []))
+
+    @classmethod
+    def percentile(cls, samples, fraction):
+        """Nearest-rank percentile of samples; fraction is between 0 and 1."""
+        ordered = sorted(samples)
+        index = int(round(fraction * (len(ordered) - 1)))
+        return ordered[index]
+
+    def get_schedule(self, codename, from_mode, to_mode, timeout=None):
+        """
+        Returns the TransitionSchedule for a transition.
+
+        timeout is the caller's own limit (None waits forever).  Learned timeouts only
+        ever extend it: a slow model (bacon booting a fresh TWRP takes over 15 seconds)
+        gets the time it needs, but no caller gives up earlier than it used to.
+        """
+        samples = self.get_samples(codename, from_mode, to_mode)
+        if len(samples) < self.MIN_SAMPLES:
+            return TransitionSchedule(timeout=timeout)
+
+        learned_timeout = self.TIMEOUT_FACTOR * self.percentile(samples, 0.95)
+        if timeout is not None:
+            timeout = max(timeout, learned_timeout)
+        return TransitionSchedule(quiet=self.QUIET_FRACTION * min(samples),
+                                  expected=self.percentile(samples, 0.5),
+                                  timeout=timeout)
@@ -1,20 +1,45 @@
 import os
 import re
+import socket
 import subprocess
 import time
 
 from .adb import AdbSerial
+from .adb_client import AdbClient, AdbClientException
+from .boot_timings import BootTimings
 from .console_wrapper import ConsoleWrapper
+from .device_monitor import DeviceMonitor
 from .fastboot import Fastboot
 
 from lib.download_client import DownloadClient
 from lib.recovery import Recovery
 
 class Device(ConsoleWrapper):
-    def __init__(self, serial, verbose=False):
+    # While a bootloader restarts itself, poll fastboot this often to see it go and return.
+    FASTBOOT_REBOOT_POLL_INTERVAL = 0.2
+    FASTBOOT_DISAPPEAR_TIMEOUT = 10
+
+    # Upper bound on waiting for the first boot of a freshly flashed ROM.
+    BOOT_COMPLETED_TIMEOUT = 300
+
+    # Transitions slower than this were not a plain reboot (user intervention, a
+    # forgotten device) and are not learned from.
+    MAX_LEARNED_TRANSITION = 600
+
+    def __init__(self, serial, verbose=False, codename=None):
+        """
+        codename (hammerhead, bacon) selects the learned boot timings; without it, waits
+        use their fixed timeouts.
+        """
         ConsoleWrapper.__init__(self, verbose=verbose)
         self.serial = serial
         self.serial_pattern = re.compile("%s\s+" % serial)
+        self.adb_client = AdbClient()
+
+        self.codename = codename
+        self.boot_timings = BootTimings.get_instance()
+        # (from_mode, to_mode, started) of the reboot in flight, see begin_transition().
+        self.transition = None
 
     def _parse_get_mode(self, cmdline):
         cmd = subprocess.Popen(
@@ -34,6 +59,11 @@ class Device(ConsoleWrapper):
         return None
 
     def _get_adb_mode(self):
+        # Ask the adb server directly; fall back to the binary, which also starts the server.
+        try:
+            return self.adb_client.devices().get(self.serial)
+        except (AdbClientException, socket.error), e:
+            self.print_verbose('adb server query failed: %s' % e)
         return self._parse_get_mode("adb devices -l")
 
     def _get_fastboot_mode(self):
@@ -44,28 +74,123 @@ class Device(ConsoleWrapper):
         Retrieve device mode. Wait no more than 10 seconds for devices to register.
 
         Note: bacon devices take at least 15 seconds to start when TWRP is first installed.
-        Callers should manage this.
+        During a reboot started with begin_transition(), the wait is extended to what
+        the model has been seen to need (see BootTimings).
         """
         self.print_verbose_nonewline('Reading device mode .')
-        for i in xrange(get_mode_timeout):
-            mode = self._get_adb_mode()
-            if mode is not None or mode == '':
-                print('. %s' % mode)
-                return mode
+        mode = self.wait_for_mode(timeout=get_mode_timeout)
+        print('. %s' % mode)
+        return mode
 
-            mode = self._get_fastboot_mode()
-            if mode is not None or mode == '':
-                print('. %s' % mode)
-                return mode
+    def wait_for_mode(self, modes=None, timeout=None):
+        """
+        Blocks until the device is in one of modes (any mode if None), and returns the mode.
 
-            self.print_verbose_nonewline('.')
-            time.sleep(1)
+        Modes are read from the process-wide DeviceMonitor, which follows adb events and
+        enumerates fastboot once per interval for all devices together.  Waking up on a
+        change costs no extra enumeration.
 
-        # Use hard-coded timeout
-        mode = "timedout"
-        print('. %s' % mode)
+        Returns 'timedout' if timeout seconds pass first.  Waits forever if timeout is None.
+        While a reboot to one of modes is in flight, timeout is extended from the learned
+        timings, and the time the reboot took is recorded.
+        """
+        transition = self.transition
+        if transition is None or (modes is not None and transition[1] not in modes):
+            return DeviceMonitor.get_instance().wait_for_mode(self.serial, modes=modes, timeout=timeout)
+
+        from_mode, to_mode, started = transition
+        if timeout is not None:
+            # The learned timeout counts from the reboot; the caller's counts from now.
+            elapsed = time.time() - started
+            schedule = self.boot_timings.get_schedule(self.codename, from_mode, to_mode,
+                                                      timeout=elapsed + timeout)
+            timeout = schedule.timeout - elapsed
+
+        monitor = DeviceMonitor.get_instance()
+        mode = monitor.wait_for_mode(self.serial, modes=modes, timeout=timeout)
+        # A mode entered before the reboot was issued is the old state, not the new one.
+        since = monitor.get(self.serial)[1]
+        if mode == to_mode and since is not None and since >= started:
+            self._end_transition(transition, since)
         return mode
 
+    def _end_transition(self, transition, arrived):
+        """
+        Records the time from the reboot command of transition to arrived, once.
+        """
+        if self.transition is not transition:
+            return
+        self.transition = None
+        from_mode, to_mode, started = transition
+        seconds = arrived - started
+        if seconds <= self.MAX_LEARNED_TRANSITION:
+            self.print_verbose('%s: %s -> %s took %.1fs' % (self.serial, from_mode, to_mode, seconds))
+            self.boot_timings.record(self.codename, from_mode, to_mode, seconds)
+
+    def begin_transition(self, from_mode, to_mode):
+        """
+        Notes that a reboot from from_mode to to_mode is being started now.
+
+        The next wait for to_mode is timed and learned from.  Once the model's timings
+        are known, the DeviceMonitor enumerates quickly from shortly before the device is
+        due, rather than noticing it up to a full poll interval late.
+        """
+        started = time.time()
+        self.transition = (from_mode, to_mode, started)
+
+        schedule = self.boot_timings.get_schedule(self.codename, from_mode, to_mode, timeout=0)
+        if schedule.expected is not None:
+            DeviceMonitor.get_instance().expect(self.serial, to_mode,
+                                                fast_from=started + schedule.quiet,
+                                                until=started + schedule.timeout)
+
+    def get_mode_since(self):
+        """
+        Returns (mode, since): the current mode, and the time.time() it was entered.
+        """
+        return DeviceMonitor.get_instance().get(self.serial)
+
+    def wait_for_fastboot_reboot(self, timeout=60):
+        """
+        Blocks until a bootloader that was told to reboot-bootloader is back in fastboot.
+
+        The device first has to drop off USB; otherwise the old bootloader instance could
+        still be seen.  Both transitions are checked at FASTBOOT_REBOOT_POLL_INTERVAL
+        rather than once per second, and once the model's restart time is known, not at
+        all until shortly before it is due.  Returns the mode, or 'timedout'.
+
+        Call begin_transition('fastboot', 'fastboot') before the reboot command: the
+        restart is then timed from the command, like every other learned transition.
+        """
+        transition = self.transition
+        if transition is not None and transition[:2] == ('fastboot', 'fastboot'):
+            started = transition[2]
+        else:
+            transition = None
+            started = time.time()
+        schedule = self.boot_timings.get_schedule(self.codename, 'fastboot', 'fastboot',
+                                                  timeout=timeout)
+        deadline = started + schedule.timeout
+        disappear_deadline = started + min(schedule.timeout, self.FASTBOOT_DISAPPEAR_TIMEOUT)
+        while self._get_fastboot_mode() is not None:
+            if time.time() >= disappear_deadline:
+                # It never seemed to leave; it may have come back between two looks.
+                return 'fastboot'
+            time.sleep(self.FASTBOOT_REBOOT_POLL_INTERVAL)
+
+        quiet_until = started + schedule.quiet
+        if quiet_until > time.time():
+            time.sleep(quiet_until - time.time())
+
+        while time.time() < deadline:
+            mode = self._get_fastboot_mode()
+            if mode is not None:
+                if transition is not None:
+                    self._end_transition(transition, time.time())
+                return mode
+            time.sleep(self.FASTBOOT_REBOOT_POLL_INTERVAL)
+        return 'timedout'
+
     def reboot_to_recovery(self, forced=False):
         """Reboots device into recovery mode.
 
@@ -94,15 +219,19 @@ class Device(ConsoleWrapper):
             model = fastboot.getvar_product()
             recovery_path = Recovery().get_recovery(device=model)
 
+            self.begin_transition(current_mode, "recovery")
             if fastboot.boot(recovery_path) is False:
                 print "reboot_to_recovery: Cannot reboot into recovery"
                 return False
+            # Fastboot.boot() also flashes the image to the recovery partition.
+            Recovery.record_flashed(self.serial, recovery_path)
         elif current_mode == "recovery" and not forced:
             self.print_verbose("reboot_to_recovery: %s is already in recovery mode" % self.serial)
         elif current_mode == "device" or \
              (current_mode == "recovery" and forced):
-            adb = AdbSerial(serial=self.serial,
-                            verbose=self.verbose)
+            adb = AdbSerial.get_shared(serial=self.serial,
+                                       verbose=self.verbose)
+            self.begin_transition(current_mode, "recovery")
             if adb.reboot(mode="recovery") is False:
                 print "reboot_to_recovery: Cannot reboot into recovery"
                 return False
@@ -110,13 +239,9 @@ class Device(ConsoleWrapper):
             print "reboot_to_recovery: Unknown mode %s" % current_mode
             return False
 
-        while True:
-            # Wait for the device, as long as it takes.
-            current_mode = self.get_mode(get_mode_timeout=60)
-            if current_mode != "recovery":
-                continue
-            self.print_verbose("%s is in %s mode" % (self.serial, current_mode))
-            break
+        # Wait for the device, as long as it takes.
+        current_mode = self.wait_for_mode(modes=["recovery"])
+        self.print_verbose("%s is in %s mode" % (self.serial, current_mode))
 
         return True
 
@@ -139,22 +264,25 @@ class Device(ConsoleWrapper):
         if current_mode == "fastboot":
             if forced:
                 fastboot = Fastboot(serial=self.serial, verbose=self.verbose)
+                self.begin_transition(current_mode, "fastboot")
                 fastboot.reboot(mode='reboot-bootloader')
             else:
                 self.print_verbose("reboot_to_fastboot: %s is already in fastboot mode" % self.serial)
         elif current_mode == "recovery":
-            adb = AdbSerial(serial=self.serial,
-                            verbose=self.verbose)
+            adb = AdbSerial.get_shared(serial=self.serial,
+                                       verbose=self.verbose)
+            self.begin_transition(current_mode, "fastboot")
             if adb.reboot(mode="bootloader") is False:
                 print "reboot_to_fastboot: Cannot reboot into fastboot"
                 return False
         elif current_mode == "device":
-            adb = AdbSerial(serial=self.serial,
-                            verbose=self.verbose)
+            adb = AdbSerial.get_shared(serial=self.serial,
+                                       verbose=self.verbose)
             if adb.wait_for_device() is False:
                 print "reboot_to_fastboot: Cannot wait-for-device"
                 return False
 
+            self.begin_transition(current_mode, "fastboot")
             if adb.reboot(mode="bootloader") is False:
                 print "reboot_to_fastboot: Cannot reboot into fastboot"
                 return False
@@ -180,12 +308,14 @@ class Device(ConsoleWrapper):
             fastboot = Fastboot(serial=self.serial, verbose=self.verbose)
             if not fastboot.is_unlocked():
                 raise Exception("Device is not unlocked.  Please unlock with 'fastboot oem unlock' to continue")
+            self.begin_transition(current_mode, "device")
             if fastboot.reboot() is False:
                 print "reboot_device: Cannot reboot into device"
                 return False
         elif current_mode == "recovery":
-            adb = AdbSerial(serial=self.serial,
-                            verbose=self.verbose)
+            adb = AdbSerial.get_shared(serial=self.serial,
+                                       verbose=self.verbose)
+            self.begin_transition(current_mode, "device")
             if adb.reboot() is False:
                 print "reboot_device: Cannot reboot into device"
                 return False
@@ -201,8 +331,8 @@ class Device(ConsoleWrapper):
         """
         Automatically sideloads a zipfile, and restarts device mode.
         """
-        adb = AdbSerial(serial=self.serial,
-                        verbose=self.verbose)
+        adb = AdbSerial.get_shared(serial=self.serial,
+                                   verbose=self.verbose)
         self.reboot_to_recovery()
         adb.wait_for_recovery()
 
@@ -232,11 +362,19 @@ class Device(ConsoleWrapper):
             if mode == 'unauthorized' or mode == 'offline':
                 print "Device has adb locked. Please accept to continue installation."
             elif mode == 'device':
+                # Let the first boot of the new ROM (dexopt, package scan) finish before
+                # rebooting away from it.  The watch notices the moment it does.
+                adb = AdbSerial.get_shared(serial=self.serial,
+                                           verbose=self.verbose)
+                if not adb.wait_for_boot_completed(timeout=self.BOOT_COMPLETED_TIMEOUT):
+                    print "Android did not finish booting; rebooting to recovery anyway."
+                adb.close()
                 return self.reboot_to_recovery()
             elif mode == 'timedout':
                 print "Cannot detect device. Please complete onboarding screen and enable adb mode."
             # We expect the device to be rebooting a new rom and dexopting.  This takes a while.
-            time.sleep(5)
+            # Wake up as soon as adb reports the device, but remind the user every so often.
+            self.wait_for_mode(modes=['device'], timeout=30)
 
 def main():
     d = Device('030e5d6f08ea6153', verbose=True)
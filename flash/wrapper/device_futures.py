@@ -0,0 +1,164 @@
+import sys
+import threading
+
+class DeviceFuture(object):
+    """
+    The pending result of a call running on a background thread.
+
+    result() blocks until the call finishes, then returns its value or re-raises its
+    exception (with the original traceback).
+    """
+    def __init__(self, description=None):
+        self.description = description
+        self.condition = threading.Condition()
+        self.finished = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        with self.condition:
+            return self.finished
+
+    def result(self, timeout=None):
+        """
+        Returns the call's value, waiting up to timeout seconds (forever if None).
+
+        Raises Exception if the call did not finish in time.
+        """
+        with self.condition:
+            if not self.finished:
+                self.condition.wait(timeout)
+            if not self.finished:
+                raise Exception('Timed out waiting for %s' % self.description)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the call, or None."""
+        try:
+            self.result(timeout=timeout)
+        except Exception, e:
+            return e
+        return None
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once the call finishes (immediately if it already has)."""
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, value=None, exc_info=None):
+        with self.condition:
+            self.value = value
+            self.exc_info = exc_info
+            self.finished = True
+            callbacks, self.callbacks = self.callbacks, []
+            self.condition.notify_all()
+        for callback in callbacks:
+            callback(self)
+
+def run_async(function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) on a daemon thread and returns a DeviceFuture.
+    """
+    future = DeviceFuture(description=getattr(function, '__name__', repr(function)))
+
+    def run():
+        try:
+            future._finish(value=function(*args, **kwargs))
+        except BaseException:
+            future._finish(exc_info=sys.exc_info())
+
+    thread = threading.Thread(target=run, name='run_async(%s)' % future.description)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def wait_all(futures, timeout=None):
+    """
+    Returns the results of futures, in order.  The first failure is re-raised.
+    """
+    return [future.result(timeout=timeout) for future in futures]
+
+def map_bounded(function, items, max_workers=8):
+    """
+    Calls function(item) for every item on at most max_workers threads at once.
+
+    Returns a DeviceFuture per item, in order.  Bounding the threads keeps a large hub
+    from starting dozens of adb or fastboot processes at the same moment.
+    """
+    items = list(items)
+    futures = [DeviceFuture(description='%s(%r)' % (getattr(function, '__name__', 'map'), item))
+               for item in items]
+    pending = list(xrange(len(items)))
+    pending_lock = threading.Lock()
+
+    def work():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                index = pending.pop(0)
+            try:
+                futures[index]._finish(value=function(items[index]))
+            except BaseException:
+                futures[index]._finish(exc_info=sys.exc_info())
+
+    for _ in xrange(min(max_workers, len(items))):
+        thread = threading.Thread(target=work, name='map_bounded')
+        thread.daemon = True
+        thread.start()
+    return futures
+
+class AsyncDevice(object):
+    """
+    Non-blocking view of a synchronous wrapper (AdbSerial, Fastboot or Device).
+
+    Every method of the wrapped object is available and returns a DeviceFuture instead of
+    blocking:
+
+        async_adb = AsyncDevice(adb)
+        rebooted = async_adb.reboot('recovery')
+        rom_zip = run_async(full_rom.get_zip)    # downloads while the device reboots
+        rebooted.result()
+
+    Calls made through one AsyncDevice run one at a time, in the order they were made,
+    since a device (and its shell session) can only do one thing at a time.  Calls to
+    different devices, and host work such as downloads, overlap freely.
+    """
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        # Serializes calls to the wrapped object; acquired in call order.
+        self.order_lock = threading.Lock()
+        self.last_future = None
+
+    def __getattr__(self, name):
+        method = getattr(self.wrapped, name)
+        if not callable(method):
+            return method
+
+        def call_async(*args, **kwargs):
+            return self.submit(method, *args, **kwargs)
+        call_async.__name__ = name
+        return call_async
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) after all calls already submitted to this device.
+        """
+        with self.order_lock:
+            previous = self.last_future
+
+            def run_in_order():
+                if previous is not None:
+                    # The previous call's failure belongs to its own future.
+                    previous.exception()
+                return function(*args, **kwargs)
+            run_in_order.__name__ = getattr(function, '__name__', 'call')
+
+            self.last_future = run_async(run_in_order)
+            return self.last_future
@@ -0,0 +1,228 @@
+import socket
+import subprocess
+import threading
+import time
+
+from .adb_client import AdbClient, AdbClientException
+from .device_tracker import DeviceTracker
+
+class DeviceMonitor(object):
+    """
+    Keeps a live map of serial -> (mode, since) for every adb and fastboot device.
+
+    One background thread enumerates for the whole process, so the cost stays the same
+    no matter how many devices are flashed or how many places wait on them:
+    - adb states come from the DeviceTracker event stream (one 'adb devices' per
+      interval only while the adb server cannot be reached);
+    - fastboot has no event stream, so 'fastboot devices' runs once per interval.
+
+    Modes use the names of Device.get_mode(): device, recovery, sideload, unauthorized,
+    offline, fastboot.  since is the time.time() at which the device entered the mode.
+
+    One monitor is shared by the whole process; use DeviceMonitor.get_instance().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # Seconds between enumerations.
+    POLL_INTERVAL = 1
+    # Seconds between enumerations while a device is due to arrive (see expect()).
+    FAST_POLL_INTERVAL = 0.2
+
+    def __init__(self, adb_client=None):
+        if adb_client is None:
+            adb_client = AdbClient()
+        self.adb_client = adb_client
+
+        self.condition = threading.Condition()
+        self.modes = {}
+        # Incremented whenever any serial changes mode.
+        self.version = 0
+        # True once the first enumeration has completed.
+        self.ready = False
+        # serial -> (mode, fast_from, until), see expect().
+        self.expectations = {}
+
+        self.thread = threading.Thread(target=self._run, name='DeviceMonitor')
+        self.thread.daemon = True
+
+    @classmethod
+    def get_instance(cls):
+        """Returns the process-wide monitor, started and with a first enumeration done."""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            monitor = cls._instance
+        monitor.wait_until_ready()
+        return monitor
+
+    def start(self):
+        self.thread.start()
+
+    def wait_until_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.ready:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    # Enumeration (monitor thread)
+
+    def _run(self):
+        while True:
+            tracker = DeviceTracker.get_instance()
+            tracker_version = None
+            if tracker is not None:
+                tracker_version = tracker.version
+
+            states = self._enumerate_fastboot()
+            # adb wins: a device cannot be in both, and adb reports transitions first.
+            states.update(self._enumerate_adb(tracker))
+            self._update(states)
+
+            # Wake early for adb events; fastboot is picked up on the next tick.
+            interval = self._next_interval()
+            if tracker is not None:
+                tracker.wait_for_change(tracker_version, interval)
+            else:
+                time.sleep(interval)
+
+    def _next_interval(self):
+        """
+        Returns the seconds until the next enumeration: POLL_INTERVAL, or less while an
+        expected device is due.
+        """
+        now = time.time()
+        interval = self.POLL_INTERVAL
+        with self.condition:
+            for serial, (mode, fast_from, until) in self.expectations.items():
+                arrived = self.modes.get(serial, (None, None))[0] == mode
+                if arrived or (until is not None and now >= until):
+                    del self.expectations[serial]
+                    continue
+                interval = min(interval, max(self.FAST_POLL_INTERVAL, fast_from - now))
+        return interval
+
+    def _enumerate_adb(self, tracker):
+        if tracker is not None:
+            with tracker.condition:
+                return dict(tracker.states)
+        try:
+            return self.adb_client.devices()
+        except (AdbClientException, socket.error):
+            pass
+        return self._parse_devices(['adb', 'devices'])
+
+    def _enumerate_fastboot(self):
+        return self._parse_devices(['fastboot', 'devices'])
+
+    @classmethod
+    def _parse_devices(cls, args):
+        """Returns serial -> state from 'adb devices' or 'fastboot devices' output."""
+        try:
+            command = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            return {}
+        stdout, stderr = command.communicate()
+        if command.returncode != 0:
+            return {}
+
+        states = {}
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and not line.startswith('List of devices'):
+                states[fields[0]] = fields[1]
+        return states
+
+    def _update(self, states):
+        now = time.time()
+        with self.condition:
+            changed = not self.ready
+            for serial in self.modes.keys():
+                if serial not in states:
+                    del self.modes[serial]
+                    changed = True
+            for serial, mode in states.iteritems():
+                if serial not in self.modes or self.modes[serial][0] != mode:
+                    self.modes[serial] = (mode, now)
+                    changed = True
+
+            self.ready = True
+            if changed:
+                self.version += 1
+                self.condition.notify_all()
+
+    def expect(self, serial, mode, fast_from, until=None):
+        """
+        Announces that serial should show up in mode from about time fast_from on.
+
+        From then until it does (or until passes), enumeration runs every
+        FAST_POLL_INTERVAL, so that a device that arrives is noticed within a fraction of
+        a second rather than on the next regular tick.
+        """
+        with self.condition:
+            self.expectations[serial] = (mode, fast_from, until)
+
+    # Queries
+
+    def get(self, serial):
+        """Returns (mode, since) for serial, or (None, None) if no tool sees it."""
+        with self.condition:
+            return self.modes.get(serial, (None, None))
+
+    def get_mode(self, serial):
+        return self.get(serial)[0]
+
+    def get_devices(self):
+        """Returns a copy of the whole serial -> (mode, since) map."""
+        with self.condition:
+            return dict(self.modes)
+
+    def wait_for_change(self, version, timeout=None):
+        """
+        Blocks until the map is newer than version, or timeout seconds pass.
+
+        Returns the latest version.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            while self.version == version:
+                if deadline is None:
+                    # Wake now and then, so that KeyboardInterrupt gets through.
+                    self.condition.wait(60)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.version
+
+    def wait_for_mode(self, serial, modes=None, timeout=None):
+        """
+        Blocks until serial is in one of modes (any mode if None), and returns the mode.
+
+        Returns 'timedout' if timeout seconds pass first.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            with self.condition:
+                version = self.version
+                mode = self.modes.get(serial, (None, None))[0]
+            if mode is not None and (modes is None or mode in modes):
+                return mode
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return 'timedout'
+            self.wait_for_change(version, remaining)
@@ -0,0 +1,140 @@
+class DeviceSnapshot(object):
+    """
+    A structured record of device state gathered by one compound shell script.
+
+    Instead of one adb round trip per question (mount, ls, grep, which), the script below
+    answers all of them at once:
+    - the mount table;
+    - whether each requested path exists;
+    - the requested properties of each requested prop file; and
+    - the recovery identity ('which twrp').
+
+    A snapshot is only valid until the device changes state.  Take a new one after any
+    reboot, mount or write.
+    """
+    SECTION_MARKER = '__LMA_SECTION__'
+
+    # Questions FlashHelper asks during a templated flash.
+    DEFAULT_PATHS = [
+        '/data/system/packages.xml',
+        '/tmp/recovery.log',
+        ]
+    DEFAULT_PROP_FILES = {
+        '/system/build.prop' : [
+            'ro.cm.display.version',
+            'ro.build.display.id',
+            'ro.build.version.release',
+            ],
+        '/system/etc/g.prop' : [
+            'ro.addon.pa_version',
+            ],
+        '/default.prop' : [
+            'ro.product.device',
+            ],
+        }
+
+    def __init__(self, paths=None, prop_files=None, mount_system=False):
+        if paths is None:
+            paths = self.DEFAULT_PATHS
+        if prop_files is None:
+            prop_files = self.DEFAULT_PROP_FILES
+
+        self.paths = list(paths)
+        self.prop_files = dict(prop_files)
+        self.mount_system = mount_system
+
+        # Populated by parse()
+        self.mount_points = set()
+        self.existing_paths = {}
+        self.props = {}
+        self.twrp_path = ''
+
+    def get_script(self):
+        """
+        Returns the shell script that collects the snapshot.
+
+        The script avoids double quotes and $ so it survives AdbCommand's host-side quoting.
+        """
+        script = []
+        if self.mount_system:
+            # build.prop is not visible in recovery until /system is mounted.
+            script.append('mount /system 2> /dev/null')
+
+        script.append('echo %s mounts' % self.SECTION_MARKER)
+        script.append('mount')
+
+        script.append('echo %s paths' % self.SECTION_MARKER)
+        for path in self.paths:
+            script.append('if [ -e %s ]; then echo 1 %s; else echo 0 %s; fi' % (path, path, path))
+
+        for prop_file in sorted(self.prop_files.keys()):
+            script.append('echo %s props %s' % (self.SECTION_MARKER, prop_file))
+            patterns = ' '.join(["-e '^%s='" % prop for prop in self.prop_files[prop_file]])
+            script.append('grep %s %s 2> /dev/null' % (patterns, prop_file))
+
+        script.append('echo %s recovery' % self.SECTION_MARKER)
+        script.append('which twrp 2> /dev/null')
+
+        # Always exit cleanly; missing files are expected.
+        script.append('true')
+        return '; '.join(script)
+
+    def parse(self, output):
+        """
+        Populates the snapshot from the output of get_script().
+        """
+        section = None
+        prop_file = None
+        for line in output.splitlines():
+            line = line.rstrip('\r')
+            if line.startswith(self.SECTION_MARKER):
+                section_args = line.split()[1:]
+                section = section_args[0]
+                if section == 'props':
+                    prop_file = section_args[1]
+                    self.props.setdefault(prop_file, {})
+                continue
+
+            if section == 'mounts':
+                # Accepts "/dev/block/mmcblk0p25 on /system type ext4 (rw,...)" and the
+                # /proc/mounts format "/dev/block/mmcblk0p25 /system ext4 rw,... 0 0".
+                components = line.split()
+                if len(components) >= 4 and components[1] == 'on' and components[3] == 'type':
+                    self.mount_points.add(components[2])
+                elif len(components) >= 2:
+                    self.mount_points.add(components[1])
+            elif section == 'paths':
+                components = line.split(' ', 1)
+                if len(components) == 2:
+                    self.existing_paths[components[1]] = components[0] == '1'
+            elif section == 'props':
+                if '=' in line:
+                    prop_name, prop_val = line.split('=', 1)
+                    self.props[prop_file][prop_name] = prop_val
+            elif section == 'recovery':
+                if line.strip():
+                    self.twrp_path = line.strip()
+
+        return self
+
+    def is_mount_point_mounted(self, mount=None):
+        return mount in self.mount_points
+
+    def path_exists(self, path=None):
+        if path not in self.existing_paths:
+            raise KeyError('Path "%s" was not part of this snapshot' % path)
+        return self.existing_paths[path]
+
+    def getprop_file(self, property, prop_file=None):
+        """
+        Returns the property from the prop file, or '' if it is not defined there.
+        """
+        if prop_file not in self.prop_files or property not in self.prop_files[prop_file]:
+            raise KeyError('Property "%s" of "%s" was not part of this snapshot' % (property, prop_file))
+        return self.props.get(prop_file, {}).get(property, '')
+
+    def getprop_system(self, property):
+        return self.getprop_file(property, prop_file='/system/build.prop')
+
+    def is_twrp(self):
+        return self.twrp_path != ''
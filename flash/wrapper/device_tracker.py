@@ -0,0 +1,118 @@
+import socket
+import subprocess
+import threading
+import time
+
+from .adb_client import AdbClient, AdbClientException
+
+class DeviceTracker(object):
+    """
+    Follows the adb server's host:track-devices stream on a background thread.
+
+    The adb server pushes an update whenever a device appears, disappears or changes state
+    (device, recovery, unauthorized, offline, sideload).  Waiters block on a condition
+    variable and wake as soon as an update arrives, instead of on the next polling tick.
+
+    One tracker is shared by the whole process; use DeviceTracker.get_instance().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # Seconds to wait before reconnecting after the adb server went away.
+    RECONNECT_DELAY = 1
+
+    def __init__(self, client=None):
+        if client is None:
+            client = AdbClient()
+        self.client = client
+
+        self.condition = threading.Condition()
+        self.states = {}
+        # Incremented on every update, so waiters can tell that something happened.
+        self.version = 0
+        # True while the stream is connected and self.states can be trusted.
+        self.connected = False
+
+        self.thread = threading.Thread(target=self._run, name='DeviceTracker')
+        self.thread.daemon = True
+        self.started = False
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the process-wide tracker, or None while the adb server cannot be reached.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            tracker = cls._instance
+
+        if not tracker.connected:
+            return None
+        return tracker
+
+    def start(self, timeout=10):
+        """
+        Starts tracking and waits for the first device listing.
+
+        Returns False if no listing arrived within timeout seconds.
+        """
+        if not self.started:
+            self.started = True
+            self.thread.start()
+
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.connected:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _run(self):
+        started_server = False
+        while True:
+            try:
+                for device_states in self.client.track_devices():
+                    self._update(device_states, connected=True)
+            except (AdbClientException, socket.error):
+                # The server may not be running yet; 'adb start-server' fixes that once.
+                if not started_server:
+                    started_server = True
+                    subprocess.call(['adb', 'start-server'])
+                    continue
+
+            # The stream ended.  Nothing is known until we reconnect.
+            self._update({}, connected=False)
+            time.sleep(self.RECONNECT_DELAY)
+
+    def _update(self, device_states, connected):
+        with self.condition:
+            self.states = device_states
+            self.connected = connected
+            self.version += 1
+            self.condition.notify_all()
+
+    def get_state(self, serial):
+        """
+        Returns the adb state of the serial, or None if adb does not see it.
+        """
+        with self.condition:
+            return self.states.get(serial)
+
+    def wait_for_change(self, version, timeout):
+        """
+        Blocks until an update newer than version arrives, or timeout seconds pass.
+
+        Returns the latest version.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.version == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.version
@@ -0,0 +1,138 @@
+class DeviceWaitResult(object):
+    """
+    Outcome of AdbSerial.wait_on_device().
+
+    - satisfied: True if the condition held before the timeout.
+    - elapsed: seconds spent waiting, measured on the host.
+    - value: the last value observed by value-based waits (for example, the sha1sum line
+      of a file that had to stabilize).  None otherwise.
+    """
+    def __init__(self, satisfied=False, elapsed=0, value=None):
+        self.satisfied = satisfied
+        self.elapsed = elapsed
+        self.value = value
+
+class DeviceWait(object):
+    """
+    Builds shell loops that block on the device until a condition holds.
+
+    The loop runs inside a single adb shell, so the host sees one command that returns
+    once, instead of one adb round trip per second.  The loop prints a result line:
+
+        __LMA_WAIT__ 1      (condition held)
+        __LMA_WAIT__ 0      (timed out)
+
+    followed, for value waits, by the last value observed.
+
+    usleep is used between checks where available (busybox, toybox).  Devices with only
+    toolbox fall back to whole-second sleeps.
+    """
+    RESULT_MARKER = '__LMA_WAIT__'
+
+    # Seconds between checks on the device.
+    DEFAULT_INTERVAL = 0.2
+
+    # Conditions
+
+    @classmethod
+    def path_exists(cls, path):
+        return '[ -e %s ]' % path
+
+    @classmethod
+    def mount_present(cls, mount):
+        return 'grep -q " %s " /proc/mounts' % mount
+
+    @classmethod
+    def prop_equals(cls, prop, value):
+        return '[ "$(getprop %s)" = "%s" ]' % (prop, value)
+
+    @classmethod
+    def output_contains(cls, command, text):
+        return '%s 2> /dev/null | grep -q "%s"' % (command, text)
+
+    @classmethod
+    def foreground_activity(cls, activity):
+        """
+        activity may be short ('.WelcomeActivity') or qualified ('com.example/.Welcome').
+        """
+        if '/' not in activity:
+            activity = '/' + activity
+        return 'dumpsys activity activities 2> /dev/null | grep mFocusedActivity | grep -q "%s[ }]"' % activity
+
+    @classmethod
+    def any_of(cls, conditions):
+        return ' || '.join(['{ %s; }' % condition for condition in conditions])
+
+    # Scripts
+
+    @classmethod
+    def _sleep(cls, interval):
+        return 'usleep %d 2> /dev/null || sleep 1' % int(interval * 1000000)
+
+    @classmethod
+    def _timed_out(cls, timeout):
+        if timeout is None:
+            return 'false'
+        return '[ $(( $(date +%%s) - t0 )) -ge %d ]' % int(timeout + 0.999)
+
+    @classmethod
+    def condition_script(cls, condition, timeout=None, hold=0, interval=DEFAULT_INTERVAL):
+        """
+        Returns a script that waits until condition has held for hold seconds in a row.
+        """
+        return '; '.join([
+            't0=$(date +%s); r=0; since=""',
+            'while true; do '
+                'now=$(date +%%s); '
+                'if %(condition)s; then '
+                    'if [ -z "$since" ]; then since=$now; fi; '
+                    'if [ $((now - since)) -ge %(hold)d ]; then r=1; break; fi; '
+                'else since=""; fi; '
+                'if %(timed_out)s; then break; fi; '
+                '%(sleep)s; '
+            'done' % {
+                'condition' : condition,
+                'hold' : hold,
+                'timed_out' : cls._timed_out(timeout),
+                'sleep' : cls._sleep(interval),
+                },
+            'echo "%s $r"' % cls.RESULT_MARKER,
+            ])
+
+    @classmethod
+    def stable_output_script(cls, command, seconds, timeout=None, interval=DEFAULT_INTERVAL):
+        """
+        Returns a script that waits until command prints the same non-empty output for
+        the indicated number of seconds.  The output is reported as the value.
+        """
+        return '; '.join([
+            't0=$(date +%s); r=0; last=""; since=$t0',
+            'while true; do '
+                'cur=$(%(command)s 2> /dev/null); now=$(date +%%s); '
+                'if [ -n "$cur" ] && [ "$cur" = "$last" ]; then '
+                    'if [ $((now - since)) -ge %(seconds)d ]; then r=1; break; fi; '
+                'else last=$cur; since=$now; fi; '
+                'if %(timed_out)s; then break; fi; '
+                '%(sleep)s; '
+            'done' % {
+                'command' : command,
+                'seconds' : seconds,
+                'timed_out' : cls._timed_out(timeout),
+                'sleep' : cls._sleep(interval),
+                },
+            'echo "%s $r"' % cls.RESULT_MARKER,
+            'echo "$last"',
+            ])
+
+    @classmethod
+    def parse(cls, stdout):
+        """
+        Returns (satisfied, value) from a script's output, or None if there is no result line.
+        """
+        lines = [line.rstrip('\r') for line in stdout.splitlines()]
+        for index, line in enumerate(lines):
+            if line.startswith(cls.RESULT_MARKER + ' '):
+                satisfied = line.split()[1] == '1'
+                value = '\n'.join(lines[index+1:]).strip() or None
+                return (satisfied, value)
+        return None
@@ -0,0 +1,194 @@
+import os
+import select
+import subprocess
+import threading
+import time
+
+from .console_wrapper import ConsoleWrapper
+from .device_futures import DeviceFuture
+from .device_wait import DeviceWait
+from .retry import backoff_delay
+
+class DeviceWatch(ConsoleWrapper):
+    """
+    Streams changes of device state from one long-running 'adb shell' to subscribers.
+
+    Each watched probe is a shell command whose output is the value (a property, whether
+    Wi-Fi is connected, the foreground activity).  A loop on the device runs every probe
+    each interval and prints a line only when a value changes:
+
+        __LMA_WATCH__ boot_completed 1
+
+    A reader thread dispatches those lines to callbacks and resolves futures as they
+    arrive, so waiters wake the moment the device changes instead of on the next poll.
+    The stream is restarted if adb drops it (reboot, unplug); values are re-sent then.
+
+        watch = DeviceWatch(serial, probes={'boot' : DeviceWatch.prop('sys.boot_completed')})
+        watch.start()
+        watch.wait_for('boot', '1').result(timeout=120)
+        watch.stop()
+    """
+    WATCH_MARKER = '__LMA_WATCH__'
+    UNSET = '__LMA_UNSET__'
+
+    # Seconds between probe rounds on the device.
+    DEFAULT_INTERVAL = 0.5
+
+    # Probes
+
+    @classmethod
+    def prop(cls, prop):
+        return 'getprop %s' % prop
+
+    @classmethod
+    def wifi_connected(cls):
+        """1 when no Wi-Fi state machine is disconnected (see AdbSerial.is_wifi_connected)."""
+        return 'if dumpsys wifi | grep -q -e "curState=NotConnectedState" -e "curState=DisconnectedState"; ' \
+               'then echo 0; else echo 1; fi'
+
+    @classmethod
+    def foreground_activity(cls, activity):
+        """1 while activity is in the foreground."""
+        return 'if %s; then echo 1; else echo 0; fi' % DeviceWait.foreground_activity(activity)
+
+    def __init__(self, serial=None, probes=None, interval=DEFAULT_INTERVAL, verbose=False):
+        ConsoleWrapper.__init__(self, verbose=verbose)
+        self.serial = serial
+        self.probes = probes or {}
+        self.interval = interval
+
+        self.condition = threading.Condition()
+        self.values = {}
+        # name -> list of callback(name, value)
+        self.callbacks = {}
+        # name -> list of (predicate, DeviceFuture)
+        self.waiters = {}
+
+        self.process = None
+        self.stopped = False
+        self.thread = None
+
+    def get_script(self):
+        names = sorted(self.probes)
+        # Start from a value no probe prints, so the first round reports every probe.
+        lines = [' '.join(['p%d=%s;' % (index, self.UNSET) for index in xrange(len(names))]),
+                 'while true; do']
+        for index, name in enumerate(names):
+            lines.append('v=$( { %s\n} 2> /dev/null ); '
+                         'if [ "$v" != "$p%d" ]; then p%d=$v; echo "%s %s $v"; fi' % (
+                             self.probes[name], index, index, self.WATCH_MARKER, name))
+        lines.append('%s; done' % DeviceWait._sleep(self.interval))
+        return '\n'.join(lines)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='DeviceWatch(%s)' % self.serial)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            process = self.process
+        if process is not None and process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    def subscribe(self, name, callback):
+        """
+        Calls callback(name, value) on every change of the probe, starting with its
+        current value if one is known.
+        """
+        with self.condition:
+            self.callbacks.setdefault(name, []).append(callback)
+            value = self.values.get(name)
+        if value is not None:
+            callback(name, value)
+
+    def wait_for(self, name, expected):
+        """
+        Returns a DeviceFuture that resolves to the probe's value once expected (a value,
+        or a predicate taking the value) matches.
+        """
+        predicate = expected
+        if not callable(expected):
+            predicate = lambda value: value == expected
+
+        future = DeviceFuture(description='%s on %s' % (name, self.serial))
+        with self.condition:
+            value = self.values.get(name)
+            if value is None or not predicate(value):
+                self.waiters.setdefault(name, []).append((predicate, future))
+                return future
+        future._finish(value=value)
+        return future
+
+    def _run(self):
+        attempt = 0
+        while not self.stopped:
+            started = time.time()
+            self._stream()
+            if self.stopped:
+                break
+
+            # Values are re-sent by the next stream; forget the stale ones.
+            with self.condition:
+                self.values = {}
+            if time.time() - started > 10:
+                attempt = 0
+            self.print_verbose('DeviceWatch: stream for %s ended; restarting' % self.serial)
+            time.sleep(backoff_delay(attempt, base=0.5))
+            attempt += 1
+
+    def _stream(self):
+        with self.condition:
+            if self.stopped:
+                return
+            self.process = subprocess.Popen(['adb', '-s', self.serial, 'shell', self.get_script()],
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+            process = self.process
+
+        buffered = ''
+        fd = process.stdout.fileno()
+        while True:
+            select.select([fd], [], [])
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            buffered += chunk
+            while '\n' in buffered:
+                line, buffered = buffered.split('\n', 1)
+                self._dispatch(line.rstrip('\r'))
+        process.wait()
+
+    def _dispatch(self, line):
+        fields = line.split(' ', 2)
+        if len(fields) < 2 or fields[0] != self.WATCH_MARKER:
+            return
+        name = fields[1]
+        value = ''
+        if len(fields) == 3:
+            value = fields[2].strip()
+
+        resolved = []
+        with self.condition:
+            self.values[name] = value
+            callbacks = list(self.callbacks.get(name, []))
+            pending = []
+            for predicate, future in self.waiters.get(name, []):
+                if predicate(value):
+                    resolved.append(future)
+                else:
+                    pending.append((predicate, future))
+            self.waiters[name] = pending
+            self.condition.notify_all()
+
+        self.print_verbose('DeviceWatch: %s=%s' % (name, value))
+        for callback in callbacks:
+            callback(name, value)
+        for future in resolved:
+            future._finish(value=value)
@@ -1,15 +1,139 @@
+import socket
 import subprocess
+import threading
+import time
 
 from .console_wrapper import ConsoleWrapper
+from .fastboot_client import FastbootClient, FastbootClientException
+from .retry import backoff_delay
 
 class FastbootCommandException(Exception): pass
 
 class Fastboot(ConsoleWrapper):
+    # Attempts for reads that bootloaders sometimes fail transiently.
+    GETVAR_ATTEMPTS = 5
+
+    # serial -> {variable: value} from 'fastboot getvar all', for the current stay in
+    # fastboot mode.  Shared by all instances, since any of them may reboot the device.
+    _vars_cache = {}
+    _vars_cache_lock = threading.Lock()
+
     def __init__(self, serial=None, verbose=None):
         ConsoleWrapper.__init__(self, verbose=verbose)
         self.serial = serial
 
+        # Network-attached bootloaders ('tcp:HOST[:PORT]') are driven in-process.
+        self.client = FastbootClient.from_serial(serial, verbose=verbose)
+
+    def _client_call(self, description, function, *args, **kwargs):
+        """
+        Runs a FastbootClient call.  Returns (True, result), or (False, None) on failure.
+        """
+        self.print_verbose("Executing (fastboot tcp): %s" % description)
+        try:
+            return (True, function(*args, **kwargs))
+        except (FastbootClientException, socket.error), e:
+            self.print_verbose("%s failed: %s" % (description, e))
+            return (False, None)
+
+    def _print_progress(self, sent, total):
+        self.print_verbose("Sent %d of %d bytes" % (sent, total))
+
+    def invalidate_vars(self):
+        """Forgets the cached variables.  Called whenever the device leaves fastboot or is flashed."""
+        with self._vars_cache_lock:
+            self._vars_cache.pop(self.serial, None)
+
+    def _getvar_cmdline(self, param):
+        if self.serial is None:
+            return "fastboot getvar %s" % param
+        return "fastboot -s %s getvar %s" % (self.serial, param)
+
+    def _execute_getvar(self, param, attempts=1):
+        """
+        Runs 'fastboot getvar param', retrying with backoff up to attempts times.
+
+        Returns (stdout, stderr), or None if every attempt failed.
+        """
+        cmdline = self._getvar_cmdline(param)
+        for i in xrange(attempts):
+            if self.client is not None:
+                # Present the answer the way the fastboot binary prints it.
+                if param == 'all':
+                    succeeded, output = self._client_call(cmdline, self.client.getvar_all)
+                else:
+                    succeeded, output = self._client_call(cmdline, self.client.getvar, param)
+                    output = '%s: %s' % (param, output)
+                if succeeded:
+                    return ('', output)
+                if i+1 < attempts:
+                    time.sleep(backoff_delay(i))
+                continue
+
+            self.print_verbose("Executing: %s" % cmdline)
+            command = subprocess.Popen(cmdline,
+                                       shell=True,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            stdout, stderr = command.communicate()
+            if command.returncode == 0:
+                return (stdout, stderr)
+
+            self.print_verbose("ReturnCode = %s" % command.returncode)
+            if i+1 < attempts:
+                time.sleep(backoff_delay(i))
+        return None
+
+    @classmethod
+    def parse_getvar_all(cls, output):
+        """
+        Parses 'fastboot getvar all' output into a dict:
+
+            (bootloader) version-bootloader: HHZ12d
+            (bootloader) partition-size:system: 0x0000000040000000
+        """
+        variables = {}
+        for line in output.splitlines():
+            if not line.startswith('(bootloader) '):
+                continue
+            variable = line[len('(bootloader) '):].strip()
+            if ': ' in variable:
+                name, value = variable.rsplit(': ', 1)
+            elif variable.endswith(':'):
+                # Variables without a value ("variant:" on bacon)
+                name, value = variable[:-1], ''
+            else:
+                continue
+            variables[name.strip()] = value.strip()
+        return variables
+
+    def get_vars(self):
+        """
+        Returns every variable the bootloader reports, read once per stay in fastboot.
+
+        Bootloaders without 'getvar all' yield an empty dict; getvar() then asks for
+        variables one at a time.
+        """
+        with self._vars_cache_lock:
+            if self.serial in self._vars_cache:
+                return self._vars_cache[self.serial]
+
+        variables = {}
+        # One attempt: a bootloader without 'getvar all' fails the same way every time.
+        output = self._execute_getvar('all')
+        if output is not None:
+            # fastboot prints the variables to stderr.
+            variables = self.parse_getvar_all(output[1] + output[0])
+            self.print_verbose("getvar all: %d variables" % len(variables))
+        # A failure is remembered too, until invalidate_vars(), so that it is not asked again.
+        with self._vars_cache_lock:
+            self._vars_cache[self.serial] = variables
+        return variables
+
     def reboot(self, mode="reboot"):
+        self.invalidate_vars()
+        if self.client is not None:
+            return self._client_call("reboot %s" % mode, self.client.reboot, mode)[0]
         if self.serial is None:
             cmdline = "fastboot %s" % mode
         else:
@@ -22,6 +146,7 @@ class Fastboot(ConsoleWrapper):
         stdout, stderr = command.communicate()
         if command.returncode != 0:
             self.print_verbose("ReturnCode = %s" % command.returncode)
+        return command.returncode == 0
 
     def boot(self, kernel, just_flashed_recovery=None):
         # Always flash the recovery sector when doing this trick.
@@ -29,6 +154,12 @@ class Fastboot(ConsoleWrapper):
         # (Skip if just_flashed_recovery is True.)
         if just_flashed_recovery is not True:
             self.flash("recovery", kernel)
+        self.invalidate_vars()
+
+        if self.client is not None:
+            self._client_call("boot %s" % kernel, self.client.boot, kernel,
+                              progress_callback=self._print_progress)
+            return
 
         if self.serial is None:
             cmdline = "fastboot boot %s" % kernel
@@ -44,6 +175,10 @@ class Fastboot(ConsoleWrapper):
             self.print_verbose("ReturnCode = %s" % command.returncode)
 
     def flash(self, partition, filename):
+        self.invalidate_vars()
+        if self.client is not None:
+            return self._client_call("flash %s %s" % (partition, filename), self.client.flash,
+                                     partition, filename, progress_callback=self._print_progress)[0]
         if self.serial is None:
             cmdline = "fastboot flash %s %s" % (partition, filename)
         else:
@@ -56,24 +191,25 @@ class Fastboot(ConsoleWrapper):
         stdout, stderr = command.communicate()
         if command.returncode != 0:
             self.print_verbose("ReturnCode = %s" % command.returncode)
+        return command.returncode == 0
 
-    def getvar(self, param, use_exception=False):
-        if self.serial is None:
-            cmdline = "fastboot getvar %s" % param
-        else:
-            cmdline = "fastboot -s %s getvar %s" % (self.serial, param)
+    def getvar(self, param, use_exception=False, attempts=1):
+        """
+        Returns the bootloader variable param, from 'getvar all' when it is listed there.
 
-        self.print_verbose("Executing: %s" % cmdline)
-        command = subprocess.Popen(cmdline,
-                                   shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        stdout, stderr = command.communicate()
-        if command.returncode != 0:
-            self.print_verbose("ReturnCode = %s" % command.returncode)
+        Otherwise, runs 'fastboot getvar param' up to attempts times.  Returns None (or
+        raises FastbootCommandException if use_exception is set) if that fails.
+        """
+        variables = self.get_vars()
+        if param in variables:
+            return variables[param] or None
+
+        output = self._execute_getvar(param, attempts=attempts)
+        if output is None:
             if use_exception:
                 raise FastbootCommandException()
             return None
+        stdout, stderr = output
 
         for line in stdout.splitlines():
             if line.startswith("%s: " % param):
@@ -131,6 +267,13 @@ class Fastboot(ConsoleWrapper):
         """
         device_info = {}
 
+        if self.client is not None:
+            succeeded, info = self._client_call("oem device-info", self.client.oem, 'device-info')
+            stderr = ''
+            if succeeded:
+                stderr = '\n'.join(['(bootloader) %s' % line for line in info])
+            return self.parse_oem_device_info(stderr)
+
         if self.serial is None:
             cmdline = "fastboot oem device-info"
         else:
@@ -146,6 +289,12 @@ class Fastboot(ConsoleWrapper):
             self.print_verbose("ReturnCode = %s" % command.returncode)
             return device_info
 
+        return self.parse_oem_device_info(stderr)
+
+    @classmethod
+    def parse_oem_device_info(cls, stderr):
+        device_info = {}
+
         # Parse "variable: value" that are prefixed by "(bootloader) \t"
         for line in stderr.splitlines():
             if line.startswith("(bootloader) \t"):
@@ -160,19 +309,15 @@ class Fastboot(ConsoleWrapper):
         return device_info
 
     def is_unlocked(self):
-        # Loop until we successfully read all parameters
-        while True:
-            try:
-                var_unlocked = self.getvar('unlocked', use_exception=True)
-                break
-            except FastbootCommandException:
-                pass
-        while True:
-            try:
-                var_secure = self.getvar('secure', use_exception=True)
-                break
-            except FastbootCommandException:
-                pass
+        # Read all parameters, retrying a bounded number of times.
+        try:
+            var_unlocked = self.getvar('unlocked', use_exception=True,
+                                       attempts=self.GETVAR_ATTEMPTS)
+            var_secure = self.getvar('secure', use_exception=True,
+                                     attempts=self.GETVAR_ATTEMPTS)
+        except FastbootCommandException:
+            raise FastbootCommandException('is_unlocked: Unable to read unlocked and secure from %s' %
+                                           self.serial)
 
         #
         # CAUTION CAUTION CAUTION
@@ -188,12 +333,7 @@ class Fastboot(ConsoleWrapper):
         # 1
         var_lock_state = None
         if self.getvar_product() in ['flo', 'deb']:
-            while True:
-                try:
-                    var_lock_state = self.getvar('lock_state', use_exception=True)
-                    break
-                except FastbootCommandException:
-                    pass
+            var_lock_state = self.getvar('lock_state', attempts=self.GETVAR_ATTEMPTS)
 
         # Require both unlocked=yes and secure=no
         if var_unlocked == 'yes' and var_secure == 'no':
@@ -217,6 +357,12 @@ class Fastboot(ConsoleWrapper):
         return False
 
     def format(self, partition):
+        self.invalidate_vars()
+        if self.client is not None:
+            # Creating a filesystem image is host work the client does not do; the
+            # bootloader recreates empty partitions from an erase.
+            self._client_call("erase %s" % partition, self.client.erase, partition)
+            return
         if self.serial is None:
             cmdline = "fastboot format %s" % partition
         else:
@@ -232,6 +378,11 @@ class Fastboot(ConsoleWrapper):
             self.print_verbose("ReturnCode = %s" % command.returncode)
 
     def wipe(self):
+        self.invalidate_vars()
+        if self.client is not None:
+            for partition in ['userdata', 'cache']:
+                self._client_call("erase %s" % partition, self.client.erase, partition)
+            return
         if self.serial is None:
             cmdline = "fastboot -w"
         else:
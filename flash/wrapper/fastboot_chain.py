@@ -0,0 +1,58 @@
+from .console_wrapper import ConsoleWrapper
+
+class FastbootChain(ConsoleWrapper):
+    """
+    Runs a sequence of flashes and bootloader restarts as one fastboot session.
+
+    The chain is entered once (Device.reboot_to_fastboot) and then stays in fastboot:
+    after each reboot-bootloader it only waits for the bootloader to re-enumerate,
+    instead of going through a fresh get_mode() and reboot_to_fastboot().
+
+        chain = FastbootChain(fastboot=fastboot, device=device)
+        chain.flash('bootloader', bootloader_img).reboot_bootloader()
+        chain.flash('radio', radio_img).reboot_bootloader()
+        chain.execute()
+    """
+    def __init__(self, fastboot=None, device=None, verbose=False):
+        ConsoleWrapper.__init__(self, verbose=verbose)
+        self.fastboot = fastboot
+        self.device = device
+        self.steps = []
+
+    def flash(self, partition, filename):
+        self.steps.append(('flash', partition, filename))
+        return self
+
+    def reboot_bootloader(self):
+        self.steps.append(('reboot-bootloader',))
+        return self
+
+    def execute(self, reenumeration_timeout=60):
+        """
+        Runs the steps in order and stops at the first failure.
+
+        Returns True if every step succeeded.
+        """
+        if not self.steps:
+            return True
+
+        self.device.reboot_to_fastboot(forced=False)
+        if self.device.wait_for_mode(modes=['fastboot'], timeout=reenumeration_timeout) != 'fastboot':
+            print 'Device did not enter fastboot mode.'
+            return False
+
+        for step in self.steps:
+            self.print_verbose('FastbootChain: %s' % ' '.join(step))
+            if step[0] == 'flash':
+                succeeded = self.fastboot.flash(step[1], step[2])
+            else:
+                self.device.begin_transition('fastboot', 'fastboot')
+                succeeded = self.fastboot.reboot(mode='reboot-bootloader')
+                if succeeded:
+                    succeeded = self.device.wait_for_fastboot_reboot(
+                        timeout=reenumeration_timeout) == 'fastboot'
+
+            if not succeeded:
+                print 'Firmware step failed: %s' % ' '.join(step)
+                return False
+        return True
@@ -0,0 +1,249 @@
+import os
+import socket
+import struct
+
+from .console_wrapper import ConsoleWrapper
+
+class FastbootClientException(Exception):
+    """
+    Used to indicate that the bootloader answered FAIL or broke the protocol.
+    """
+    pass
+
+class FastbootClient(ConsoleWrapper):
+    """
+    In-process client for the fastboot protocol over the TCP transport.
+
+    No fastboot process is started, which also makes the client easy to point at a fake
+    bootloader.  Network-attached boards are addressed the way the fastboot binary does:
+    'tcp:HOST' or 'tcp:HOST:PORT'.
+
+    Protocol summary:
+    - the client opens with 'FB01' and the bootloader answers with its own 'FBxx';
+    - every message in either direction is an 8-byte big-endian length followed by the
+      payload;
+    - a command ('getvar:product', 'download:0001f000', 'flash:recovery') is answered by
+      any number of INFO<text> messages, then OKAY<value>, FAIL<reason> or, for
+      download, DATA<8 hex digits> after which the client sends the data.
+
+    Every method opens its own connection, like one invocation of the fastboot binary.
+    """
+    DEFAULT_PORT = 5554
+
+    HANDSHAKE = 'FB01'
+
+    # Largest data message sent during a download.
+    DOWNLOAD_CHUNK = 1024 * 1024
+
+    def __init__(self, host=None, port=None, timeout=300, verbose=False):
+        ConsoleWrapper.__init__(self, verbose=verbose)
+        self.host = host
+        self.port = port or self.DEFAULT_PORT
+        self.timeout = timeout
+
+    @classmethod
+    def parse_serial(cls, serial):
+        """
+        Returns (host, port) for a 'tcp:HOST[:PORT]' serial, or None for other serials.
+        """
+        if serial is None or not serial.startswith('tcp:'):
+            return None
+        address = serial[len('tcp:'):]
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            return (host, int(port))
+        return (address, cls.DEFAULT_PORT)
+
+    @classmethod
+    def from_serial(cls, serial, timeout=300, verbose=False):
+        """Returns a client for a 'tcp:' serial, or None if serial is not one."""
+        address = cls.parse_serial(serial)
+        if address is None:
+            return None
+        return cls(host=address[0], port=address[1], timeout=timeout, verbose=verbose)
+
+    @classmethod
+    def parse_size(cls, value):
+        """
+        Returns a size reported by the bootloader ('0x20000000' or '536870912'), or None
+        if it cannot be read.
+        """
+        value = value.strip()
+        try:
+            if value.lower().startswith('0x'):
+                return int(value[2:], 16)
+            return int(value, 10)
+        except ValueError:
+            return None
+
+    # Low-level framing
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.settimeout(self.timeout)
+        try:
+            sock.sendall(self.HANDSHAKE)
+            answer = self._recv_exactly(sock, 4)
+            if not answer.startswith('FB'):
+                raise FastbootClientException('Unexpected fastboot handshake %r' % answer)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    @classmethod
+    def _recv_exactly(cls, sock, length):
+        chunks = []
+        while length > 0:
+            chunk = sock.recv(min(length, 65536))
+            if not chunk:
+                raise FastbootClientException('Connection closed by bootloader.')
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    @classmethod
+    def _send_packet(cls, sock, payload):
+        sock.sendall(struct.pack('>Q', len(payload)) + payload)
+
+    @classmethod
+    def _recv_packet(cls, sock):
+        length = struct.unpack('>Q', cls._recv_exactly(sock, 8))[0]
+        return cls._recv_exactly(sock, length)
+
+    @classmethod
+    def _read_response(cls, sock, command, info=None):
+        """
+        Reads messages until OKAY, FAIL or DATA.  Returns (status, payload).
+
+        INFO messages are appended to info, if set.
+        """
+        while True:
+            response = cls._recv_packet(sock)
+            status, payload = response[:4], response[4:]
+            if status == 'INFO':
+                if info is not None:
+                    info.append(payload)
+                continue
+            if status == 'FAIL':
+                raise FastbootClientException('%s failed: %s' % (command, payload))
+            if status in ['OKAY', 'DATA']:
+                return (status, payload)
+            raise FastbootClientException('Unexpected fastboot response %r to %s' % (response, command))
+
+    def _command(self, sock, command, info=None):
+        self._send_packet(sock, command)
+        status, payload = self._read_response(sock, command, info=info)
+        if status != 'OKAY':
+            raise FastbootClientException('Unexpected %s in response to %s' % (status, command))
+        return payload
+
+    def _download(self, sock, file_h, total, progress_callback=None):
+        """Sends total bytes from file_h with download:, reporting progress."""
+        command = 'download:%08x' % total
+        self._send_packet(sock, command)
+        status, payload = self._read_response(sock, command)
+        if status != 'DATA':
+            raise FastbootClientException('Bootloader did not accept download of %d bytes' % total)
+
+        sent = 0
+        while sent < total:
+            chunk = file_h.read(min(self.DOWNLOAD_CHUNK, total - sent))
+            if not chunk:
+                raise FastbootClientException('File ended after %d of %d bytes' % (sent, total))
+            self._send_packet(sock, chunk)
+            sent += len(chunk)
+            if progress_callback is not None:
+                progress_callback(sent, total)
+
+        self._read_response(sock, 'download')
+
+    # Commands
+
+    def getvar(self, name):
+        """Returns the value of a bootloader variable."""
+        sock = self._connect()
+        try:
+            return self._command(sock, 'getvar:%s' % name)
+        finally:
+            sock.close()
+
+    def getvar_all(self):
+        """
+        Returns 'getvar all' in the same form the fastboot binary prints it:
+
+            (bootloader) version-bootloader: HHZ12d
+        """
+        info = []
+        sock = self._connect()
+        try:
+            self._command(sock, 'getvar:all', info=info)
+        finally:
+            sock.close()
+        return '\n'.join(['(bootloader) %s' % line for line in info])
+
+    def oem(self, command):
+        """Runs 'oem command' and returns its INFO lines."""
+        info = []
+        sock = self._connect()
+        try:
+            self._command(sock, 'oem %s' % command, info=info)
+        finally:
+            sock.close()
+        return info
+
+    def _download_file(self, sock, local_path, progress_callback=None):
+        total = os.path.getsize(local_path)
+        try:
+            max_download = self._command(sock, 'getvar:max-download-size')
+        except FastbootClientException:
+            # Older bootloaders do not report a limit.
+            max_download = None
+        max_download_bytes = None
+        if max_download:
+            max_download_bytes = self.parse_size(max_download)
+            if max_download_bytes is None:
+                self.print_verbose('Unreadable max-download-size %r, not checking the size of %s' % (
+                    max_download, local_path))
+        if max_download_bytes is not None and total > max_download_bytes:
+            raise FastbootClientException('%s is %d bytes, but the bootloader accepts at most %s' % (
+                local_path, total, max_download))
+        with open(local_path, 'rb') as file_h:
+            self._download(sock, file_h, total, progress_callback=progress_callback)
+
+    def flash(self, partition, local_path, progress_callback=None):
+        """
+        Streams local_path to the bootloader and flashes it to partition.
+
+        progress_callback, if set, is called with (bytes_sent, total_bytes).
+        """
+        sock = self._connect()
+        try:
+            self._download_file(sock, local_path, progress_callback=progress_callback)
+            self._command(sock, 'flash:%s' % partition)
+        finally:
+            sock.close()
+
+    def boot(self, local_path, progress_callback=None):
+        """Streams a boot image to the bootloader and boots it without flashing."""
+        sock = self._connect()
+        try:
+            self._download_file(sock, local_path, progress_callback=progress_callback)
+            self._command(sock, 'boot')
+        finally:
+            sock.close()
+
+    def erase(self, partition):
+        sock = self._connect()
+        try:
+            self._command(sock, 'erase:%s' % partition)
+        finally:
+            sock.close()
+
+    def reboot(self, mode='reboot'):
+        """mode is 'reboot' or 'reboot-bootloader', as with the fastboot binary."""
+        sock = self._connect()
+        try:
+            self._command(sock, mode)
+        finally:
+            sock.close()
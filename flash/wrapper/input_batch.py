@@ -0,0 +1,118 @@
+from .device_wait import DeviceWait
+
+class InputBatchResult(object):
+    """
+    Outcome of AdbSerial.run_input_batch().
+
+    - succeeded: True if every step ran and every wait was satisfied.
+    - completed: number of steps that succeeded, in order.
+    - failed_step: description of the first step that failed, or None.
+    """
+    def __init__(self, succeeded=False, completed=0, failed_step=None):
+        self.succeeded = succeeded
+        self.completed = completed
+        self.failed_step = failed_step
+
+class InputBatch(object):
+    """
+    A sequence of taps, text, key events and waits, run on the device as one script.
+
+    Scripted onboarding used to start one 'adb shell input ...' per event.  A batch runs
+    in a single shell round trip, runs consecutive key events in a single 'input' process
+    (one JVM start instead of one per key), and waits for activities on the device
+    instead of polling dumpsys from the host.  The batch stops at the first failed step.
+
+        batch = InputBatch()
+        batch.wait_for_activity('.WelcomeActivity', timeout=60)
+        batch.tap(540, 1600)
+        batch.text('guest')
+        batch.key(66)   # KEYCODE_ENTER
+        adb.run_input_batch(batch)
+
+    Several key codes per 'input keyevent' needs Android 4.4 or newer.
+    """
+    STEP_MARKER = '__LMA_STEP__'
+
+    def __init__(self):
+        # (description, command) pairs; command is None for key events still being merged.
+        self.steps = []
+        self.pending_keys = []
+        self.wait_seconds = 0
+
+    def tap(self, x, y):
+        self._add_step('tap %s %s' % (x, y), 'input tap %s %s' % (x, y))
+        return self
+
+    def text(self, text):
+        # 'input text' splits its argument on spaces; %s is its escape for one.
+        self._add_step('text "%s"' % text, 'input text "%s"' % text.replace(' ', '%s'))
+        return self
+
+    def key(self, key_event):
+        """Queues a key event (see https://developer.android.com/reference/android/view/KeyEvent.html)."""
+        self.pending_keys.append(int(key_event))
+        return self
+
+    def sleep(self, seconds):
+        self._add_step('sleep %s' % seconds, 'sleep %s' % seconds)
+        self.wait_seconds += seconds
+        return self
+
+    def wait_for_activity(self, activity, timeout=30):
+        """
+        Waits until activity (for example '.WelcomeActivity') is in the foreground.
+        """
+        script = DeviceWait.condition_script(DeviceWait.foreground_activity(activity),
+                                             timeout=timeout)
+        # The wait script leaves r=1 when the activity came up.
+        self._add_step('wait_for_activity %s' % activity, '%s; [ $r = 1 ]' % script)
+        self.wait_seconds += timeout
+        return self
+
+    def _flush_keys(self):
+        if self.pending_keys:
+            keys = ' '.join(['%d' % key for key in self.pending_keys])
+            self.steps.append(('keyevent %s' % keys, 'input keyevent %s' % keys))
+            self.pending_keys = []
+
+    def _add_step(self, description, command):
+        self._flush_keys()
+        self.steps.append((description, command))
+
+    def get_steps(self):
+        self._flush_keys()
+        return list(self.steps)
+
+    def get_script(self):
+        """
+        Returns the script that runs every step and reports each one's status:
+
+            __LMA_STEP__ <index> <exit code>
+        """
+        lines = ['s=0']
+        for index, (description, command) in enumerate(self.get_steps()):
+            lines.append('if [ $s = 0 ]; then { %s\n}; s=$?; echo "%s %d $s"; fi' % (
+                command, self.STEP_MARKER, index))
+        return '\n'.join(lines)
+
+    def parse(self, stdout):
+        """Returns an InputBatchResult from the script's output."""
+        steps = self.get_steps()
+        completed = 0
+        failed_step = None
+        for line in stdout.splitlines():
+            fields = line.strip().split()
+            if len(fields) != 3 or fields[0] != self.STEP_MARKER:
+                continue
+            if fields[2] == '0':
+                completed += 1
+            else:
+                failed_step = steps[int(fields[1])][0]
+                break
+
+        if failed_step is None and completed < len(steps):
+            # The script was cut short (device disconnected).
+            failed_step = steps[completed][0]
+
+        return InputBatchResult(succeeded=failed_step is None, completed=completed,
+                                failed_step=failed_step)
@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+
+from mercurial import (
+    lock,
+    error as mercurial_error,
+)
+
+class JsonStore(object):
+    """
+    A dict kept in a JSON file, shared by every process on the host.
+
+    Each process keeps its own copy, and changes it through update(), which re-reads
+    the file under a file lock, applies the change to what is there and writes the
+    result back.  Two lma_flash processes recording at the same time therefore both
+    keep their changes, rather than the last writer dropping the other's.
+
+        store = JsonStore(path)
+        data = store.load()
+        data = store.update(data, lambda data: data.setdefault(key, []).append(value))
+    """
+    # Seconds to wait for another process to finish writing.
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = '%s.lock' % path
+
+    def load(self):
+        """Returns the dict in the file, or {} if it is missing or unreadable."""
+        try:
+            with open(self.path) as file_h:
+                data = json.load(file_h)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def _save(self, data):
+        # Write then rename, so that a concurrent reader never sees half a file.
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'w') as file_h:
+            json.dump(data, file_h, indent=2, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+    def update(self, data, change):
+        """
+        Calls change(d) on the latest contents of the file, saves them, and returns them.
+
+        data is the caller's copy.  If the file cannot be locked or written, change is
+        applied to data instead, and data is returned: this process still sees the
+        change, but it is not saved.
+        """
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            file_lock = lock.lock(self.lock_path, timeout=self.LOCK_TIMEOUT)
+        except (mercurial_error.LockHeld, IOError, OSError), e:
+            print >> sys.stderr, 'Unable to lock %s: %s' % (self.path, e)
+            change(data)
+            return data
+
+        try:
+            latest = self.load()
+            change(latest)
+            self._save(latest)
+            return latest
+        except (IOError, OSError), e:
+            print >> sys.stderr, 'Unable to save %s: %s' % (self.path, e)
+            change(data)
+            return data
+        finally:
+            file_lock.release()
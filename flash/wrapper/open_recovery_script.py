@@ -1,19 +1,13 @@
 #! /usr/bin/python
 
-import hashlib
 import os
 import sys
 
 from .adb import AdbSerial
 from .console_wrapper import ConsoleWrapper
 from .device import Device
-
-def hashfile(filename, hash_type=hashlib.md5):
-    hasher = hash_type()
-    with open(filename, 'rb') as file_h:
-        for chunk in iter(lambda: file_h.read(128 * hasher.block_size), b''):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+from .shared_artifact import SharedArtifact
+from .transfer_scheduler import TransferScheduler
 
 class OpenRecoveryScript(ConsoleWrapper):
     """
@@ -25,14 +19,15 @@ class OpenRecoveryScript(ConsoleWrapper):
     """
     ZIP_PREFIX = "/sdcard/Download/openrecoveryscript"
 
-    def __init__(self, serial, verbose=False):
+    def __init__(self, serial, verbose=False, codename=None):
         ConsoleWrapper.__init__(self, verbose=verbose)
         self.serial = serial
 
-        self.adb = AdbSerial(serial=self.serial,
-                             verbose=self.verbose)
+        self.adb = AdbSerial.get_shared(serial=self.serial,
+                                        verbose=self.verbose)
         self.device = Device(serial=self.serial,
-                             verbose=self.verbose)
+                             verbose=self.verbose,
+                             codename=codename)
 
         # Ordered commands to execute
         self.commands = []
@@ -121,7 +116,8 @@ class OpenRecoveryScript(ConsoleWrapper):
             return False
 
         print 'Remote MD5: %s' % remote_file_md5sum
-        local_file_md5sum = hashfile(local_file)
+        # Computed once per file, for every device it goes to.
+        local_file_md5sum = SharedArtifact.get(local_file).get_md5sum()
         print ' Local MD5: %s  %s' % (local_file_md5sum, local_file)
         return remote_file_md5sum.startswith(local_file_md5sum)
 
@@ -164,16 +160,25 @@ class OpenRecoveryScript(ConsoleWrapper):
             self.adb.shell('mkdir -p ' + self.ZIP_PREFIX)
             self.set_sdcard_permissions(path=self.ZIP_PREFIX, recursive_to_sdcard_root=True)
 
-        # Upload the files
-        for local_file, remote_file in self.zipfiles:
-            if not self.files_match(local_file, remote_file):
+        # Upload the files, sharing the USB bus with other devices being flashed
+        uploads = [(local_file, remote_file) for local_file, remote_file in self.zipfiles
+                   if not self.files_match(local_file, remote_file)]
+        remaining = sum([os.path.getsize(local_file) for local_file, _ in uploads])
+        scheduler = TransferScheduler.get_instance()
+        for local_file, remote_file in uploads:
+            size = os.path.getsize(local_file)
+            bus = scheduler.acquire(self.serial, size, remaining=remaining)
+            try:
                 rv = self.adb.push(local_file, remote_file)
-                if not rv:
-                    raise Exception('Unable to upload file: %s to %s' % (local_file, remote_file))
-                # Sanity check uploaded file
-                if not self.files_match(local_file, remote_file):
-                    raise Exception('Uploaded file did not match in MD5: %s to %s' % (local_file, remote_file))
-                self.set_sdcard_permissions(path=remote_file)
+            finally:
+                scheduler.release(bus)
+            remaining -= size
+            if not rv:
+                raise Exception('Unable to upload file: %s to %s' % (local_file, remote_file))
+            # Sanity check uploaded file
+            if not self.files_match(local_file, remote_file):
+                raise Exception('Uploaded file did not match in MD5: %s to %s' % (local_file, remote_file))
+            self.set_sdcard_permissions(path=remote_file)
 
         # Create script
         self.adb.shell('rm /cache/recovery/openrecoveryscript')
@@ -0,0 +1,23 @@
+def parse_props(prop_text):
+    """
+    Parses the contents of a build.prop-style file into a dict.
+
+    Comments and any line that isn't a key-value pair are skipped.  Values keep everything
+    after the first '='.  If a property is defined twice, the last value wins and a
+    warning is printed.
+    """
+    props = {}
+    for prop_line in prop_text.splitlines():
+        # Skip comments and any line that isn't a key-value pair
+        if prop_line.startswith('#'):
+            continue
+        if '=' not in prop_line:
+            continue
+
+        prop_name, prop_val = prop_line.split('=', 1)
+        if prop_name in props and prop_val != props[prop_name]:
+            print 'WARN: Duplicate property "%s" has two values ("%s", "%s")' % \
+                (prop_name, props[prop_name], prop_val)
+        props[prop_name] = prop_val
+
+    return props
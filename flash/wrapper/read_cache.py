@@ -0,0 +1,126 @@
+import re
+
+class BootScopedReadCache(object):
+    """
+    Caches the results of read-only shell commands for one boot of one device.
+
+    Every command is classified before it runs:
+    - READ: only observes the device (getprop ro.*, grep, cat, ...).  Results are cached.
+    - VOLATILE: only observes the device, but what it sees changes during a boot (getprop
+      of anything but ro.*: gsm.version.baseband stays empty until the radio starts,
+      sys.* follow the boot).  Never cached, and invalidates nothing.
+    - IDEMPOTENT: changes the device, but repeating it has no further effect (mount /system,
+      mkdir -p).  The first run invalidates the cache; repeats are answered from it.
+    - WRITE: anything else.  Invalidates the cache and is never cached.
+
+    A command is only as safe as its least safe segment (segments are separated by ;, |,
+    && and ||).  Within a segment, if/then/else/elif are skipped and the command after
+    them is classified.  Any output redirection other than to /dev/null, command
+    substitution ($( ) or backticks), loops and unknown keywords make it a WRITE.
+
+    Cached results belong to a (boot_id, mode) key.  When the key changes (the device
+    rebooted, or moved between device and recovery mode) everything is dropped.
+    """
+    READ = 'read'
+    VOLATILE = 'volatile'
+    IDEMPOTENT = 'idempotent'
+    WRITE = 'write'
+
+    READ_COMMANDS = set([
+        'cat',
+        'grep',
+        'ls',
+        'md5sum',
+        'sha1sum',
+        'which',
+        # Shell glue that does not touch the device
+        '[', 'echo', 'test', 'true',
+        ])
+
+    # Words that introduce the command classified after them.
+    CONDITION_KEYWORDS = set(['if', 'then', 'else', 'elif', '!'])
+    # Words that end a condition and run nothing themselves.
+    CLOSING_KEYWORDS = set(['fi'])
+
+    # One round trip that identifies the current boot and mode.
+    BOOT_KEY_COMMAND = 'cat /proc/sys/kernel/random/boot_id; ' \
+                       'if [ -e /sbin/recovery ]; then echo recovery; else echo device; fi'
+
+    SEGMENT_SEPARATOR = re.compile(r'\|\||&&|[;|\n]')
+    NULL_REDIRECTION = re.compile(r'\d?>\s*/dev/null')
+
+    def __init__(self):
+        self.results = {}
+        self.boot_key = None
+
+    @classmethod
+    def classify(cls, command):
+        """Returns READ, IDEMPOTENT or WRITE for the shell command."""
+        # A substituted command could be anything, and its separators are not segments.
+        if '$(' in command or '`' in command:
+            return cls.WRITE
+
+        segment_classes = set()
+        for segment in cls.SEGMENT_SEPARATOR.split(command):
+            segment_class = cls._classify_segment(segment)
+            if segment_class == cls.WRITE:
+                return cls.WRITE
+            segment_classes.add(segment_class)
+
+        if cls.IDEMPOTENT in segment_classes:
+            # Repeats of a change are answered from the cache; a changing read must not be.
+            if cls.VOLATILE in segment_classes:
+                return cls.WRITE
+            return cls.IDEMPOTENT
+        if cls.VOLATILE in segment_classes:
+            return cls.VOLATILE
+        return cls.READ
+
+    @classmethod
+    def _classify_segment(cls, segment):
+        segment = cls.NULL_REDIRECTION.sub('', segment)
+        if '>' in segment or '<' in segment:
+            return cls.WRITE
+
+        words = segment.split()
+        while words and words[0] in cls.CONDITION_KEYWORDS:
+            words = words[1:]
+        if not words or (len(words) == 1 and words[0] in cls.CLOSING_KEYWORDS):
+            return cls.READ
+
+        # 'mount' alone lists mounts; with arguments it mounts something.
+        if words[0] == 'mount':
+            return cls.READ if len(words) == 1 else cls.IDEMPOTENT
+        if words[0] == 'mkdir' and '-p' in words[1:]:
+            return cls.IDEMPOTENT
+        # Only read-only properties keep their value for the whole boot.
+        if words[0] == 'getprop':
+            if len(words) > 1 and words[1].strip('\'"').startswith('ro.'):
+                return cls.READ
+            return cls.VOLATILE
+        if words[0] in cls.READ_COMMANDS:
+            return cls.READ
+        return cls.WRITE
+
+    @classmethod
+    def parse_boot_key(cls, stdout):
+        """Returns the (boot_id, mode) tuple from the output of BOOT_KEY_COMMAND."""
+        lines = [line.strip() for line in stdout.splitlines() if line.strip()]
+        if len(lines) != 2:
+            return None
+        return (lines[0], lines[1])
+
+    def set_boot_key(self, boot_key):
+        """Drops all results if the device is no longer in the same boot and mode."""
+        if boot_key != self.boot_key:
+            self.invalidate()
+        self.boot_key = boot_key
+
+    def invalidate(self):
+        self.results = {}
+
+    def get(self, command):
+        return self.results.get(command)
+
+    def put(self, command, result):
+        self.results[command] = result
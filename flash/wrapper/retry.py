@@ -0,0 +1,56 @@
+import random
+import time
+
+class Deadline(object):
+    """
+    A time budget shared by a sequence of operations.
+
+    A caller that wants "up to 90 seconds total" creates Deadline(90) and passes it down.
+    Each operation bounds its own timeout by what is left, so one hung command cannot
+    consume more than the caller's budget.
+
+    Deadline(None) never expires.
+    """
+    def __init__(self, seconds=None):
+        self.expires_at = None
+        if seconds is not None:
+            self.expires_at = time.time() + seconds
+
+    @classmethod
+    def coerce(cls, deadline=None, timeout=None):
+        """
+        Returns deadline if set, or a new Deadline for timeout seconds.
+        """
+        if deadline is not None:
+            return deadline
+        return cls(timeout)
+
+    def remaining(self):
+        """Seconds left, or None for an unbounded deadline."""
+        if self.expires_at is None:
+            return None
+        return max(0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def bound(self, timeout=None):
+        """
+        Returns the smaller of timeout and the remaining budget (None if both are unbounded).
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+def backoff_delay(attempt, base=0.25, cap=4):
+    """
+    Returns the delay before retry number attempt (0-based).
+
+    Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt,
+    capped at cap seconds.  Transient failures are retried almost immediately, while
+    persistent ones back off without retrying in lock step.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
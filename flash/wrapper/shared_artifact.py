@@ -0,0 +1,167 @@
+import hashlib
+import os
+import threading
+
+class SharedArtifact(object):
+    """
+    A local file pushed to many devices, read from disk and hashed once for all of them.
+
+    Pushes of the same file that overlap share one reader: the push furthest ahead
+    reads the next chunk from disk into a shared buffer, and the others take it from
+    there.  Chunks are dropped once every push has sent them, so memory holds only
+    the distance between the fastest and the slowest device, at most MAX_BUFFERED_BYTES.
+    A push falling further behind, or starting after the first chunks were dropped,
+    reads what it missed from its own file handle and rejoins the shared buffer when
+    it catches up.
+
+    The MD5 of the file is computed from the shared chunks the first time the file is
+    read through, and reused to verify every device.
+
+        artifact = SharedArtifact.get(local_path)
+        client.push_stream(serial, artifact.chunks(), remote_path)
+        artifact.get_md5sum()
+
+    Artifacts are kept for the whole process, per path; a file changed on disk gets a
+    new one.  Use SharedArtifact.get().
+    """
+    _artifacts = {}
+    _artifacts_lock = threading.Lock()
+
+    # Bytes read at a time; one sync DATA frame.
+    CHUNK_SIZE = 64 * 1024
+
+    # Most bytes held in the shared buffer.
+    MAX_BUFFERED_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, path, size=None, mtime=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+        self.condition = threading.Condition()
+        self.md5sum = None
+
+        # Shared buffer: chunks[0] is chunk number base.
+        self.chunks_buffered = []
+        self.base = 0
+        self.eof = False
+        self.file_h = None
+        # Hash of chunks 0 .. hashed - 1, while the shared reader goes through the file.
+        self.hasher = None
+        self.hashed = 0
+
+        # consumer id -> number of the next chunk it sends.
+        self.positions = {}
+        self.next_consumer = 0
+
+    @classmethod
+    def get(cls, path):
+        """Returns the SharedArtifact for the current contents of path."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with cls._artifacts_lock:
+            artifact = cls._artifacts.get(path)
+            if artifact is None or (artifact.size, artifact.mtime) != (stat.st_size, stat.st_mtime):
+                artifact = cls(path, size=stat.st_size, mtime=stat.st_mtime)
+                cls._artifacts[path] = artifact
+            return artifact
+
+    def get_md5sum(self):
+        """Returns the MD5 of the file, reading it only if no push has read it through yet."""
+        with self.condition:
+            if self.md5sum is not None:
+                return self.md5sum
+        hasher = hashlib.md5()
+        with open(self.path, 'rb') as file_h:
+            for chunk in iter(lambda: file_h.read(self.CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        with self.condition:
+            self.md5sum = hasher.hexdigest()
+            return self.md5sum
+
+    def chunks(self):
+        """Yields the contents of the file, in CHUNK_SIZE pieces, for one push."""
+        with self.condition:
+            consumer = self.next_consumer
+            self.next_consumer += 1
+            self.positions[consumer] = 0
+
+        private_h = None
+        index = 0
+        try:
+            while True:
+                chunk = None
+                with self.condition:
+                    end = self.base + len(self.chunks_buffered)
+                    if self.base <= index < end:
+                        chunk = self.chunks_buffered[index - self.base]
+                    elif index == end and not self.eof:
+                        chunk = self._read_shared()
+                        if chunk is None:
+                            return
+                    elif index >= end and self.eof:
+                        return
+                if chunk is None:
+                    # Behind the shared buffer: catch up from our own handle.
+                    if private_h is None:
+                        private_h = open(self.path, 'rb')
+                    private_h.seek(index * self.CHUNK_SIZE)
+                    chunk = private_h.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        return
+
+                index += 1
+                with self.condition:
+                    self.positions[consumer] = index
+                    self._trim()
+                yield chunk
+        finally:
+            if private_h is not None:
+                private_h.close()
+            with self.condition:
+                del self.positions[consumer]
+                if not self.positions:
+                    self._reset()
+                else:
+                    self._trim()
+
+    def _read_shared(self):
+        """Reads the chunk after the shared buffer.  Called holding the condition."""
+        if self.file_h is None:
+            self.file_h = open(self.path, 'rb')
+            if self.base == 0:
+                self.hasher = hashlib.md5()
+                self.hashed = 0
+        index = self.base + len(self.chunks_buffered)
+        self.file_h.seek(index * self.CHUNK_SIZE)
+        chunk = self.file_h.read(self.CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            if self.hasher is not None and self.hashed == index and self.md5sum is None:
+                self.md5sum = self.hasher.hexdigest()
+            return None
+        if self.hasher is not None and self.hashed == index:
+            self.hasher.update(chunk)
+            self.hashed += 1
+        self.chunks_buffered.append(chunk)
+        return chunk
+
+    def _trim(self):
+        """Drops chunks every push has sent, and the oldest beyond MAX_BUFFERED_BYTES."""
+        end = self.base + len(self.chunks_buffered)
+        keep_from = min([end] + self.positions.values())
+        keep_from = max(keep_from, end - self.MAX_BUFFERED_BYTES // self.CHUNK_SIZE)
+        if keep_from > self.base:
+            del self.chunks_buffered[:keep_from - self.base]
+            self.base = keep_from
+
+    def _reset(self):
+        """Frees the shared buffer once no push is running."""
+        if self.file_h is not None:
+            self.file_h.close()
+            self.file_h = None
+        self.chunks_buffered = []
+        self.base = 0
+        self.eof = False
+        self.hasher = None
+        self.hashed = 0
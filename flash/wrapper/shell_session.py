@@ -0,0 +1,188 @@
+import os
+import re
+import select
+import subprocess
+import time
+
+from .console_wrapper import ConsoleWrapper
+
+class AdbShellSessionException(Exception):
+    """
+    Used to indicate that the persistent shell died, timed out or lost sync.
+
+    The session is closed when this is raised; the next command restarts it.
+    command_started is True if the device had already begun running the command.
+    """
+    command_started = False
+
+class AdbShellSessionTimeout(AdbShellSessionException):
+    """
+    Used to indicate that a command did not finish within its timeout.
+    """
+    pass
+
+class AdbShellResult(object):
+    """
+    Result of a command executed in an AdbShellSession.
+
+    Exposes the same attributes as AdbCommand so callers can use either.
+    """
+    def __init__(self, stdout='', stderr=None, returncode=0, error=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.error = error
+
+class AdbShellSession(ConsoleWrapper):
+    """
+    Keeps one long-lived 'adb shell' process per device and multiplexes commands over its stdin.
+
+    Every command is framed by sentinel lines, and the closing sentinel carries the exit code:
+
+        echo "__LMA_"BEGIN"__ 7"; { command ; } </dev/null 2>&1; echo "__LMA_"END"__ 7 $?"
+
+    The quotes split the markers so that a pty echoing our input back never matches them.
+    Older adbd allocates a pty for 'adb shell', which means echoed input, prompts and \r\n
+    line endings; the parser tolerates all three.
+
+    The adb process exits when the device disconnects (reboot, unplug).  The next command
+    notices and transparently starts a new session.
+    """
+    BEGIN_MARKER = '__LMA_BEGIN__'
+    END_MARKER = '__LMA_END__'
+
+    # Return code reported when the command never ran on the device (same as modern adb).
+    TRANSPORT_FAILURE = 255
+
+    def __init__(self, serial=None, verbose=False, timeout=300):
+        ConsoleWrapper.__init__(self, verbose=verbose)
+        self.serial = serial
+        self.timeout = timeout
+
+        self.process = None
+        self.buffer = ''
+        self.sequence = 0
+
+        # Incremented whenever a new adb process is started.  A new generation means the
+        # device may have rebooted since the last command.
+        self.generation = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """
+        Starts the adb shell process and verifies that the device shell answers.
+        """
+        self.close()
+
+        self.print_verbose('Starting shell session: adb -s "%s" shell' % self.serial)
+        self.process = subprocess.Popen(['adb', '-s', self.serial, 'shell'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        self.buffer = ''
+        self.generation += 1
+
+        # Silence the prompt; it only adds noise to the stream.
+        self._execute('PS1=""', timeout=30)
+
+    def close(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write('exit\n')
+                self.process.stdin.flush()
+            except (IOError, OSError):
+                pass
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.wait()
+        self.process = None
+
+    def execute(self, command, timeout=None):
+        """
+        Runs command on the device and returns an AdbShellResult.
+
+        stderr is merged into stdout, as it is with 'adb shell' on a pty.
+
+        Raises AdbShellSessionException if the session cannot be used.  The session is
+        closed in that case, so a later call will reconnect.
+        """
+        if not self.is_alive():
+            self.start()
+        return self._execute(command, timeout=timeout)
+
+    def _execute(self, command, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        self.sequence += 1
+        begin = '%s %d' % (self.BEGIN_MARKER, self.sequence)
+        end_pattern = re.compile(r'^(.*)%s %d (\d+)$' % (self.END_MARKER, self.sequence))
+
+        line = 'echo "__LMA_"BEGIN"__ %d"; { %s\n} </dev/null 2>&1; echo "__LMA_"END"__ %d $?"\n' % (
+            self.sequence, command, self.sequence)
+
+        try:
+            self.process.stdin.write(line)
+            self.process.stdin.flush()
+        except (IOError, OSError), e:
+            self.close()
+            raise AdbShellSessionException('Unable to write to shell session: %s' % e)
+
+        deadline = time.time() + timeout
+        started = False
+        output = []
+        try:
+            while True:
+                received = self._readline(deadline)
+                if not started:
+                    # Skip echoed input, prompts, and leftovers from an abandoned command.
+                    if received.endswith(begin):
+                        started = True
+                    continue
+
+                end_match = end_pattern.match(received)
+                if end_match is not None:
+                    # Output without a trailing newline shares a line with the end marker.
+                    if end_match.group(1):
+                        output.append(end_match.group(1))
+                    break
+                output.append(received)
+        except AdbShellSessionException, e:
+            e.command_started = started
+            raise
+
+        stdout = ''.join(['%s\n' % out_line for out_line in output])
+        return AdbShellResult(stdout=stdout, returncode=int(end_match.group(2)))
+
+    def _readline(self, deadline):
+        """
+        Returns the next line from the session, without its line ending.
+        """
+        while '\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.close()
+                raise AdbShellSessionTimeout('Timed out waiting for shell session output.')
+
+            fd = self.process.stdout.fileno()
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                # Keep adb's last words ("error: device not found") for the caller.
+                leftover = self.buffer.strip()
+                self.close()
+                raise AdbShellSessionException('Shell session closed by adb. %s' % leftover)
+            self.buffer += chunk
+
+        received, self.buffer = self.buffer.split('\n', 1)
+        return received.rstrip('\r')
@@ -0,0 +1,150 @@
+import re
+import socket
+import subprocess
+import threading
+
+from .adb_client import AdbClient, AdbClientException
+
+class TransferScheduler(object):
+    """
+    Limits how many large pushes share one USB bus at a time.
+
+    Devices on one hub share its bandwidth: four 700 MB pushes at once take about as
+    long as four in a row, and all four devices sit idle until the last byte arrives.
+    Pushes are instead admitted MAX_PER_BUS at a time per bus, the bus being read from
+    the usb: field of 'adb devices -l':
+
+        scheduler = TransferScheduler.get_instance()
+        bus = scheduler.acquire(serial, size, remaining=remaining)
+        try:
+            adb.push(local_file, remote_file)
+        finally:
+            scheduler.release(bus)
+
+    Among waiting devices, the one with the fewest bytes left goes first.  It finishes
+    its pushes and moves on to rebooting and installing, which needs no bandwidth,
+    while the next device pushes: the bus stays busy and devices finish one by one
+    instead of all at the end.
+
+    Small pushes, and devices whose bus is unknown (adb over the network), are not
+    limited.
+
+    One scheduler is shared by the whole process; use TransferScheduler.get_instance().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # Large pushes running at once on one bus.  One push alone leaves gaps while the
+    # device writes to flash; two keep a USB 2.0 bus busy.
+    MAX_PER_BUS = 2
+
+    # Smaller pushes go straight through.
+    LARGE_TRANSFER_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, adb_client=None):
+        if adb_client is None:
+            adb_client = AdbClient()
+        self.adb_client = adb_client
+
+        self.condition = threading.Condition()
+        # serial -> bus, learnt from 'adb devices -l'.
+        self.buses = {}
+        # bus -> number of pushes running.
+        self.running = {}
+        # bus -> [(remaining bytes, ticket, serial)] of waiting pushes.
+        self.waiting = {}
+        self.next_ticket = 0
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def parse_bus(cls, usb):
+        """
+        Returns the bus of a usb: field, or None.
+
+        Linux reports bus-port.port (1-1.4.2: bus 1), Mac OS a hexadecimal location id
+        whose top byte is the bus (14112000: bus 14).
+        """
+        if not usb:
+            return None
+        match = re.match(r'^(\d+)-[\d.]+$', usb)
+        if match:
+            return 'usb-%s' % match.group(1)
+        if re.match(r'^[0-9a-fA-F]{8}$', usb):
+            return 'usb-%s' % usb[:2].lower()
+        return None
+
+    @classmethod
+    def parse_buses(cls, listing):
+        """Returns serial -> bus for the lines of 'adb devices -l'."""
+        buses = {}
+        for line in listing.splitlines():
+            components = line.split()
+            if len(components) < 2 or line.startswith('List of devices'):
+                continue
+            for component in components[2:]:
+                if component.startswith('usb:'):
+                    bus = cls.parse_bus(component[len('usb:'):])
+                    if bus is not None:
+                        buses[components[0]] = bus
+        return buses
+
+    def _list_devices(self):
+        try:
+            return self.adb_client.devices_l()
+        except (AdbClientException, socket.error):
+            command = subprocess.Popen(['adb', 'devices', '-l'],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, _ = command.communicate()
+            return output
+
+    def get_bus(self, serial):
+        """Returns the bus serial is attached to, or None if unknown."""
+        with self.condition:
+            if serial in self.buses:
+                return self.buses[serial]
+        # A device keeps its port across reboots, so one listing per new serial is enough.
+        buses = self.parse_buses(self._list_devices())
+        with self.condition:
+            self.buses.update(buses)
+            return self.buses.get(serial)
+
+    def acquire(self, serial, size, remaining=None):
+        """
+        Waits for a slot on serial's bus.  Returns the bus to give to release(), or None
+        if the push is not limited.
+
+        remaining is how many bytes serial still has to push, this one included.
+        """
+        if size < self.LARGE_TRANSFER_BYTES:
+            return None
+        bus = self.get_bus(serial)
+        if bus is None:
+            return None
+        if remaining is None:
+            remaining = size
+
+        with self.condition:
+            entry = (remaining, self.next_ticket, serial)
+            self.next_ticket += 1
+            waiting = self.waiting.setdefault(bus, [])
+            waiting.append(entry)
+            while self.running.get(bus, 0) >= self.MAX_PER_BUS or min(waiting) != entry:
+                self.condition.wait()
+            waiting.remove(entry)
+            self.running[bus] = self.running.get(bus, 0) + 1
+            # The next waiter may fit too.
+            self.condition.notify_all()
+        return bus
+
+    def release(self, bus):
+        if bus is None:
+            return
+        with self.condition:
+            self.running[bus] -= 1
+            self.condition.notify_all()